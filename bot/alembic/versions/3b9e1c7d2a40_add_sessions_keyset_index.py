@@ -0,0 +1,28 @@
+"""add (created_at, id) index for keyset pagination of sessions
+
+Revision ID: 3b9e1c7d2a40
+Revises: fd5848ab75d8
+Create Date: 2026-10-17 14:03:18.527104
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9e1c7d2a40'
+down_revision: Union[str, None] = 'fd5848ab75d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_sessions_created_id', 'sessions', ['created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sessions_created_id', table_name='sessions')
@@ -0,0 +1,57 @@
+"""add composite indexes and (session_id, user_id) uniqueness for queue hot paths
+
+Revision ID: fd5848ab75d8
+Revises: 8808c23b0026
+Create Date: 2026-10-17 10:12:41.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'fd5848ab75d8'
+down_revision: Union[str, None] = '8808c23b0026'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Перед созданием уникальных ограничений удаляем дубли. Из заявок остается
+    # принятая, затем занявшая слот и только потом самая ранняя
+    op.execute(
+        "DELETE FROM session_requests WHERE id IN ("
+        " SELECT id FROM ("
+        "  SELECT id, ROW_NUMBER() OVER ("
+        "   PARTITION BY session_id, user_id"
+        "   ORDER BY CASE WHEN status = 'accepted' THEN 0 ELSE 1 END,"
+        "    CASE WHEN slot_number IS NOT NULL THEN 0 ELSE 1 END,"
+        "    id"
+        "  ) AS duplicate_rank"
+        "  FROM session_requests"
+        " ) ranked WHERE duplicate_rank > 1"
+        ")"
+    )
+    # Из отзывов остается последний, как при upsert_review
+    op.execute(
+        "DELETE FROM session_reviews a USING session_reviews b "
+        "WHERE a.session_id = b.session_id AND a.user_id = b.user_id AND a.id < b.id"
+    )
+
+    op.create_index('ix_sessions_coach_active_created', 'sessions', ['coach_id', 'is_active', 'created_at'], unique=False)
+    op.create_unique_constraint('uq_session_requests_session_user', 'session_requests', ['session_id', 'user_id'])
+    op.create_index('ix_session_requests_session_status_slot', 'session_requests', ['session_id', 'status', 'slot_number'], unique=False)
+    op.create_index('ix_session_requests_user_status', 'session_requests', ['user_id', 'status'], unique=False)
+    op.create_unique_constraint('uq_session_reviews_session_user', 'session_reviews', ['session_id', 'user_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_session_reviews_session_user', 'session_reviews', type_='unique')
+    op.drop_index('ix_session_requests_user_status', table_name='session_requests')
+    op.drop_index('ix_session_requests_session_status_slot', table_name='session_requests')
+    op.drop_constraint('uq_session_requests_session_user', 'session_requests', type_='unique')
+    op.drop_index('ix_sessions_coach_active_created', table_name='sessions')
@@ -1,12 +1,18 @@
+import asyncio
+import contextvars
+import time
 from datetime import datetime
+from typing import Optional
 from discord import Intents, Member, VoiceState, VoiceChannel
 from discord.ext import commands
 
 from factory import ServiceFactory, get_service_factory
-from commands import SessionCommands, UserCommands
+from commands import AdminCommands, SessionCommands, UserCommands
 from logger import logger
 from database.db import init_db
-from helpers import Roles, RolesManager
+from database.query_counter import finish_operation, start_operation, track_queries
+from helpers import Roles, RolesManager, activity_tracker, channel_registry, session_manager
+from helpers.activity_tracker import ACTIVITY_FLUSH_INTERVAL, ACTIVITY_HEARTBEAT_INTERVAL
 import enum
 
 
@@ -26,21 +32,65 @@ class BoostyQueueBot(commands.Bot):
         self.service_factory.init_discord_service(self)
         self.channel_states = {}
         self.guild = None
+        self.members_sync_task = None
+        self.activity_flush_task = None
+        self.activity_flush_lock = asyncio.Lock()
+        self.before_invoke(self.start_command_tracking)
+        self.after_invoke(self.finish_command_tracking)
+
+    async def start_command_tracking(self, ctx: commands.Context):
+        ctx.query_operation_token = start_operation(f"command:{ctx.command.qualified_name}")
+
+    async def finish_command_tracking(self, ctx: commands.Context):
+        token = getattr(ctx, "query_operation_token", None)
+        if token is not None:
+            finish_operation(token)
 
     async def setup_hook(self):
         await init_db()
+        await self.warm_session_state()
+        await self.recover_activities()
+        # Пустой контекст: запросы задачи не учитываются в других операциях
+        self.activity_flush_task = asyncio.create_task(
+            self.flush_activities_periodically(), context=contextvars.Context()
+        )
         await self.load_commands()
 
-    def is_session_channel(self, channel: VoiceChannel):
-        return channel.category and channel.category.name.startswith("Сессия")
+    async def warm_session_state(self):
+        """Загружает открытые сессии в session_manager до обработки событий"""
+        try:
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                count = await session_service.warm_session_state()
+            logger.info(f"Session state warmed: {count} open sessions")
+        except Exception as e:
+            # Без прогрева каналы сессий ищутся в БД (get_channel_session_id),
+            # повторная попытка - в on_ready
+            logger.error(f"Error warming session state: {e}")
 
-    async def handle_voice_channel_join(self, member: Member, voice_ch: VoiceChannel):
+    async def get_channel_session_id(self, channel: Optional[VoiceChannel]) -> Optional[int]:
+        """
+        Идентификатор открытой сессии канала по индексу session_manager
+
+        Если прогрев при запуске не удался, индекс неполон, и канал
+        ищется в БД, пока хранилище не будет прогрето.
+        """
+        if channel is None:
+            return None
+        if session_manager.warmed:
+            return session_manager.get_session_id_by_channel(channel.id)
         async with get_service_factory(self.service_factory) as factory:
             session_service = await factory.get_service("session")
-            session_id = int(voice_ch.category.name.split(" ")[1])
-            await session_service.create_user_session_activity(
-                session_id, member.id, join_time=datetime.now()
-            )
+            return await session_service.get_session_id_by_channel(channel.id)
+
+    async def is_session_channel(self, channel: Optional[VoiceChannel]) -> bool:
+        return await self.get_channel_session_id(channel) is not None
+
+    async def handle_voice_channel_join(self, member: Member, voice_ch: VoiceChannel):
+        session_id = await self.get_channel_session_id(voice_ch)
+        if session_id is None:
+            return
+        if activity_tracker.join(session_id, member.id, datetime.now()):
             logger.info(f"User {member.name} joined session {session_id}")
 
     async def on_voice_state_update(
@@ -48,39 +98,85 @@ class BoostyQueueBot(commands.Bot):
     ):
         if member.bot:
             return
+        # Мьют, стрим и события вне каналов сессий не требуют обработки
+        if before.channel == after.channel:
+            return
+        before_session_id = await self.get_channel_session_id(before.channel)
+        after_session_id = await self.get_channel_session_id(after.channel)
+        if before_session_id is None and after_session_id is None:
+            return
 
-        async with get_service_factory(self.service_factory) as factory:
-            session_service = await factory.get_service("session")
-            logger.info(
-                f"on_voice_state_update: {member.name} {before.channel} {after.channel}"
-            )
+        # Переходы копятся в activity_tracker и пишутся в БД пачкой (flush_activities)
+        now = datetime.now()
+        if before_session_id is not None and before_session_id != after_session_id:
+            if activity_tracker.leave(before_session_id, member.id, now):
+                logger.info(f"User {member.name} left session {before_session_id}")
+        if after_session_id is not None:
+            if activity_tracker.join(after_session_id, member.id, now):
+                logger.info(f"User {member.name} joined session {after_session_id}")
 
-            if after.channel and self.is_session_channel(after.channel):
-                session_id = int(after.channel.category.name.split(" ")[1])
-                logger.info(f"session_id: {session_id}")
-                active_activities = await session_service.get_active_user_activities(
-                    session_id, member.id
-                )
-                if not active_activities:
-                    await session_service.create_user_session_activity(
-                        session_id, member.id, join_time=datetime.now()
-                    )
-                    logger.info(f"User {member.name} joined session {session_id}")
+    @track_queries("task:flush_activities")
+    async def flush_activities(self, heartbeat: bool = False):
+        """
+        Записывает накопленные входы и выходы из каналов сессий одной транзакцией
 
-            if before.channel and self.is_session_channel(before.channel):
-                session_id = int(before.channel.category.name.split(" ")[1])
-                logger.info(f"session_id: {session_id}")
-                active_activities = await session_service.get_active_user_activities(
-                    session_id, member.id
-                )
-                for activity in active_activities:
-                    await session_service.complete_user_activity(
-                        activity.id, datetime.now()
-                    )
+        Args:
+            heartbeat: Отметить открытые активности текущим временем, чтобы после
+                аварийной остановки они закрылись этим временем, а не временем запуска
+        """
+        async with self.activity_flush_lock:
+            batch, events = activity_tracker.drain()
+            heartbeat_at = datetime.now() if heartbeat and activity_tracker.open else None
+            if not batch and heartbeat_at is None:
+                return
+            try:
+                async with get_service_factory(self.service_factory) as factory:
+                    session_service = await factory.get_service("session")
+                    closed, created = await session_service.apply_activity_batch(batch, heartbeat_at)
+                logger.info(f"Activities flushed: {closed} closed, {created} created")
+            except Exception as e:
+                # События вернутся в буфер и будут записаны следующим сбросом
+                activity_tracker.requeue(events)
+                logger.error(f"Error flushing activities: {e}")
 
-                logger.info(f"User {member.name} left session {session_id}")
+    async def flush_activities_periodically(self):
+        last_heartbeat = time.monotonic()
+        while not self.is_closed():
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            heartbeat = time.monotonic() - last_heartbeat >= ACTIVITY_HEARTBEAT_INTERVAL
+            if heartbeat:
+                last_heartbeat = time.monotonic()
+            await self.flush_activities(heartbeat=heartbeat)
 
-        logger.info(f"Channel states: {self.channel_states}")
+    async def recover_activities(self):
+        """Закрывает активности, оставшиеся открытыми после прошлого запуска"""
+        try:
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                closed = await session_service.close_dangling_activities()
+            activity_tracker.clear()
+            logger.info(f"Dangling activities closed: {closed}")
+        except Exception as e:
+            logger.error(f"Error closing dangling activities: {e}")
+
+    def reopen_activities(self, guild):
+        """Открывает активности участников, уже находящихся в голосовых каналах сессий"""
+        now = datetime.now()
+        for state in list(session_manager.sessions.values()):
+            voice_channel_id = state.session.voice_channel_id
+            channel = guild.get_channel(voice_channel_id) if voice_channel_id else None
+            if channel is None:
+                continue
+            for member in channel.members:
+                if not member.bot:
+                    activity_tracker.join(state.session_id, member.id, now)
+
+    async def close(self):
+        # Время простоя до следующего запуска не засчитывается: активности
+        # закрываются сейчас, а при запуске reopen_activities открывает их снова
+        activity_tracker.close_all(datetime.now())
+        await self.flush_activities()
+        await super().close()
 
     def clear_channel_state(self, channel_id: int):
         if channel_id in self.channel_states:
@@ -91,6 +187,7 @@ class BoostyQueueBot(commands.Bot):
             return self.channel_states[channel_id]
         return None
 
+    @track_queries("event:on_member_update")
     async def on_member_update(self, before: Member, after: Member):
         if before.roles != after.roles:
             logger.info(
@@ -100,7 +197,12 @@ class BoostyQueueBot(commands.Bot):
                 role.name for role in after.roles if role not in before.roles
             ]
             lost_roles = [role.name for role in before.roles if role not in after.roles]
+            coach_roles = (Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3)
+            coach_changed = any(role in coach_roles for role in gained_roles + lost_roles)
 
+            # Любая смена ролей (например, получение Subscriber) создает недостающего
+            # пользователя. Известный пользователь берется из user_cache, и без смены
+            # роли коуча событие обходится без обращения к БД
             async with get_service_factory(self.service_factory) as factory:
                 user_service = await factory.get_service("user")
                 user = await user_service.get_user(after.id)
@@ -108,6 +210,8 @@ class BoostyQueueBot(commands.Bot):
                     user = await user_service.create_user(
                         after.id, after.name, join_date=after.joined_at.replace(tzinfo=None)
                     )
+                if not coach_changed:
+                    return
                 if "Coach T1" in gained_roles:
                     await user_service.update_user(user.id, coach_tier="Coach T1")
                 elif "Coach T2" in gained_roles:
@@ -122,6 +226,31 @@ class BoostyQueueBot(commands.Bot):
                 elif "Coach T3" in lost_roles:
                     await user_service.update_user(user.id, coach_tier=None)
 
+    def is_registry_guild(self, channel) -> bool:
+        return self.guild is not None and channel.guild.id == self.guild.id
+
+    async def on_guild_channel_create(self, channel):
+        if self.is_registry_guild(channel):
+            channel_registry.register(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        if self.is_registry_guild(channel):
+            channel_registry.unregister(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        if self.is_registry_guild(after) and before.name != after.name:
+            channel_registry.update(before, after)
+
+    async def on_guild_role_create(self, role):
+        RolesManager.invalidate(role.guild)
+
+    async def on_guild_role_delete(self, role):
+        RolesManager.invalidate(role.guild)
+
+    async def on_guild_role_update(self, before, after):
+        RolesManager.invalidate(after.guild)
+
+    @track_queries("event:on_ready")
     async def on_ready(self):
         from random import randint
 
@@ -136,75 +265,46 @@ class BoostyQueueBot(commands.Bot):
             if self.guild:
                 synced = await self.tree.sync()
                 logger.info(f"Synced commands: {synced}")
-                roles_manager = RolesManager(self.guild)
+                roles_manager = RolesManager.for_guild(self.guild)
                 await roles_manager.check_roles()
+                if not session_manager.warmed:
+                    await self.warm_session_state()
+                self.reopen_activities(self.guild)
 
                 admin_overwrites = await roles_manager.get_session_admin_overwrites()
+                channel_registry.populate(self.guild)
                 categories = [ch for ch in self.guild.categories if ch.name == "Сессии"]
-                channels = [ch.name for ch in self.guild.channels]
                 if len(categories) == 0:
                     category = await self.guild.create_category("Сессии")
                     logger.info(f"Created category: {category.name}")
                 else:
                     category = categories[0]
-                if Channels.SESSION_START_CHANNEL.value not in channels:
+                if channel_registry.start_channel_id is None:
                     logger.info(
                         f"Creating session start channel: {Channels.SESSION_START_CHANNEL.value}"
                     )
-                    await self.guild.create_text_channel(
+                    channel = await self.guild.create_text_channel(
                         Channels.SESSION_START_CHANNEL.value,
                         category=category,
                         overwrites=admin_overwrites,
                     )
-                if Channels.SESSION_LOGS_CHANNEL.value not in channels:
+                    channel_registry.register(channel)
+                if channel_registry.logs_channel_id is None:
                     logger.info(
                         f"Creating session logs channel: {Channels.SESSION_LOGS_CHANNEL.value}"
                     )
-                    await self.guild.create_text_channel(
+                    channel = await self.guild.create_text_channel(
                         Channels.SESSION_LOGS_CHANNEL.value,
                         category=category,
                         overwrites=admin_overwrites,
                     )
+                    channel_registry.register(channel)
 
-                async with get_service_factory(self.service_factory) as factory:
-                    user_service = await factory.get_service("user")
-                    for member in self.guild.members:
-                        roles = [role.name for role in member.roles]
-                        if member.bot:
-                            continue
-                        if Roles.SUB in roles:
-                            user = await user_service.get_user(member.id)
-                            join_date = member.joined_at.replace(tzinfo=None)
-                            if not user:
-                                await user_service.create_user(
-                                    member.id, member.name, join_date=join_date
-                                )
-                        if (
-                            Roles.COACH_T1 in roles
-                            or Roles.COACH_T2 in roles
-                            or Roles.COACH_T3 in roles
-                        ):
-                            coach_tier = (
-                                Roles.COACH_T1
-                                if Roles.COACH_T1 in roles
-                                else (
-                                    Roles.COACH_T2
-                                    if Roles.COACH_T2 in roles
-                                    else Roles.COACH_T3
-                                )
-                            )
-                            user = await user_service.get_user(member.id)
-                            if not user:
-                                await user_service.create_user(
-                                    member.id,
-                                    member.name,
-                                    join_date=join_date,
-                                    coach_tier=coach_tier,
-                                )
-                            else:
-                                await user_service.update_user(
-                                    member.id, coach_tier=coach_tier
-                                )
+                # Синхронизация пользователей не задерживает готовность бота.
+                # Пустой контекст: запросы задачи не учитываются в операции on_ready
+                self.members_sync_task = asyncio.create_task(
+                    self.sync_members(self.guild), context=contextvars.Context()
+                )
 
         except Exception as e:
             logger.error(f"Error on_ready: {e}")
@@ -212,12 +312,56 @@ class BoostyQueueBot(commands.Bot):
 
             logger.error(traceback.format_exc())
 
+    def member_sync_row(self, member: Member) -> dict | None:
+        """Данные пользователя для синхронизации или None, если участник не синхронизируется"""
+        roles = [role.name for role in member.roles]
+        coach_tier = next(
+            (
+                tier
+                for tier in (Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3)
+                if tier in roles
+            ),
+            None,
+        )
+        if member.bot or (Roles.SUB not in roles and not coach_tier):
+            return None
+        return {
+            "id": member.id,
+            "nickname": member.name,
+            "join_date": member.joined_at.replace(tzinfo=None),
+            "coach_tier": coach_tier,
+        }
+
+    @track_queries("task:sync_members")
+    async def sync_members(self, guild):
+        """Синхронизирует подписчиков и коучей сервера с таблицей пользователей"""
+        try:
+            started = time.perf_counter()
+            rows = [
+                row
+                for row in map(self.member_sync_row, guild.members)
+                if row is not None
+            ]
+            async with get_service_factory(self.service_factory) as factory:
+                user_service = await factory.get_service("user")
+                written = await user_service.bulk_sync(rows)
+            logger.info(
+                f"Members sync: {len(rows)} members, {written} users written "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+        except Exception:
+            import traceback
+
+            logger.error(f"Error syncing members: {traceback.format_exc()}")
+
     async def load_commands(self):
         try:
             session_commands = SessionCommands(self, self.service_factory)
             await self.add_cog(session_commands)
             user_commands = UserCommands(self, self.service_factory)
             await self.add_cog(user_commands)
+            admin_commands = AdminCommands(self, self.service_factory)
+            await self.add_cog(admin_commands)
             logger.info("Commands loaded")
         except Exception as e:
             logger.error(f"Error loading commands: {e}")
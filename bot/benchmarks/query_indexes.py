@@ -0,0 +1,238 @@
+"""
+Бенчмарк индексов горячих путей очереди (миграция fd5848ab75d8).
+
+Засевает отдельную БД PostgreSQL (по умолчанию 100k заявок), снимает планы
+запросов и задержки без индексов, затем создает индексы из метаданных моделей
+и повторяет замеры.
+
+ВНИМАНИЕ: скрипт пересоздает все таблицы в указанной БД. Не запускайте его на
+рабочей базе.
+
+Запуск из каталога bot:
+    python -m benchmarks.query_indexes --url postgresql+asyncpg://postgres:postgres@db:5432/boosty_bench
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Index, UniqueConstraint, func, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from sqlalchemy.schema import AddConstraint, CreateIndex, DropConstraint, DropIndex
+
+from models import Base, Session, SessionRequest, SessionRequestStatus, SessionReview, User
+
+REQUESTS_PER_SESSION = 50
+REVIEWS_PER_SESSION = 10
+COACHES = 50
+CHUNK_SIZE = 5000
+
+INDEXED_TABLES = (Session.__table__, SessionRequest.__table__, SessionReview.__table__)
+
+
+def hot_path_indexes() -> list:
+    """Индексы и уникальные ограничения, добавленные миграцией"""
+    items = []
+    for table in INDEXED_TABLES:
+        items.extend(sorted(table.indexes, key=lambda index: index.name))
+        items.extend(
+            sorted(
+                (c for c in table.constraints if isinstance(c, UniqueConstraint)),
+                key=lambda constraint: constraint.name,
+            )
+        )
+    return items
+
+
+def hot_path_queries(sessions_count: int, users_count: int) -> dict:
+    """Фабрики запросов, повторяющих запросы репозиториев на горячих путях"""
+    def random_session_id() -> int:
+        return random.randint(1, sessions_count)
+
+    def random_user_id() -> int:
+        return random.randint(1, users_count)
+
+    return {
+        "request by (session_id, user_id)": lambda: select(SessionRequest).where(
+            SessionRequest.session_id == random_session_id(),
+            SessionRequest.user_id == random_user_id(),
+        ),
+        "accepted slots of session": lambda: select(SessionRequest)
+        .where(
+            SessionRequest.session_id == random_session_id(),
+            SessionRequest.status == SessionRequestStatus.ACCEPTED.value,
+        )
+        .order_by(SessionRequest.slot_number),
+        "active sessions of coach": lambda: select(Session)
+        .where(Session.coach_id == random.randint(1, COACHES), Session.is_active == True)
+        .order_by(Session.created_at.desc()),
+        "review by (session_id, user_id)": lambda: select(SessionReview).where(
+            SessionReview.session_id == random_session_id(),
+            SessionReview.user_id == random_user_id(),
+        ),
+        "user sessions count": lambda: select(func.count(SessionRequest.id))
+        .join(Session)
+        .where(
+            SessionRequest.user_id == random_user_id(),
+            Session.type == "replay",
+            SessionRequest.status == SessionRequestStatus.ACCEPTED.value,
+        ),
+    }
+
+
+async def insert_chunked(conn: AsyncConnection, model, rows: list):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        await conn.execute(insert(model), rows[start:start + CHUNK_SIZE])
+
+
+async def seed(conn: AsyncConnection, requests_count: int) -> tuple[int, int]:
+    """Заполняет БД тестовыми данными. Возвращает (кол-во сессий, кол-во пользователей)"""
+    random.seed(42)
+    sessions_count = max(1, requests_count // REQUESTS_PER_SESSION)
+    users_count = max(REQUESTS_PER_SESSION * 4, requests_count // 20)
+    now = datetime.utcnow()
+
+    await insert_chunked(conn, User, [
+        {"id": user_id, "nickname": f"user{user_id}", "join_date": now}
+        for user_id in range(1, users_count + 1)
+    ])
+    await insert_chunked(conn, Session, [
+        {
+            "id": session_id,
+            "type": random.choice(("replay", "creative")),
+            "coach_id": random.randint(1, COACHES),
+            "date": now - timedelta(hours=sessions_count - session_id),
+            "created_at": now - timedelta(hours=sessions_count - session_id),
+            "max_slots": 8,
+            "is_active": session_id > sessions_count - 3,
+        }
+        for session_id in range(1, sessions_count + 1)
+    ])
+
+    requests, reviews = [], []
+    for session_id in range(1, sessions_count + 1):
+        user_ids = random.sample(range(1, users_count + 1), REQUESTS_PER_SESSION)
+        for idx, user_id in enumerate(user_ids):
+            accepted = idx < 8
+            requests.append({
+                "session_id": session_id,
+                "user_id": user_id,
+                "status": SessionRequestStatus.ACCEPTED.value if accepted else SessionRequestStatus.REJECTED.value,
+                "slot_number": idx + 1 if accepted else None,
+            })
+        for user_id in user_ids[:REVIEWS_PER_SESSION]:
+            reviews.append({"session_id": session_id, "user_id": user_id, "rating": random.randint(0, 1)})
+    await insert_chunked(conn, SessionRequest, requests[:requests_count])
+    await insert_chunked(conn, SessionReview, reviews)
+    return sessions_count, users_count
+
+
+async def drop_indexes(conn: AsyncConnection):
+    for item in hot_path_indexes():
+        if isinstance(item, Index):
+            await conn.execute(DropIndex(item, if_exists=True))
+        else:
+            await conn.execute(DropConstraint(item, if_exists=True))
+
+
+async def create_indexes(conn: AsyncConnection):
+    for item in hot_path_indexes():
+        if isinstance(item, Index):
+            await conn.execute(CreateIndex(item))
+        else:
+            await conn.execute(AddConstraint(item))
+
+
+async def analyze(conn: AsyncConnection):
+    for table in INDEXED_TABLES:
+        await conn.exec_driver_sql(f"ANALYZE {table.name}")
+
+
+async def measure(conn: AsyncConnection, queries: dict, iterations: int) -> dict:
+    """Снимает план (EXPLAIN ANALYZE) и задержки каждого запроса"""
+    results = {}
+    for name, make_query in queries.items():
+        compiled = make_query().compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        plan = await conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {compiled}")
+        timings = []
+        for _ in range(iterations):
+            query = make_query()
+            started = time.perf_counter()
+            await conn.execute(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        results[name] = {
+            "plan": [row[0] for row in plan.all()],
+            "median_ms": statistics.median(timings),
+            "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        }
+    return results
+
+
+def print_plans(title: str, results: dict):
+    print(f"\n===== {title} =====")
+    for name, result in results.items():
+        print(f"\n--- {name} ---")
+        print("\n".join(result["plan"]))
+
+
+def print_summary(before: dict, after: dict):
+    print("\n===== Сводка (мс) =====")
+    header = f"{'запрос':<36}{'до, median':>12}{'до, p95':>10}{'после, median':>16}{'после, p95':>12}{'ускорение':>11}"
+    print(header)
+    print("-" * len(header))
+    for name in before:
+        b, a = before[name], after[name]
+        speedup = b["median_ms"] / a["median_ms"] if a["median_ms"] else float("inf")
+        print(
+            f"{name:<36}{b['median_ms']:>12.3f}{b['p95_ms']:>10.3f}"
+            f"{a['median_ms']:>16.3f}{a['p95_ms']:>12.3f}{speedup:>10.1f}x"
+        )
+
+
+async def main(url: str, requests_count: int, iterations: int):
+    engine = create_async_engine(url)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            await drop_indexes(conn)
+            started = time.perf_counter()
+            sessions_count, users_count = await seed(conn, requests_count)
+            print(
+                f"Seeded {requests_count} requests, {sessions_count} sessions, "
+                f"{users_count} users in {time.perf_counter() - started:.1f}s"
+            )
+
+        queries = hot_path_queries(sessions_count, users_count)
+        async with engine.connect() as conn:
+            await analyze(conn)
+            before = await measure(conn, queries, iterations)
+            await conn.commit()
+
+        async with engine.begin() as conn:
+            await create_indexes(conn)
+            await analyze(conn)
+
+        async with engine.connect() as conn:
+            after = await measure(conn, queries, iterations)
+
+        print_plans("Без индексов", before)
+        print_plans("С индексами", after)
+        print_summary(before, after)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк индексов горячих путей очереди")
+    parser.add_argument("--url", default=os.environ.get("BENCH_DATABASE_URL"), help="URL отдельной БД для бенчмарка")
+    parser.add_argument("--requests", type=int, default=100_000, help="Количество заявок для засева")
+    parser.add_argument("--iterations", type=int, default=200, help="Повторов каждого запроса")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("Укажите --url или BENCH_DATABASE_URL")
+    asyncio.run(main(args.url, args.requests, args.iterations))
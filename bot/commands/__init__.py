@@ -1,4 +1,5 @@
+from .admin_commands import AdminCommands
 from .session_commands import SessionCommands
 from .user_commands import UserCommands
 
-__all__ = ["SessionCommands", "UserCommands"]
\ No newline at end of file
+__all__ = ["AdminCommands", "SessionCommands", "UserCommands"]
@@ -0,0 +1,74 @@
+import csv
+from io import BytesIO, StringIO
+
+import discord
+from discord.ext import commands
+from discord.ext.commands import Cog
+
+from config import config
+from database.db import engine, read_engine
+from database.pool_stats import get_pool_stats
+from factory import ServiceFactory, get_service_factory
+from helpers.user_cache import user_cache
+from logger import logger
+
+class AdminCommands(Cog):
+    def __init__(self, bot: commands.Bot, service_factory: ServiceFactory):
+        self.bot = bot
+        self.service_factory = service_factory
+
+    @commands.command(name="recount_sessions")
+    async def recount_sessions(self, ctx: commands.Context):
+        """Пересчитывает счетчики сессий пользователей по принятым заявкам"""
+        if ctx.author.id not in [config.ADMIN_ID, config.DEVELOPER_ID]:
+            return
+        async with get_service_factory(self.service_factory) as factory:
+            user_service = await factory.get_service("user")
+            updated = await user_service.recompute_sessions_counts()
+        logger.info(f"Sessions counters recomputed for {updated} users")
+        await ctx.send(f"Счетчики сессий пересчитаны для {updated} пользователей")
+
+    @commands.command(name="sessions")
+    async def export_sessions(self, ctx: commands.Context, coach_id: int = None):
+        """Выгружает историю сессий (опционально одного коуча) в CSV"""
+        if ctx.author.id not in [config.ADMIN_ID, config.DEVELOPER_ID]:
+            return
+        filters = {"coach_id": coach_id} if coach_id else {}
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "type", "coach_id", "date", "start_time", "end_time", "max_slots", "is_active"])
+        exported = 0
+        async with get_service_factory(self.service_factory, read_only=True) as factory:
+            session_service = await factory.get_service("session")
+            async for session in session_service.stream_sessions(**filters):
+                writer.writerow([
+                    session.id, session.type, session.coach_id, session.date,
+                    session.start_time, session.end_time, session.max_slots, session.is_active,
+                ])
+                exported += 1
+        # Файл собирается в памяти: параллельные выгрузки не затирают друг друга
+        file = discord.File(BytesIO(buffer.getvalue().encode("utf-8")), filename="sessions_history.csv")
+        await ctx.send(content=f"Выгружено сессий: {exported}", file=file)
+
+    @commands.command(name="pool")
+    async def pool_stats(self, ctx: commands.Context):
+        """Показывает состояние пулов соединений с БД"""
+        if ctx.author.id not in [config.ADMIN_ID, config.DEVELOPER_ID]:
+            return
+        lines = []
+        for name, pool_engine in (("main", engine), ("read", read_engine)):
+            stats = get_pool_stats(pool_engine)
+            histogram = stats.pop("wait_histogram", {})
+            lines.append(f"[{name}]")
+            lines.extend(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}" for key, value in stats.items())
+            lines.extend(f"  {bucket}: {count}" for bucket, count in histogram.items() if count)
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.command(name="cache")
+    async def cache_stats(self, ctx: commands.Context):
+        """Показывает статистику кэша пользователей"""
+        if ctx.author.id not in [config.ADMIN_ID, config.DEVELOPER_ID]:
+            return
+        stats = user_cache.stats()
+        lines = [f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}" for key, value in stats.items()]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
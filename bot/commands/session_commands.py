@@ -5,7 +5,7 @@ from discord import User, Member, Guild, TextChannel
 
 from config import config
 from factory import ServiceFactory, get_service_factory
-from helpers import ScoreCalculator
+from helpers import ScoreCalculator, SessionHeader, SessionState, activity_tracker, channel_registry, session_manager
 from helpers.roles_manager import RolesManager
 from logger import logger
 from models.session import (
@@ -15,9 +15,11 @@ from models.session import (
     UserSessionActivity,
     Session,
 )
+from repositories import SessionLoad, SlotClaimStatus
 from services.discord_service import Roles
-from services import ReportService
+from services import ReportService, SessionService
 from utils import get_current_time
+from datetime import datetime
 from typing import List
 from ui import (
     SessionQueueView,
@@ -30,7 +32,6 @@ from ui import (
 
 import asyncio
 import os
-import re  # Добавляем импорт для регулярных выражений
 
 
 class SessionInfo:
@@ -62,7 +63,6 @@ class SessionCommands(Cog):
         self.bot = bot
         self.service_factory = service_factory
         self.SESSION_AUTO_DELETE_TIME = 600
-        self.sessions = {}
 
     async def response_to_user(
         self, ctx: commands.Context, message: str, channel: TextChannel = None
@@ -77,7 +77,8 @@ class SessionCommands(Cog):
 
     @commands.command(name="test")
     async def test(self, ctx: commands.Context):
-        user_service = await self.service_factory.get_service("user")
+        async with get_service_factory(self.service_factory) as factory:
+            user_service = await factory.get_service("user")
 
     @commands.hybrid_command(name="create")
     @commands.has_any_role(Roles.MOD, Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3)
@@ -111,13 +112,12 @@ class SessionCommands(Cog):
 
             author = ctx.author
             guild = ctx.guild
-            roles_manager = RolesManager(guild)
+            roles_manager = RolesManager.for_guild(guild)
             await roles_manager.check_roles()
 
             async with get_service_factory(self.service_factory) as factory:
                 user_service = await factory.get_service("user")
                 session_service = await factory.get_service("session")
-                discord_service = await factory.get_service("discord")
 
                 coach = await user_service.get_user(author.id)
                 if not coach:
@@ -139,40 +139,43 @@ class SessionCommands(Cog):
                     max_slots=max_slots,
                 )
 
-                overwrites = roles_manager.get_session_channels_overwrites()
-                category = await guild.create_category(
-                    f"Сессия {session.id}", overwrites=overwrites
-                )
-                text_ch = await guild.create_text_channel(
-                    f"🚦・Очередь", category=category, overwrites=overwrites
-                )
-                logger.info(f"Session channels created")
+            # Каналы и сообщение очереди создаются после закрытия скоупа БД,
+            # их id записываются отдельным коротким скоупом
+            overwrites = roles_manager.get_session_channels_overwrites()
+            category = await guild.create_category(
+                f"Сессия {session.id}", overwrites=overwrites
+            )
+            channel_registry.register(category)
+            text_ch = await guild.create_text_channel(
+                f"🚦・Очередь", category=category, overwrites=overwrites
+            )
+            logger.info(f"Session channels created")
 
-                embed = SessionQueueEmbed(author, session.id)
-                view = SessionQueueView(
-                    session, session_service, discord_service, user_service
-                )
-                info_message = await text_ch.send(embed=embed, view=view)
-                await info_message.pin()
+            embed = SessionQueueEmbed(author, session.id)
+            view = SessionQueueView(session, self.service_factory)
+            info_message = await text_ch.send(embed=embed, view=view)
+            await info_message.pin()
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
                 await session_service.update_session(
                     session.id, info_message_id=info_message.id, text_channel_id=text_ch.id
                 )
-                if ctx.interaction:
-                    await ctx.interaction.response.send_message(
-                        f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}"
-                    )
-                else:
-                    await text_ch.send(
-                        f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}"
-                    )
+            if ctx.interaction:
+                await ctx.interaction.response.send_message(
+                    f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}"
+                )
+            else:
+                await text_ch.send(
+                    f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}"
+                )
 
-                for channel in guild.text_channels:
-                    if "логи-сессий" in channel.name:
-                        await self.response_to_user(
-                            ctx,
-                            f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}",
-                            channel,
-                        )
+            logs_channel = channel_registry.get_logs_channel(guild)
+            if logs_channel:
+                await self.response_to_user(
+                    ctx,
+                    f"Сессия {session.id} создана. Коуч: {author.mention}. Количество слотов: {max_slots}",
+                    logs_channel,
+                )
 
         except discord.Forbidden:
             await self.response_to_user(
@@ -195,127 +198,109 @@ class SessionCommands(Cog):
     async def start_session(self, ctx: commands.Context):
         logger.info(f"Starting session for {ctx.author.name}")
         try:
+            guild = ctx.guild
+            coach = guild.get_member(ctx.author.id)
+            error = None
             async with get_service_factory(self.service_factory) as factory:
                 user_service = await factory.get_service("user")
                 session_service = await factory.get_service("session")
-                discord_service = await factory.get_service("discord")
-                guild = ctx.guild
-                active_sessions = await session_service.get_active_sessions_by_coach_id(
+                active_sessions = await session_service.get_active_session_states_by_coach_id(
                     ctx.author.id
                 )
-                coach = guild.get_member(ctx.author.id)
+                session = None
                 if len(active_sessions) > 0:
-                    await self.response_to_user(
-                        ctx,
-                        "У вас есть запущенная сессия. Пожалуйста, завершите её перед началом новой.",
-                        ctx.channel,
+                    error = "У вас есть запущенная сессия. Пожалуйста, завершите её перед началом новой."
+                else:
+                    session = await session_service.get_last_created_session_by_coach_id(
+                        ctx.author.id, load=SessionLoad.HEADER
                     )
-                    return
+                    if not session:
+                        error = "У вас нет созданных сессий. Пожалуйста, сначала создайте сессию."
+                    elif ctx.channel.id != session.text_channel_id:
+                        error = f"Вы не можете начать сессию в этом канале. Пожалуйста, используйте канал, где была создана очередь для сессии: {session.id}."
+
+                if not error:
+                    state = await session_service.get_session_state(session.id)
+                    if not state or not state.requests:
+                        error = "У вас нет запросов в очередь. Перед тем как запускать распределение и сессию, дождитесь пока очередь заполнится."
+
+                if not error:
+                    requests = [state.get_request(user_id) for user_id in state.pending_user_ids]
+                    user_ids = [request.user_id for request in requests]
+                    users = await user_service.get_users_by_ids(user_ids)
+                    scored_users = []
+                    for user in users:
+                        score = ScoreCalculator.calculate_score(user, session.type)
+                        scored_users.append({"user": user, "score": score})
+                    logger.info(f"scored_users: {scored_users}")
+                    sorted_users = sorted(scored_users, key=lambda x: x["score"], reverse=True)
+                    logger.info(f"sorted_users: {sorted_users}")
+                    accepted_users = [user["user"] for user in sorted_users[: session.max_slots]]
+                    accepted_users_ids = [user.id for user in accepted_users]
+                    logger.info(f"accepted_users: {accepted_users}")
+                    slots = {user_id: idx + 1 for idx, user_id in enumerate(accepted_users_ids)}
+                    accepted = [
+                        (request.id, slots[request.user_id])
+                        for request in requests
+                        if request.user_id in slots
+                    ]
+                    rejected_ids = [
+                        request.id for request in requests if request.user_id not in slots
+                    ]
+                    await session_service.bulk_assign_slots(session.id, accepted, rejected_ids)
+
+            # Сообщения и голосовой канал создаются после закрытия скоупа БД
+            if error:
+                await self.response_to_user(ctx, error, ctx.channel)
+                return
 
-                session = await session_service.get_last_created_session_by_coach_id(
-                    ctx.author.id
+            participants = [guild.get_member(user_id) for user_id in accepted_users_ids]
+            for i, participant in enumerate(participants):
+                if participant is None:
+                    participants[i] = await self.bot.fetch_user(accepted_users_ids[i])
+            embed = SessionEmbed(participants, session.id, session.max_slots)
+            view = SessionView(session, self.service_factory)
+            session_message = await ctx.send(embed=embed, view=view)
+            channel = guild.get_channel(session.text_channel_id)
+            async for message in channel.history(limit=100):
+                if message.id == session.info_message_id:
+                    await message.delete()
+                    break
+
+            voice_channel = None
+            category = channel_registry.get_session_category(guild, session.id)
+            if category:
+                overwrites = RolesManager.for_guild(guild).get_session_channels_overwrites()
+                voice_channel = await guild.create_voice_channel(
+                    f"{coach.name}", category=category, overwrites=overwrites
                 )
-                if not session:
-                    await self.response_to_user(
-                        ctx,
-                        "У вас нет созданных сессий. Пожалуйста, сначала создайте сессию.",
-                        ctx.channel,
-                    )
-                    return
-
-                if ctx.channel.id != session.text_channel_id:
-                    await self.response_to_user(
-                        ctx,
-                        f"Вы не можете начать сессию в этом канале. Пожалуйста, используйте канал, где была создана очередь для сессии: {session.id}.",
-                        ctx.channel,
-                    )
-                    return
-
-                requests = await session_service.get_requests_by_session_id(session.id)
-                if not requests:
-                    await self.response_to_user(
-                        ctx,
-                        "У вас нет запросов в очередь. Перед тем как запускать распределение и сессию, дождитесь пока очередь заполнится.",
-                        ctx.channel,
-                    )
-                    return
-
-                requests = [
-                    request
-                    for request in requests
-                    if request.status == SessionRequestStatus.PENDING.value
-                ]
-                user_ids = [request.user_id for request in requests]
-                users = await user_service.get_users_by_ids(user_ids)
-                scored_users = []
-                for user in users:
-                    score = ScoreCalculator.calculate_score(user, session.type)
-                    scored_users.append({"user": user, "score": score})
-                logger.info(f"scored_users: {scored_users}")
-                sorted_users = sorted(scored_users, key=lambda x: x["score"], reverse=True)
-                accepted_users = sorted_users[: session.max_slots]
-                logger.info(f"sorted_users: {sorted_users}")
-                accepted_users = [user["user"] for user in sorted_users[: session.max_slots]]
-                accepted_users_ids = [user.id for user in accepted_users]
-                logger.info(f"accepted_users: {accepted_users}")
-                for request in requests:
-                    if request.user_id in accepted_users_ids:
-                        idx = accepted_users_ids.index(request.user_id)
-                        await session_service.update_request(
-                            request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=idx + 1
-                        )
-                    else:
-                        await session_service.update_request_status(
-                            request.id, SessionRequestStatus.REJECTED
-                        )
-
-                participants = [guild.get_member(user.id) for user in accepted_users]
-                for i, participant in enumerate(participants):
-                    if participant is None:
-                        participants[i] = await self.bot.fetch_user(accepted_users[i].id)
-                embed = SessionEmbed(participants, session.id, session.max_slots)
-                view = SessionView(session, session_service, discord_service, user_service)
-                session_message = await ctx.send(embed=embed, view=view)
-                channel = guild.get_channel(session.text_channel_id)
-                async for message in channel.history(limit=100):
-                    if message.id == session.info_message_id:
-                        await message.delete()
-                        break
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
                 await session_service.update_session(
                     session.id,
                     is_active=True,
                     session_message_id=session_message.id,
                     start_time=get_current_time(),
+                    voice_channel_id=voice_channel.id if voice_channel else None,
                 )
 
-                for category in guild.categories:
-                    if category.name == f"Сессия {session.id}":
-                        overwrites = RolesManager(guild).get_session_channels_overwrites()
-                        voice_channel = await guild.create_voice_channel(
-                            f"{coach.name}", category=category, overwrites=overwrites
-                        )
-                        await session_service.update_session(
-                            session.id, voice_channel_id=voice_channel.id
-                        )
-                text_channel = None
-                for channel in guild.text_channels:
-                    if channel.id == session.text_channel_id:
-                        text_channel = channel
-                    if "логи-сессий" in channel.name:
-                        await channel.send(
-                            f"Сессия {session.id} началась. Коуч: {ctx.author.mention}. Участники: {', '.join([participant.mention for participant in participants])}"
-                        )
+            text_channel = guild.get_channel(session.text_channel_id)
+            logs_channel = channel_registry.get_logs_channel(guild)
+            if logs_channel:
+                await logs_channel.send(
+                    f"Сессия {session.id} началась. Коуч: {ctx.author.mention}. Участники: {', '.join([participant.mention for participant in participants])}"
+                )
 
-                if not text_channel:
-                    await self.response_to_user(
-                        ctx,
-                        "Канал не найден. Пожалуйста, создайте канал и попробуйте снова.",
-                        ctx.channel,
-                    )
-                    return
-                await text_channel.send(
-                    f"Сессия {session.id} началась. Коуч: {ctx.author.mention}"
+            if not text_channel:
+                await self.response_to_user(
+                    ctx,
+                    "Канал не найден. Пожалуйста, создайте канал и попробуйте снова.",
+                    ctx.channel,
                 )
+                return
+            await text_channel.send(
+                f"Сессия {session.id} началась. Коуч: {ctx.author.mention}"
+            )
         except Exception as e:
             import traceback
 
@@ -330,57 +315,65 @@ class SessionCommands(Cog):
     @commands.has_any_role(Roles.MOD)
     async def delete_channels(self, ctx: commands.Context):
         logger.info(f"Deleting channels for {ctx.guild.name}")
-        async with get_service_factory(self.service_factory) as factory:
-            session_service = await factory.get_service("session")
-            try:
-                guild = ctx.guild
-                categories = guild.categories
-                for category in categories:
-                    if category.name.startswith("Сессия"):
-                        session_id = int(category.name.split(" ")[1])
-                        session = await session_service.get_session_by_id(session_id)
-                        if not session:
-                            continue
-                        if session.is_active:
-                            continue
-                        for channel in category.channels:
-                            await channel.delete()
-                        await category.delete()
-                await self.response_to_user(ctx, "Все каналы были удалены.", ctx.channel)
-            except Exception as e:
-                import traceback
+        try:
+            guild = ctx.guild
+            for session_id in list(channel_registry.session_categories):
+                category = channel_registry.get_session_category(guild, session_id)
+                if category is None:
+                    continue
+                # Категории активных сессий определяются по индексу каналов, без запросов к БД
+                if session_manager.warmed:
+                    states = [session_manager.get_by_channel(channel.id) for channel in category.channels]
+                    if any(state and state.session.is_active for state in states):
+                        continue
+                else:
+                    # Индекс неполон: статус сессии читается из БД
+                    async with get_service_factory(self.service_factory) as factory:
+                        session_service = await factory.get_service("session")
+                        session = await session_service.get_session_header(session_id)
+                    if session and session.is_active:
+                        continue
+                for channel in category.channels:
+                    await channel.delete()
+                await category.delete()
+            await self.response_to_user(ctx, "Все каналы были удалены.", ctx.channel)
+        except Exception as e:
+            import traceback
 
-                logger.error(f"Error deleting channels: {traceback.format_exc()}")
-                await self.response_to_user(
-                    ctx,
-                    "Произошла ошибка при удалении каналов. Пожалуйста, попробуйте позже.",
-                    ctx.channel,
-                )
+            logger.error(f"Error deleting channels: {traceback.format_exc()}")
+            await self.response_to_user(
+                ctx,
+                "Произошла ошибка при удалении каналов. Пожалуйста, попробуйте позже.",
+                ctx.channel,
+            )
 
     async def delete_session_channels(self, guild: Guild, session: Session):
-        categories = guild.categories
         if session.is_active:
             await guild.get_channel(session.text_channel_id).send(
                 "Каналы не могут быть удалены, пока сессия активна. Завершите сессию /end"
             )
-        for category in categories:
-            if category.name == f"Сессия {session.id}" and not session.is_active:
-                for channel in category.channels:
-                    await channel.delete()
-                await category.delete()
+            return
+        category = channel_registry.get_session_category(guild, session.id)
+        if category:
+            for channel in category.channels:
+                await channel.delete()
+            await category.delete()
 
     async def prepare_session_report(self, guild: Guild, session: Session):
         try:
-            session_service = await self.service_factory.get_service("session")
-            user_service = await self.service_factory.get_service("user")
-            session_data = await session_service.get_session_data(session.id)
-            coach_db = await user_service.get_user(session.coach_id)
+            # Отчет строится сразу после записей /end: реплика может еще не содержать
+            # их, поэтому чтение идет с основной БД
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                user_service = await factory.get_service("user")
+                session_data = await session_service.get_session_data(session.id)
+                coach_db = await user_service.get_user(session.coach_id)
+                users_ids = [request.user_id for request in session_data["requests"]] + [
+                    session.coach_id
+                ]
+                users = await user_service.get_users_by_ids(users_ids)
             session_data["coach_tier"] = coach_db.coach_tier
             coach = guild.get_member(session.coach_id)
-            users_ids = [request.user_id for request in session_data["requests"]] + [
-                session.coach_id
-            ]
-            users = await user_service.get_users_by_ids(users_ids)
             session_data["users"] = users
             participants = [
                 guild.get_member(request.user_id)
@@ -397,6 +390,24 @@ class SessionCommands(Cog):
             logger.error(f"Error preparing session report: {e.with_traceback()}")
             return None
 
+    async def close_session(
+        self,
+        session_service: SessionService,
+        state: SessionState,
+        end_time: datetime,
+    ) -> SessionHeader:
+        """
+        Завершает сессию в БД
+
+        Returns:
+            Заголовок завершенной сессии. Снимок state.session остается
+            активным, и по нему каналы сессии не были бы удалены
+        """
+        ended = await session_service.update_session(
+            state.session_id, is_active=False, end_time=end_time
+        )
+        return SessionHeader.from_model(ended)
+
     @commands.hybrid_command(name="end")
     @commands.has_any_role(Roles.MOD, Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3)
     async def end_session(self, ctx: commands.Context):
@@ -404,89 +415,96 @@ class SessionCommands(Cog):
             f"Attempting to end session for coach {ctx.author.name} in guild {ctx.guild.name}"
         )
         try:
+            error = None
+            end_time = get_current_time()
             async with get_service_factory(self.service_factory) as factory:
-                user_service = await factory.get_service("user")
                 session_service = await factory.get_service("session")
-            
-                active_sessions = await session_service.get_active_sessions_by_coach_id(
+
+                active_sessions = await session_service.get_active_session_states_by_coach_id(
                     ctx.author.id
                 )
-                logger.info(f"Active sessions: {active_sessions}")
+                logger.info(f"Active sessions: {[state.session_id for state in active_sessions]}")
 
                 if not active_sessions:
-                    await self.response_to_user(
-                        ctx, "У вас нет активных сессий для завершения.", ctx.channel
-                    )
-                    return
-                active_session = active_sessions[0]
-                if active_session.text_channel_id != ctx.channel.id:
-                    await self.response_to_user(
-                        ctx,
-                        "Вы не можете завершить сессию в этом канале. Пожалуйста, используйте канал, где была создана очередь для сессии.",
-                        ctx.channel,
+                    error = "У вас нет активных сессий для завершения."
+                elif active_sessions[0].session.text_channel_id != ctx.channel.id:
+                    error = "Вы не можете завершить сессию в этом канале. Пожалуйста, используйте канал, где была создана очередь для сессии."
+                else:
+                    active_session = await self.close_session(
+                        session_service, active_sessions[0], end_time
                     )
-                    return
-                text_channel = ctx.guild.get_channel(active_session.text_channel_id)
-                end_session_view = EndSessionConfirmationView(
-                    ctx.bot,
-                    active_session,
-                    self.service_factory,
-                    ctx.interaction if ctx.interaction else None,
-                )
 
-                message_content = "Все ли участники были разобраны во время сессии?"
-                if ctx.interaction:
-                    await ctx.interaction.response.send_message(
-                        message_content, view=end_session_view, ephemeral=True
-                    )
-                else:
-                    if text_channel:
-                        sent_message = await text_channel.send(
-                            message_content, view=end_session_view, ephemeral=True
-                        )
-                        end_session_view.message = sent_message
-                end_time = get_current_time()
-                await session_service.update_session(
-                    active_session.id, is_active=False, end_time=end_time
-                )
-                for ch in ctx.guild.text_channels:
-                    if "логи-сессий" in ch.name:
-                        duration = end_time - active_session.start_time
-                        duration = f"{duration}".split(".")[0]
-                        await ch.send(
-                            f"Сессия {active_session.id} завершена. Коуч: {ctx.author.mention}. Продолжительность: {duration}"
-                        )
-                for ch in ctx.guild.voice_channels:
-                    if active_session.voice_channel_id == ch.id:
-                        await ch.delete()
+            # Сообщения, ожидание и удаление каналов идут после закрытия скоупа БД:
+            # соединение не простаивает в транзакции SESSION_AUTO_DELETE_TIME секунд
+            if error:
+                await self.response_to_user(ctx, error, ctx.channel)
+                return
+            text_channel = ctx.guild.get_channel(active_session.text_channel_id)
+            end_session_view = EndSessionConfirmationView(
+                ctx.bot,
+                active_session,
+                self.service_factory,
+                ctx.interaction if ctx.interaction else None,
+            )
 
-                message_content = f"Сессия {active_session.id} завершена. Коуч: {ctx.author.mention}. Пожалуйста, оцените сессию."
-                review_session_view = ReviewSessionView(
-                    active_session, session_service, user_service
+            message_content = "Все ли участники были разобраны во время сессии?"
+            if ctx.interaction:
+                await ctx.interaction.response.send_message(
+                    message_content, view=end_session_view, ephemeral=True
                 )
-                await text_channel.send(message_content, view=review_session_view)
-
+            else:
+                if text_channel:
+                    sent_message = await text_channel.send(
+                        message_content, view=end_session_view, ephemeral=True
+                    )
+                    end_session_view.message = sent_message
+            # Незаписанные переходы и открытые активности фиксируются до подсчета времени
+            activity_tracker.close_session(active_session.id, datetime.now())
+            await self.bot.flush_activities()
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
                 session_activities = await session_service.calculate_session_activities(
                     active_session.id
                 )
-                logger.info(f"Session activities: {session_activities}")
+            logger.info(f"Session activities: {session_activities}")
+
+            logs_channel = channel_registry.get_logs_channel(ctx.guild)
+            if logs_channel:
+                duration = end_time - active_session.start_time
+                duration = f"{duration}".split(".")[0]
+                await logs_channel.send(
+                    f"Сессия {active_session.id} завершена. Коуч: {ctx.author.mention}. Продолжительность: {duration}"
+                )
+            voice_channel = (
+                ctx.guild.get_channel(active_session.voice_channel_id)
+                if active_session.voice_channel_id
+                else None
+            )
+            if voice_channel:
+                await voice_channel.delete()
 
-                for user_id, duration in session_activities.items():
-                    if duration > 300 and user_id != active_session.coach_id:
-                        try:
-                            await self.bot.get_user(user_id).send(
-                                message_content, view=review_session_view
-                            )
-                        except Exception as e:
-                            logger.error(f"Error sending review message: {e.with_traceback()}")
+            message_content = f"Сессия {active_session.id} завершена. Коуч: {ctx.author.mention}. Пожалуйста, оцените сессию."
+            review_session_view = ReviewSessionView(
+                active_session, self.service_factory
+            )
+            await text_channel.send(message_content, view=review_session_view)
 
-                await text_channel.send(f"Сессия {active_session.id} завершена. Канал автоматически удалится через 10 минут.")
-                await asyncio.sleep(self.SESSION_AUTO_DELETE_TIME)
-                await self.delete_session_channels(ctx.guild, active_session)
+            for user_id, duration in session_activities.items():
+                if duration > 300 and user_id != active_session.coach_id:
+                    try:
+                        await self.bot.get_user(user_id).send(
+                            message_content, view=review_session_view
+                        )
+                    except Exception as e:
+                        logger.error(f"Error sending review message: {e.with_traceback()}")
+
+            await text_channel.send(f"Сессия {active_session.id} завершена. Канал автоматически удалится через 10 минут.")
+            await asyncio.sleep(self.SESSION_AUTO_DELETE_TIME)
+            await self.delete_session_channels(ctx.guild, active_session)
 
-                report = await self.prepare_session_report(ctx.guild, active_session)
-                with open(report, "rb") as file:
-                    await ctx.bot.get_user(config.ADMIN_ID).send(file=discord.File(file))
+            report = await self.prepare_session_report(ctx.guild, active_session)
+            with open(report, "rb") as file:
+                await ctx.bot.get_user(config.ADMIN_ID).send(file=discord.File(file))
             # os.remove(report)
 
         except Exception as e:
@@ -509,66 +527,68 @@ class SessionCommands(Cog):
     @commands.has_any_role(Roles.SUB)
     async def join_queue(self, ctx: commands.Context, session_id: int):
         logger.info(f"Joining queue for {ctx.author.name}")
+        error = None
         async with get_service_factory(self.service_factory) as factory:
             session_service = await factory.get_service("session")
-            session = await session_service.get_session_by_id(session_id)
+            session = await session_service.get_session_header(session_id)
             if not session:
-                await self.response_to_user(ctx, f"Сессия {session_id} не найдена.", ctx.channel)
-                return
-            if session.coach_id == ctx.author.id:
-                await self.response_to_user(ctx, f"Вы не можете присоединиться к своей сессии.", ctx.channel)
-                return
-            if session and session.is_active:
-                await self.response_to_user(ctx, f"Сессия {session_id} уже началась. Используйте /join, если есть свободные слоты.", ctx.channel)
-                return
-            request = await session_service.get_request_by_user_id(session.id, ctx.author.id)
-            if not request:
-                request = await session_service.create_request(session_id, ctx.author.id)
+                error = f"Сессия {session_id} не найдена."
+            elif session.coach_id == ctx.author.id:
+                error = f"Вы не можете присоединиться к своей сессии."
+            elif session.is_active:
+                error = f"Сессия {session_id} уже началась. Используйте /join, если есть свободные слоты."
             else:
-                await self.response_to_user(ctx, f"Вы уже в очереди на сессию {session.id}", ctx.channel)
-                return
-            guild = ctx.guild
-            coach = await guild.fetch_member(session.coach_id)
-            channel = await guild.fetch_channel(session.text_channel_id)
-            queue_message = await channel.fetch_message(session.info_message_id)
-            queue_embed = SessionQueueEmbed(coach, session.id)
-            members = await session_service.get_queue_participants(guild, session.id)
-            queue_embed.update_queue(members)
-            await queue_message.edit(embed=queue_embed)
-            await self.response_to_user(ctx, f"Вы успешно присоединились к очереди на сессию {session.id}", ctx.channel)
+                request, created = await session_service.create_request(session_id, ctx.author.id, idempotent=True)
+                if not created:
+                    error = f"Вы уже в очереди на сессию {session.id}"
+                else:
+                    queue_user_ids = await session_service.get_queue_user_ids(session.id)
+
+        # Обращения к Discord выполняются после закрытия скоупа БД
+        if error:
+            await self.response_to_user(ctx, error, ctx.channel)
+            return
+        await self.refresh_queue_message(ctx.guild, session, queue_user_ids)
+        await self.response_to_user(ctx, f"Вы успешно присоединились к очереди на сессию {session.id}", ctx.channel)
 
     @commands.hybrid_command(name="leave")
     @commands.has_any_role(Roles.SUB)
     async def leave_queue(self, ctx: commands.Context, session_id: int):
         logger.info(f"Leaving queue for {ctx.author.name}")
+        error = None
         async with get_service_factory(self.service_factory) as factory:
             session_service = await factory.get_service("session")
-            session = await session_service.get_session_by_id(session_id)
+            session = await session_service.get_session_header(session_id)
             if not session:
-                await self.response_to_user(ctx, f"Сессия {session_id} не найдена.", ctx.channel)
-                return
-            if session.coach_id == ctx.author.id:
-                await self.response_to_user(ctx, f"Вы не можете покинуть очередь на свою сессию.", ctx.channel)
-                return
-            if session.is_active:
-                await self.response_to_user(ctx, f"Сессия {session_id} уже началась, вы не можете покинуть очередь.", ctx.channel)
-                return
-            request = await session_service.get_request_by_user_id(session.id, ctx.author.id)
-            if not request:
-                await self.response_to_user(ctx, f"Вы не в очереди на сессию {session.id}", ctx.channel)
-                return
+                error = f"Сессия {session_id} не найдена."
+            elif session.coach_id == ctx.author.id:
+                error = f"Вы не можете покинуть очередь на свою сессию."
+            elif session.is_active:
+                error = f"Сессия {session_id} уже началась, вы не можете покинуть очередь."
+            else:
+                request = await session_service.get_request_by_user_id(session.id, ctx.author.id)
+                if not request:
+                    error = f"Вы не в очереди на сессию {session.id}"
+                else:
+                    if request.status == SessionRequestStatus.PENDING.value:
+                        await session_service.delete_request(request.id)
+                    queue_user_ids = await session_service.get_queue_user_ids(session.id)
 
-            if request.status == SessionRequestStatus.PENDING.value:
-                await session_service.delete_request(request.id)
-            coach = await ctx.guild.fetch_member(session.coach_id)
-            channel = await ctx.guild.fetch_channel(session.text_channel_id)
-            queue_message = await channel.fetch_message(session.info_message_id)
-            queue_embed = SessionQueueEmbed(coach, session.id)
-            members = await session_service.get_queue_participants(ctx.guild, session.id)
-            queue_embed.update_queue(members)
-            await queue_message.edit(embed=queue_embed)
+        # Обращения к Discord выполняются после закрытия скоупа БД
+        if error:
+            await self.response_to_user(ctx, error, ctx.channel)
+            return
+        await self.refresh_queue_message(ctx.guild, session, queue_user_ids)
+        await self.response_to_user(ctx, f"Вы успешно покинули очередь на сессию {session.id}", ctx.channel)
 
-            await self.response_to_user(ctx, f"Вы успешно покинули очередь на сессию {session.id}", ctx.channel)
+    async def refresh_queue_message(self, guild: Guild, session: SessionHeader, queue_user_ids: List[int]):
+        """Обновляет embed очереди в сообщении сессии"""
+        coach = guild.get_member(session.coach_id) or await guild.fetch_member(session.coach_id)
+        channel = await guild.fetch_channel(session.text_channel_id)
+        queue_message = await channel.fetch_message(session.info_message_id)
+        queue_embed = SessionQueueEmbed(coach, session.id)
+        queue_embed.update_queue(await SessionService.fetch_members(guild, queue_user_ids))
+        await queue_message.edit(embed=queue_embed)
 
     @commands.hybrid_command(name="join")
     @commands.has_any_role(Roles.SUB)
@@ -576,7 +596,7 @@ class SessionCommands(Cog):
         logger.info(f"Joining session {session_id}")
         async with get_service_factory(self.service_factory) as factory:
             session_service = await factory.get_service("session")
-            session = await session_service.get_session_by_id(session_id)
+            session = await session_service.get_session_header(session_id)
             if not session:
                 await self.response_to_user(ctx, f"Сессия {session_id} не найдена.", ctx.channel)
                 return
@@ -587,22 +607,16 @@ class SessionCommands(Cog):
                 await self.response_to_user(ctx, f"Сессия {session_id} еще не началась или уже завершена.", ctx.channel)
                 return
 
-            accepted_requests = await session_service.get_accepted_requests(session.id)
-            if len(accepted_requests) >= session.max_slots:
-                await self.response_to_user(ctx, "Все слоты заняты.", ctx.channel)
-                return
-
-            request = await session_service.get_request_by_user_id(session.id, ctx.author.id)
-            if request and request.status == SessionRequestStatus.ACCEPTED.value:
+            status, _ = await session_service.claim_slot(session.id, ctx.author.id)
+            if status == SlotClaimStatus.ALREADY_JOINED:
                 await self.response_to_user(ctx, f"Вы уже присоединились к сессии {session.id}", ctx.channel)
                 return
+            if status == SlotClaimStatus.FULL:
+                await self.response_to_user(ctx, "Все слоты заняты.", ctx.channel)
+                return
 
-            if not request:
-                request = await session_service.create_request(session.id, ctx.author.id)
-            await session_service.update_request(request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=len(accepted_requests) + 1)
-
-            requests = await session_service.get_accepted_requests(session.id)
-            participants = [ctx.guild.get_member(request.user_id) for request in requests]
+            state = await session_service.get_session_state(session.id)
+            participants = [ctx.guild.get_member(user_id) for user_id in state.accepted_user_ids] if state else []
             embed = SessionEmbed(participants, session.id, session.max_slots)
             channel = await ctx.guild.fetch_channel(session.text_channel_id)
             message = await channel.fetch_message(session.session_message_id)
@@ -628,15 +642,16 @@ class SessionCommands(Cog):
             if not request or request.status != SessionRequestStatus.ACCEPTED.value:
                 return False, "Пользователь не участвует в сессии"
             
-            # Исключаем пользователя из сессии
-            await session_service.update_request(
-                request.id, 
-                status=SessionRequestStatus.REJECTED.value, 
-                slot_number=None
-            )
-            
-            # Пересчитываем номера слотов для оставшихся участников
-            await self._reorder_session_slots(session_service, session.id)
+            async with session_service.transaction():
+                # Исключаем пользователя из сессии
+                await session_service.update_request(
+                    request.id, 
+                    status=SessionRequestStatus.REJECTED.value, 
+                    slot_number=None
+                )
+                
+                # Пересчитываем номера слотов для оставшихся участников
+                await self._reorder_session_slots(session_service, session.id)
             
             # Обновляем embed с участниками
             await self._update_session_embed(session_service, guild, session)
@@ -656,8 +671,8 @@ class SessionCommands(Cog):
 
     async def _update_session_embed(self, session_service, guild: Guild, session: Session):
         """Приватный метод для обновления embed сессии."""
-        accepted_requests = await session_service.get_accepted_requests(session.id)
-        participants = [guild.get_member(req.user_id) for req in accepted_requests]
+        state = await session_service.get_session_state(session.id)
+        participants = [guild.get_member(user_id) for user_id in state.accepted_user_ids] if state else []
         embed = SessionEmbed(participants, session.id, session.max_slots)
         
         channel = await guild.fetch_channel(session.text_channel_id)
@@ -672,7 +687,7 @@ class SessionCommands(Cog):
             async with get_service_factory(self.service_factory) as factory:
                 session_service = await factory.get_service("session")
                 
-                session = await session_service.get_session_by_id(session_id)
+                session = await session_service.get_session_header(session_id)
                 if not session:
                     await self.response_to_user(ctx, f"Сессия {session_id} не найдена.", ctx.channel)
                     return
@@ -703,20 +718,9 @@ class SessionCommands(Cog):
     @commands.has_any_role(Roles.MOD, Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3)
     async def kick_from_session(self, ctx: commands.Context, user: Member):
         try:
-            # Проверяем, что команда выполняется в правильном канале
-            if not ctx.channel.category:
-                await self.response_to_user(
-                    ctx, 
-                    "Эта команда должна выполняться в канале сессии.", 
-                    ctx.channel
-                )
-                return
-            
-            # Регулярное выражение для проверки названия категории и извлечения ID сессии
-            pattern = r"^Сессия (\d+)$"
-            match = re.match(pattern, ctx.channel.category.name)
-            
-            if not match:
+            # Проверяем, что команда выполняется в канале открытой сессии
+            session_id = await self.bot.get_channel_session_id(ctx.channel)
+            if session_id is None:
                 await self.response_to_user(
                     ctx, 
                     "Эта команда может быть выполнена только в канале активной сессии.", 
@@ -724,13 +728,12 @@ class SessionCommands(Cog):
                 )
                 return
             
-            session_id = int(match.group(1))
             logger.info(f"Kicking user {user.mention} from session {session_id}")
             
             async with get_service_factory(self.service_factory) as factory:
                 session_service = await factory.get_service("session")
                 
-                session = await session_service.get_session_by_id(session_id)
+                session = await session_service.get_session_header(session_id)
                 if not session:
                     await self.response_to_user(
                         ctx, 
@@ -775,7 +778,7 @@ class SessionCommands(Cog):
         logger.info(f"Force ending session {session_id}")
         async with get_service_factory(self.service_factory) as factory:
             session_service = await factory.get_service("session")
-            session = await session_service.get_session_by_id(session_id)
+            session = await session_service.get_session_by_id(session_id, load=SessionLoad.HEADER)
             if session.coach_id != ctx.author.id:
                 await self.response_to_user(
                     ctx,
@@ -792,14 +795,16 @@ class SessionCommands(Cog):
         logger.info(f"Sending report for session {session_id}")
         if ctx.author.id not in [config.ADMIN_ID, config.DEVELOPER_ID]:
             return
-        async with get_service_factory(self.service_factory) as factory:
+        async with get_service_factory(self.service_factory, read_only=True) as factory:
             user_service = await factory.get_service("user")
             session_service = await factory.get_service("session")
             if session_id:
-                session = await session_service.get_session_by_id(session_id)
+                session = await session_service.get_session_by_id(session_id, load=SessionLoad.HEADER)
             else:
-                sessions = await session_service.get_all_sessions()
-                session = sessions[-1]
+                session = await session_service.get_latest_session()
+                if not session:
+                    await ctx.send("Сессии не найдены.")
+                    return
             session_data = await session_service.get_session_data(session.id)
             requests = session_data["requests"]
             try:
@@ -856,7 +861,7 @@ class SessionCommands(Cog):
             async with get_service_factory(self.service_factory) as factory:
                 session_service = await factory.get_service("session")
                 user_service = await factory.get_service("user")
-                session = await session_service.get_session_by_id(session_id)
+                session = await session_service.get_session_by_id(session_id, load=SessionLoad.HEADER)
                 if not session:
                     await self.response_to_user(ctx, f"Сессия {session_id} не найдена.", ctx.channel)
                     return
@@ -866,7 +871,7 @@ class SessionCommands(Cog):
                     return
                 logger.info(f"Activities: {activities}")
                 review_session_view = ReviewSessionView(
-                    session, session_service, user_service
+                    session, self.service_factory
                 )
                 coach = await ctx.guild.fetch_member(session.coach_id)
                 message_content = f"Сессия {session.id} завершена. Коуч: {coach.mention}. Пожалуйста, оцените сессию."
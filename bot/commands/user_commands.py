@@ -9,7 +9,7 @@ class UserCommands(Cog):
 
     @commands.hybrid_command(name="stats")
     async def stats(self, ctx: commands.Context):
-        async with get_service_factory(self.service_factory) as factory:
+        async with get_service_factory(self.service_factory, read_only=True) as factory:
             user_service = await factory.get_service("user")
             user = await user_service.get_user(ctx.author.id)
             if not user:
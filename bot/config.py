@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -6,6 +8,16 @@ class Settings(BaseSettings):
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str
     DATABASE_URL: str
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 3600
+    DB_POOL_PRE_PING: bool = True
+    # Движок для отчетов и статистики: реплика или, если не задано, отдельный пул к DATABASE_URL
+    DATABASE_READ_URL: Optional[str] = None
+    READ_DB_POOL_SIZE: int = 5
+    READ_DB_MAX_OVERFLOW: int = 5
+    READ_DB_POOL_TIMEOUT: int = 30
     ADMIN_ID: int
     DEVELOPER_ID: int
     DEBUG: bool = False
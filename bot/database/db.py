@@ -6,33 +6,79 @@ from models.user import User
 from datetime import datetime, timedelta
 from sqlalchemy import select, insert
 from contextlib import asynccontextmanager
+from database.pool_stats import InstrumentedAsyncPool
+from database.query_counter import instrument_engine
+from repositories.base_repo import check_upsert_support
 
 # Настройки пула соединений
 engine = create_async_engine(
     config.DATABASE_URL, 
     echo=config.DEBUG,
-    pool_size=10,          # Размер пула соединений
-    max_overflow=20,       # Максимальное количество дополнительных соединений
-    pool_timeout=30,       # Таймаут ожидания соединения
-    pool_recycle=3600,     # Переиспользование соединений каждый час
-    pool_pre_ping=True     # Проверка соединения перед использованием
+    poolclass=InstrumentedAsyncPool,          # Пул со статистикой выдачи соединений
+    pool_size=config.DB_POOL_SIZE,            # Размер пула соединений
+    max_overflow=config.DB_MAX_OVERFLOW,      # Максимальное количество дополнительных соединений
+    pool_timeout=config.DB_POOL_TIMEOUT,      # Таймаут ожидания соединения
+    pool_recycle=config.DB_POOL_RECYCLE,      # Переиспользование соединений
+    pool_pre_ping=config.DB_POOL_PRE_PING     # Проверка соединения перед использованием
 )
 
+# Upsert репозиториев требуют ON CONFLICT: неподдерживаемая БД отклоняется при запуске
+check_upsert_support(engine.dialect.name)
+
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Движок для отчетов и статистики: реплика (DATABASE_READ_URL) или отдельный пул
+# к основной БД, чтобы тяжелые выборки не занимали соединения обработчиков кнопок
+read_engine = create_async_engine(
+    config.DATABASE_READ_URL or config.DATABASE_URL,
+    echo=config.DEBUG,
+    poolclass=InstrumentedAsyncPool,
+    pool_size=config.READ_DB_POOL_SIZE,
+    max_overflow=config.READ_DB_MAX_OVERFLOW,
+    pool_timeout=config.READ_DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=config.DB_POOL_PRE_PING
+)
+if read_engine.dialect.name == "postgresql":
+    # Транзакции только для чтения: случайная запись завершится ошибкой
+    read_engine = read_engine.execution_options(postgresql_readonly=True)
+
+async_read_session = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+# Учет запросов по командам, кнопкам и обработчикам событий
+instrument_engine(engine)
+instrument_engine(read_engine)
+
 @asynccontextmanager
 async def get_db_session():
-    """Контекстный менеджер для безопасной работы с сессией БД"""
+    """
+    Контекстный менеджер для безопасной работы с сессией БД
+
+    Соединение берется из пула при первом запросе: если в блоке не было
+    запросов, выход из него не обращается к пулу.
+    """
     async with async_session() as session:
         try:
             yield session
-            await session.commit()
+            if session.in_transaction():
+                await session.commit()
         except Exception:
             await session.rollback()
             raise
         finally:
             await session.close()
 
+@asynccontextmanager
+async def get_read_session():
+    """Контекстный менеджер для сессии только для чтения (отчеты, статистика)"""
+    async with async_read_session() as session:
+        try:
+            yield session
+        finally:
+            # Изменения через сессию чтения не фиксируются: close откатывает транзакцию,
+            # не сбрасывая уже загруженные атрибуты объектов
+            await session.close()
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,87 @@
+import time
+from bisect import bisect_left
+from typing import Any, Dict
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Верхние границы корзин гистограммы ожидания соединения, мс
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class PoolStats:
+    """Счетчики выдачи соединений пула и гистограмма времени ожидания"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def observe_checkout(self, wait: float):
+        """
+        Учитывает одну выдачу соединения
+
+        Args:
+            wait: Время получения соединения в секундах
+        """
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.wait_histogram[bisect_left(WAIT_BUCKETS_MS, wait * 1000)] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={bound}ms" for bound in WAIT_BUCKETS_MS] + [f">{WAIT_BUCKETS_MS[-1]}ms"]
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": self.total_wait / self.checkouts * 1000 if self.checkouts else 0.0,
+            "wait_max_ms": self.max_wait * 1000,
+            "wait_histogram": dict(zip(labels, self.wait_histogram)),
+        }
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool, замеряющий время получения соединения
+
+    Время включает ожидание свободного соединения, открытие нового
+    и pre-ping, то есть всю задержку, которую видит обработчик.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.observe_checkout(time.perf_counter() - started)
+
+
+def get_pool_stats(engine: AsyncEngine) -> Dict[str, Any]:
+    """
+    Текущее состояние пула движка и накопленная статистика выдачи соединений
+
+    Args:
+        engine: Асинхронный движок SQLAlchemy
+    """
+    pool = engine.pool
+    result = {"pool": type(pool).__name__}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        result.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, InstrumentedAsyncPool):
+        result.update(pool.stats.to_dict())
+    return result
@@ -0,0 +1,166 @@
+"""
+Счетчик SQL-запросов на логическую операцию (команда, кнопка, обработчик события)
+
+Движки регистрируются через instrument_engine. Операция открывается контекстом
+track_operation или декоратором track_queries. Запросы, выполненные внутри нее,
+учитываются в QueryStats, и по завершении в лог пишется сводка.
+Повторяющиеся одинаковые запросы помечаются как возможный N+1.
+
+В тестах:
+    with track_operation("start") as stats:
+        ...
+    assert stats.statements <= 10
+"""
+import functools
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from logger import logger
+
+# Сколько раз одинаковый запрос должен выполниться за операцию, чтобы считаться N+1
+REPEATED_STATEMENT_THRESHOLD = 5
+
+_current_operation: ContextVar[Optional["QueryStats"]] = ContextVar(
+    "current_query_operation", default=None
+)
+
+
+class QueryStats:
+    """Статистика запросов одной операции"""
+
+    def __init__(self, name: str, parent: Optional["QueryStats"] = None):
+        self.name = name
+        self.parent = parent
+        self.statements = 0
+        # Строки, измененные INSERT/UPDATE/DELETE (cursor.rowcount). Для SELECT
+        # rowcount драйвера не отражает число строк выборки и не учитывается
+        self.affected_rows = 0
+        self.total_time = 0.0
+        self.statement_counts: Counter = Counter()
+
+    def record(self, statement: str, duration: float, affected_rows: int = 0):
+        self.statements += 1
+        self.total_time += duration
+        self.affected_rows += max(affected_rows, 0)
+        self.statement_counts[statement] += 1
+
+    def repeated_statements(
+        self, threshold: int = REPEATED_STATEMENT_THRESHOLD
+    ) -> List[Tuple[str, int]]:
+        """Запросы, выполненные не меньше threshold раз (кандидаты в N+1)"""
+        return [
+            (statement, count)
+            for statement, count in self.statement_counts.most_common()
+            if count >= threshold
+        ]
+
+    def summary(self) -> str:
+        return (
+            f"{self.name}: {self.statements} statements, "
+            f"{self.total_time * 1000:.1f} ms, {self.affected_rows} affected rows"
+        )
+
+
+def current_operation() -> Optional[QueryStats]:
+    """Текущая операция или None, если запросы сейчас не отслеживаются"""
+    return _current_operation.get()
+
+
+@contextmanager
+def track_operation(
+    name: str, repeat_threshold: int = REPEATED_STATEMENT_THRESHOLD
+) -> Iterator[QueryStats]:
+    """
+    Учитывает запросы, выполненные внутри блока
+
+    Вложенные операции учитываются и в своей статистике, и в статистике внешних.
+
+    Args:
+        name: Имя операции для лога
+        repeat_threshold: Порог повторов одинакового запроса для предупреждения о N+1
+    """
+    stats = QueryStats(name, parent=_current_operation.get())
+    token = _current_operation.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_operation.reset(token)
+        log_operation(stats, repeat_threshold)
+
+
+def log_operation(stats: QueryStats, repeat_threshold: int = REPEATED_STATEMENT_THRESHOLD):
+    if not stats.statements:
+        return
+    logger.info(f"[queries] {stats.summary()}")
+    for statement, count in stats.repeated_statements(repeat_threshold):
+        logger.warning(
+            f"[queries] {stats.name}: possible N+1, statement executed {count} times: "
+            f"{' '.join(statement.split())[:300]}"
+        )
+
+
+def track_queries(name: Optional[str] = None):
+    """
+    Декоратор асинхронной функции, учитывающий ее запросы как одну операцию
+
+    Без имени для элементов UI используется custom_id (button:<custom_id>),
+    иначе имя функции.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            operation = name
+            if operation is None:
+                custom_id = getattr(args[0], "custom_id", None) if args else None
+                operation = f"button:{custom_id}" if custom_id else func.__qualname__
+            with track_operation(operation):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_operation(name: str):
+    """Открывает операцию без контекстного менеджера, возвращает токен для finish_operation"""
+    stats = QueryStats(name, parent=_current_operation.get())
+    return _current_operation.set(stats)
+
+
+def finish_operation(token) -> QueryStats:
+    """Закрывает операцию, открытую start_operation, и пишет сводку в лог"""
+    stats = token.var.get()
+    token.var.reset(token)
+    log_operation(stats)
+    return stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_operation.get() is not None:
+        context._query_counter_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_operation.get()
+    started = getattr(context, "_query_counter_started", None)
+    if stats is None or started is None:
+        return
+    duration = time.perf_counter() - started
+    is_dml = context.isinsert or context.isupdate or context.isdelete
+    affected_rows = cursor.rowcount if is_dml and cursor.rowcount is not None else 0
+    while stats is not None:
+        stats.record(statement, duration, affected_rows)
+        stats = stats.parent
+
+
+def instrument_engine(engine: AsyncEngine | Engine):
+    """Подключает счетчик запросов к движку"""
+    sync_engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+    if not event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
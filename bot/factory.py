@@ -2,25 +2,42 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from discord.ext import commands
 from repositories import *
 from services import *
-from database.db import get_db_session
+from database.db import get_db_session, get_read_session
 from contextlib import asynccontextmanager
 from logger import logger
 
 class ServiceFactory:
-    """Фабрика для создания сервисов"""
+    """
+    Фабрика для создания сервисов
 
-    def __init__(self):
+    Фабрика бота (корневая) хранит только сервисы без БД и передается в команды,
+    view и кнопки. Сервисы с БД берутся из области, открытой get_service_factory
+    на время одной команды, нажатия кнопки или события: сессия БД создается при
+    первом обращении и закрывается при выходе из области.
+    """
+
+    def __init__(self, read_only: bool = False, scoped: bool = False):
+        """
+        Args:
+            read_only: Использовать движок только для чтения (отчеты, статистика)
+            scoped: Фабрика области get_service_factory, которой разрешена работа с БД
+        """
         self._services = {}
         self._session = None
         self._session_context = None
+        self.read_only = read_only
+        self.scoped = scoped
 
     def init_discord_service(self, bot: commands.Bot):
         self._services['discord'] = DiscordService(bot)
 
     async def _ensure_session(self):
         """Обеспечивает наличие активной сессии БД"""
+        if not self.scoped:
+            # Сессия корневой фабрики жила бы вечно и делилась между всеми взаимодействиями
+            raise RuntimeError("Database services are only available inside get_service_factory()")
         if self._session is None:
-            self._session_context = get_db_session()
+            self._session_context = get_read_session() if self.read_only else get_db_session()
             self._session = await self._session_context.__aenter__()
 
     async def get_service(self, service_name: str):
@@ -32,7 +49,8 @@ class ServiceFactory:
         if service_name == 'user':
             if 'user' not in self._services:
                 user_repo = UserRepository(self._session)
-                self._services['user'] = UserService(user_repo)
+                # Строки реплики не попадают в общий кэш пользователей
+                self._services['user'] = UserService(user_repo, fill_cache=not self.read_only)
             return self._services['user']
         elif service_name == 'session':
             if 'session' not in self._services:
@@ -42,6 +60,18 @@ class ServiceFactory:
 
         raise ValueError(f"Service {service_name} not found")
 
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Unit of work для сервисов фабрики: записи репозиториев внутри блока
+        фиксируются одним commit при выходе, при ошибке откатываются
+        """
+        if self.read_only:
+            raise RuntimeError("Transactions are not available in a read-only service factory")
+        await self._ensure_session()
+        async with unit_of_work(self._session):
+            yield self
+
     async def close(self):
         """Закрывает сессию БД"""
         if self._session_context and self._session:
@@ -58,14 +88,18 @@ class ServiceFactory:
                         del self._services[key]
 
 @asynccontextmanager
-async def get_service_factory(existing_factory: ServiceFactory = None):
-    """Контекстный менеджер для безопасной работы с ServiceFactory"""
+async def get_service_factory(existing_factory: ServiceFactory = None, read_only: bool = False):
+    """
+    Контекстный менеджер для безопасной работы с ServiceFactory
+    
+    Args:
+        existing_factory: Фабрика, из которой переиспользуются сервисы без БД
+        read_only: Сессия на движке только для чтения (отчеты, статистика)
+    """
+    factory = ServiceFactory(read_only=read_only, scoped=True)
     if existing_factory:
         # Используем существующую фабрику, но создаем новую сессию
-        factory = ServiceFactory()
         factory._services['discord'] = existing_factory._services.get('discord')
-    else:
-        factory = ServiceFactory()
 
     try:
         yield factory
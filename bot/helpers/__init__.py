@@ -1,4 +1,8 @@
 from .score_calculator import ScoreCalculator
 from .roles_manager import RolesManager, Roles
+from .session_manager import SessionHeader, SessionManager, SessionState, session_manager
+from .user_cache import UserCache, UserSnapshot, user_cache
+from .activity_tracker import ActivityTracker, activity_tracker
+from .channel_registry import ChannelRegistry, channel_registry
 
-__all__ = ["ScoreCalculator", "RolesManager"]
\ No newline at end of file
+__all__ = ["ScoreCalculator", "RolesManager", "SessionHeader", "SessionManager", "SessionState", "session_manager", "UserCache", "UserSnapshot", "user_cache", "ActivityTracker", "activity_tracker", "ChannelRegistry", "channel_registry"]
\ No newline at end of file
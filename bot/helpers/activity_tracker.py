@@ -0,0 +1,126 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# Интервал сброса буфера переходов в БД, секунды
+ACTIVITY_FLUSH_INTERVAL = 5
+# Интервал отметки открытых активностей в БД (leave_time), секунды
+ACTIVITY_HEARTBEAT_INTERVAL = 60
+
+ActivityKey = Tuple[int, int]
+
+
+class ActivityBatch:
+    """
+    Изменения user_session_activity, накопленные между сбросами
+
+    closes - завершение активностей, уже записанных в БД (session_id, user_id,
+    leave_time, total_duration_seconds); rows - новые строки, открытые и
+    завершенные внутри пачки. Завершения применяются раньше вставок.
+    """
+
+    def __init__(self):
+        self.closes: List[Dict[str, Any]] = []
+        self.rows: List[Dict[str, Any]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.closes or self.rows)
+
+
+class ActivityTracker:
+    """
+    Открытые активности пользователей в голосовых каналах сессий
+
+    Входы и выходы учитываются в памяти по ключу (session_id, user_id)
+    и копятся в буфере, который сбрасывается в БД одной пачкой
+    (BoostyQueueBot.flush_activities). Повторный вход без выхода
+    и выход без входа игнорируются.
+    """
+
+    def __init__(self):
+        # (session_id, user_id) -> время входа
+        self.open: Dict[ActivityKey, datetime] = {}
+        # (тип, session_id, user_id, время входа, время выхода)
+        self._events: List[Tuple[str, int, int, datetime, Optional[datetime]]] = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._events)
+
+    def is_open(self, session_id: int, user_id: int) -> bool:
+        return (session_id, user_id) in self.open
+
+    def join(self, session_id: int, user_id: int, at: datetime) -> bool:
+        key = (session_id, user_id)
+        if key in self.open:
+            return False
+        self.open[key] = at
+        self._events.append(("join", session_id, user_id, at, None))
+        return True
+
+    def leave(self, session_id: int, user_id: int, at: datetime) -> bool:
+        join_time = self.open.pop((session_id, user_id), None)
+        if join_time is None:
+            return False
+        self._events.append(("leave", session_id, user_id, join_time, at))
+        return True
+
+    def close_session(self, session_id: int, at: datetime) -> int:
+        """Завершает все открытые активности сессии"""
+        user_ids = [user_id for (sid, user_id) in self.open if sid == session_id]
+        for user_id in user_ids:
+            self.leave(session_id, user_id, at)
+        return len(user_ids)
+
+    def close_all(self, at: datetime) -> int:
+        """Завершает все открытые активности, например при остановке бота"""
+        keys = list(self.open)
+        for session_id, user_id in keys:
+            self.leave(session_id, user_id, at)
+        return len(keys)
+
+    def drain(self) -> Tuple[ActivityBatch, list]:
+        """
+        Забирает буфер и сворачивает его в пачку изменений
+
+        Returns:
+            (пачка, исходные события для requeue при ошибке записи)
+        """
+        events, self._events = self._events, []
+        batch = ActivityBatch()
+        # Строки, открытые в этой пачке и еще не вставленные
+        new_rows: Dict[ActivityKey, Dict[str, Any]] = {}
+        for kind, session_id, user_id, join_time, leave_time in events:
+            key = (session_id, user_id)
+            if kind == "join":
+                row = {
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "join_time": join_time,
+                    "is_active": True,
+                }
+                new_rows[key] = row
+                batch.rows.append(row)
+                continue
+            duration = int((leave_time - join_time).total_seconds())
+            row = new_rows.pop(key, None)
+            if row is not None:
+                row.update(leave_time=leave_time, total_duration_seconds=duration, is_active=False)
+            else:
+                batch.closes.append({
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "leave_time": leave_time,
+                    "total_duration_seconds": duration,
+                })
+        return batch, events
+
+    def requeue(self, events: list):
+        """Возвращает в начало буфера события несостоявшегося сброса"""
+        self._events[:0] = events
+
+    def clear(self):
+        self.open.clear()
+        self._events.clear()
+
+
+activity_tracker = ActivityTracker()
@@ -0,0 +1,72 @@
+import re
+from typing import Dict, Optional
+
+import discord
+
+SESSION_LOGS_CHANNEL_MARK = "логи-сессий"
+SESSION_START_CHANNEL_MARK = "запуск-сессии"
+SESSION_CATEGORY_PATTERN = re.compile(r"^Сессия (\d+)$")
+
+
+class ChannelRegistry:
+    """
+    Служебные каналы сервера по id: логи, запуск сессий и категории сессий
+
+    Заполняется одним проходом по каналам в on_ready и обновляется
+    событиями создания, удаления и изменения каналов, поэтому команды
+    не перебирают guild.text_channels и guild.categories.
+    """
+
+    def __init__(self):
+        self.logs_channel_id: Optional[int] = None
+        self.start_channel_id: Optional[int] = None
+        # session_id -> id категории "Сессия {session_id}"
+        self.session_categories: Dict[int, int] = {}
+
+    def populate(self, guild: discord.Guild):
+        self.clear()
+        for channel in guild.channels:
+            self.register(channel)
+
+    def register(self, channel: discord.abc.GuildChannel):
+        if isinstance(channel, discord.CategoryChannel):
+            match = SESSION_CATEGORY_PATTERN.match(channel.name)
+            if match:
+                self.session_categories[int(match.group(1))] = channel.id
+        elif isinstance(channel, discord.TextChannel):
+            if SESSION_LOGS_CHANNEL_MARK in channel.name:
+                self.logs_channel_id = channel.id
+            elif SESSION_START_CHANNEL_MARK in channel.name:
+                self.start_channel_id = channel.id
+
+    def unregister(self, channel: discord.abc.GuildChannel):
+        if channel.id == self.logs_channel_id:
+            self.logs_channel_id = None
+        if channel.id == self.start_channel_id:
+            self.start_channel_id = None
+        for session_id, category_id in list(self.session_categories.items()):
+            if category_id == channel.id:
+                del self.session_categories[session_id]
+
+    def update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        """Переименованный канал перерегистрируется под новым именем"""
+        self.unregister(before)
+        self.register(after)
+
+    def get_logs_channel(self, guild: discord.Guild) -> Optional[discord.TextChannel]:
+        return guild.get_channel(self.logs_channel_id) if self.logs_channel_id else None
+
+    def get_start_channel(self, guild: discord.Guild) -> Optional[discord.TextChannel]:
+        return guild.get_channel(self.start_channel_id) if self.start_channel_id else None
+
+    def get_session_category(self, guild: discord.Guild, session_id: int) -> Optional[discord.CategoryChannel]:
+        category_id = self.session_categories.get(session_id)
+        return guild.get_channel(category_id) if category_id else None
+
+    def clear(self):
+        self.logs_channel_id = None
+        self.start_channel_id = None
+        self.session_categories.clear()
+
+
+channel_registry = ChannelRegistry()
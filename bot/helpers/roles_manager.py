@@ -1,3 +1,5 @@
+from typing import Dict, Optional
+
 import discord
 
 class Roles:
@@ -8,8 +10,33 @@ class Roles:
     COACH_T3 = "Coach T3"
 
 class RolesManager:
+    """
+    Роли сессий сервера и шаблоны прав каналов
+
+    Экземпляр на сервер переиспользуется процессом (for_guild): роли
+    находятся одним проходом по guild.roles, шаблоны прав строятся
+    при первом обращении. Кэш сбрасывается событиями изменения ролей.
+    """
+
+    _instances: Dict[int, "RolesManager"] = {}
+
+    @classmethod
+    def for_guild(cls, guild: discord.Guild) -> "RolesManager":
+        manager = cls._instances.get(guild.id)
+        if manager is None or manager.guild is not guild:
+            manager = cls(guild)
+            cls._instances[guild.id] = manager
+        return manager
+
+    @classmethod
+    def invalidate(cls, guild: discord.Guild):
+        cls._instances.pop(guild.id, None)
+
     def __init__(self, guild: discord.Guild):
         self.guild = guild
+        self.checked = False
+        self._channel_overwrites: Optional[dict[discord.Role, discord.PermissionOverwrite]] = None
+        self._admin_overwrites: Optional[dict[discord.Role, discord.PermissionOverwrite]] = None
         self.role_names = {
             Roles.COACH_T1: "Coach T1",
             Roles.COACH_T2: "Coach T2",
@@ -17,18 +44,26 @@ class RolesManager:
             Roles.SUB: "Subscriber",
             Roles.MOD: "Moderator",
         }
-        self.roles = {
-            Roles.COACH_T1: discord.utils.get(guild.roles, name=Roles.COACH_T1),
-            Roles.COACH_T2: discord.utils.get(guild.roles, name=Roles.COACH_T2),
-            Roles.COACH_T3: discord.utils.get(guild.roles, name=Roles.COACH_T3),
-            Roles.SUB: discord.utils.get(guild.roles, name=Roles.SUB),
-            Roles.MOD: discord.utils.get(guild.roles, name=Roles.MOD),
-        }
+        self.roles: Dict[str, Optional[discord.Role]] = dict.fromkeys(self.role_names)
+        for role in guild.roles:
+            # Как и discord.utils.get, берется первая роль с таким именем
+            if role.name in self.roles and self.roles[role.name] is None:
+                self.roles[role.name] = role
 
     async def get_role(self, role_name: str) -> discord.Role:
         return self.roles[role_name]
     
     def get_session_channels_overwrites(self) -> dict[discord.Role, discord.PermissionOverwrite]:
+        if self._channel_overwrites is None:
+            self._channel_overwrites = self._build_session_channels_overwrites()
+        return dict(self._channel_overwrites)
+
+    async def get_session_admin_overwrites(self) -> dict[discord.Role, discord.PermissionOverwrite]:
+        if self._admin_overwrites is None:
+            self._admin_overwrites = self._build_session_admin_overwrites()
+        return dict(self._admin_overwrites)
+
+    def _build_session_channels_overwrites(self) -> dict[discord.Role, discord.PermissionOverwrite]:
         return {
             self.roles[Roles.COACH_T1]: discord.PermissionOverwrite(
                 view_channel=True,
@@ -74,7 +109,7 @@ class RolesManager:
             )
         }
 
-    async def get_session_admin_overwrites(self) -> dict[discord.Role, discord.PermissionOverwrite]:
+    def _build_session_admin_overwrites(self) -> dict[discord.Role, discord.PermissionOverwrite]:
         return {
             self.roles[Roles.COACH_T1]: discord.PermissionOverwrite(
                 view_channel=True,
@@ -113,17 +148,21 @@ class RolesManager:
             )
         }
 
-
-
     async def create_role(self, role_name: str) -> discord.Role:
         role = await self.guild.create_role(name=role_name)
         self.roles[role_name] = role
+        self._channel_overwrites = None
+        self._admin_overwrites = None
         return role
 
     async def check_roles(self):
+        """Создает недостающие роли; после первой проверки ничего не делает"""
+        if self.checked:
+            return
         for role_name in self.role_names:
             if not self.roles[role_name]:
                 await self.create_role(self.role_names[role_name])
+        self.checked = True
 
     async def get_role_by_name(self, role_name: str) -> discord.Role:
         return discord.utils.get(self.guild.roles, name=role_name)
@@ -1,32 +1,224 @@
-from models.session import Session
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from models.session import Session, SessionRequest, SessionRequestStatus
+
+
+@dataclass(frozen=True)
+class SessionHeader:
+    """
+    Снимок столбцов строки sessions
+
+    Хранилище не держит ORM-объекты: они принадлежат короткоживущим
+    AsyncSession и после отката транзакции истекают, а после закрытия
+    сессии становятся отсоединенными.
+    """
+
+    id: int
+    type: str
+    coach_id: int
+    date: datetime
+    voice_channel_id: Optional[int]
+    text_channel_id: Optional[int]
+    info_message_id: Optional[int]
+    session_message_id: Optional[int]
+    start_time: Optional[datetime]
+    end_time: Optional[datetime]
+    max_slots: int
+    is_active: bool
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, session: "Session | SessionHeader") -> "SessionHeader":
+        if isinstance(session, cls):
+            return session
+        return cls(**{field.name: getattr(session, field.name) for field in fields(cls)})
+
+
+class RequestState:
+    """Заявка пользователя в памяти"""
+
+    __slots__ = ("id", "user_id", "status", "slot_number")
+
+    def __init__(self, id: Optional[int], user_id: int, status: str, slot_number: Optional[int] = None):
+        # id может быть неизвестен для заявки, созданной через claim_slot
+        self.id = id
+        self.user_id = user_id
+        self.status = status
+        self.slot_number = slot_number
+
+
+class SessionState:
+    """Состояние открытой сессии: заголовок и заявки по пользователям"""
+
+    def __init__(self, session: "Session | SessionHeader", requests: Iterable[SessionRequest] = ()):
+        self.session = SessionHeader.from_model(session)
+        self.requests: Dict[int, RequestState] = {}
+        # Пользователи с заявками в статусе pending
+        self.pending_ids: Set[int] = set()
+        # Каналы сессии, внесенные в индекс SessionManager.channels
+        self.channel_ids: List[int] = []
+        for request in requests:
+            self.apply_request(request)
+
+    @property
+    def session_id(self) -> int:
+        return self.session.id
+
+    def apply_request(self, request: SessionRequest):
+        self.set_request(request.id, request.user_id, request.status, request.slot_number)
+
+    def set_request(self, request_id: Optional[int], user_id: int, status: str, slot_number: Optional[int] = None):
+        current = self.requests.get(user_id)
+        if request_id is None and current is not None:
+            request_id = current.id
+        self.requests[user_id] = RequestState(request_id, user_id, status, slot_number)
+        if status == SessionRequestStatus.PENDING.value:
+            self.pending_ids.add(user_id)
+        else:
+            self.pending_ids.discard(user_id)
+
+    def remove_request(self, request_id: int) -> bool:
+        for user_id, request in self.requests.items():
+            if request.id == request_id:
+                del self.requests[user_id]
+                self.pending_ids.discard(user_id)
+                return True
+        return False
+
+    def get_request(self, user_id: int) -> Optional[RequestState]:
+        return self.requests.get(user_id)
+
+    @property
+    def pending_user_ids(self) -> List[int]:
+        """Пользователи в очереди в порядке подачи заявок"""
+        pending = [self.requests[user_id] for user_id in self.pending_ids]
+        return [request.user_id for request in sorted(pending, key=lambda request: request.id or 0)]
+
+    @property
+    def slots(self) -> Dict[int, int]:
+        """Номер слота -> user_id принятых участников, по возрастанию слота"""
+        accepted = [
+            request for request in self.requests.values()
+            if request.status == SessionRequestStatus.ACCEPTED.value
+        ]
+        accepted.sort(key=lambda request: request.slot_number or 0)
+        return {request.slot_number: request.user_id for request in accepted}
+
+    @property
+    def accepted_user_ids(self) -> List[int]:
+        return list(self.slots.values())
+
+    def count_free_slots(self) -> int:
+        return max(self.session.max_slots - len(self.accepted_user_ids), 0)
+
+    def count_by_status(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for request in self.requests.values():
+            counts[request.status] = counts.get(request.status, 0) + 1
+        return counts
+
 
 class SessionManager:
+    """
+    Хранилище открытых сессий процесса (в очереди и активных)
+
+    Заполняется из БД при запуске (SessionService.warm_session_state) и обновляется
+    SessionService после фиксации каждого изменения. Завершенные сессии
+    (с end_time) удаляются. Сессия, которой нет в хранилище, читается из БД
+    при первом обращении.
+
+    Индекс channels связывает голосовой и текстовый каналы открытых сессий
+    с их идентификатором.
+    """
+
     def __init__(self):
-        self.sessions = {}
+        self.sessions: Dict[int, SessionState] = {}
+        self.channels: Dict[int, int] = {}
+        self.warmed = False
+
+    def _index_channels(self, state: SessionState):
+        session = state.session
+        state.channel_ids = [
+            channel_id for channel_id in (session.voice_channel_id, session.text_channel_id)
+            if channel_id is not None
+        ]
+        for channel_id in state.channel_ids:
+            self.channels[channel_id] = session.id
+
+    def _unindex_channels(self, state: SessionState):
+        for channel_id in state.channel_ids:
+            if self.channels.get(channel_id) == state.session_id:
+                del self.channels[channel_id]
+        state.channel_ids = []
+
+    def load(self, session: "Session | SessionHeader", requests: Iterable[SessionRequest] = ()) -> SessionState:
+        self.discard(session.id)
+        state = SessionState(session, requests)
+        self.sessions[session.id] = state
+        self._index_channels(state)
+        return state
+
+    def get(self, session_id: int) -> Optional[SessionState]:
+        return self.sessions.get(session_id)
+
+    def get_session_id_by_channel(self, channel_id: int) -> Optional[int]:
+        """Идентификатор открытой сессии, которой принадлежит канал"""
+        return self.channels.get(channel_id)
+
+    def get_by_channel(self, channel_id: int) -> Optional[SessionState]:
+        session_id = self.channels.get(channel_id)
+        return self.sessions.get(session_id) if session_id is not None else None
+
+    def get_by_coach_id(self, coach_id: int, active: Optional[bool] = None) -> List[SessionState]:
+        """Открытые сессии коуча, от новых к старым"""
+        states = [
+            state for state in self.sessions.values()
+            if state.session.coach_id == coach_id
+            and (active is None or bool(state.session.is_active) == active)
+        ]
+        return sorted(states, key=lambda state: state.session_id, reverse=True)
 
-    def add_session(self, session: Session, slots: dict[int, str] = {}):
-        self.sessions[session.id] = {
-            "session": session,
-            "slots": slots
-        }
+    def update_session(self, session: "Session | SessionHeader"):
+        """Обновляет заголовок; завершенная сессия удаляется из хранилища"""
+        if session.end_time is not None:
+            self.discard(session.id)
+            return
+        state = self.sessions.get(session.id)
+        if state is None:
+            # Заявки неизвестны: сессия будет прочитана из БД при обращении
+            return
+        self._unindex_channels(state)
+        state.session = SessionHeader.from_model(session)
+        self._index_channels(state)
 
-    def get_session(self, session_id: int) -> Session:
-        return self.sessions[session_id]["session"]
+    def apply_requests(self, requests: Iterable[SessionRequest]):
+        for request in requests:
+            state = self.sessions.get(request.session_id)
+            if state is not None:
+                state.apply_request(request)
 
-    def remove_session(self, session_id: int):
-        del self.sessions[session_id]
+    def set_slot(self, session_id: int, user_id: int, slot_number: int):
+        state = self.sessions.get(session_id)
+        if state is not None:
+            state.set_request(None, user_id, SessionRequestStatus.ACCEPTED.value, slot_number)
 
-    def count_free_slots(self, session_id: int) -> int:
-        return self.sessions[session_id]["session"].max_slots - len(self.sessions[session_id]["slots"])
+    def remove_request(self, request_id: int):
+        for state in self.sessions.values():
+            if state.remove_request(request_id):
+                return
 
-    def get_slots(self, session_id: int) -> dict[int, str]:
-        return self.sessions[session_id]["slots"]
-    
-    def set_slot(self, session_id: int, slot_num: int, user_mention: str):
-        self.sessions[session_id]["slots"][slot_num] = user_mention
+    def discard(self, session_id: int):
+        state = self.sessions.pop(session_id, None)
+        if state is not None:
+            self._unindex_channels(state)
 
-    def remove_slot(self, session_id: int, slot_num: int):
-        del self.sessions[session_id]["slots"][slot_num]
+    def clear(self):
+        self.sessions.clear()
+        self.channels.clear()
+        self.warmed = False
 
 
-        
\ No newline at end of file
+session_manager = SessionManager()
@@ -0,0 +1,119 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from models.user import User
+
+# Максимальное количество пользователей в кэше
+USER_CACHE_SIZE = 2048
+# Время жизни записи кэша, секунды
+USER_CACHE_TTL = 300
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """
+    Снимок столбцов строки users
+
+    Кэш общий для процесса и не держит ORM-объекты: они принадлежат
+    AsyncSession взаимодействия и после отката истекают.
+    """
+
+    id: int
+    nickname: str
+    join_date: datetime
+    coach_tier: Optional[str]
+    total_replay_sessions: Optional[int]
+    total_creative_sessions: Optional[int]
+    priority_coefficient: Optional[float]
+    priority_given_by: Optional[int]
+    priority_expires_at: Optional[datetime]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    get_sessions_count = User.get_sessions_count
+
+    @classmethod
+    def from_model(cls, user: "User | UserSnapshot") -> "UserSnapshot":
+        if isinstance(user, cls):
+            return user
+        return cls(**{field.name: getattr(user, field.name) for field in fields(cls)})
+
+
+class UserCache:
+    """
+    LRU-кэш строк users с ограниченным временем жизни
+
+    Общий для процесса: UserService создается на каждое взаимодействие,
+    а кэш переживает их. Записи сбрасываются при изменении пользователя.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users: "OrderedDict[int, Tuple[float, UserSnapshot]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[UserSnapshot]:
+        entry = self._users.get(user_id)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return user
+            del self._users[user_id]
+        self.misses += 1
+        return None
+
+    def get_many(self, user_ids: Iterable[int]) -> Tuple[Dict[int, UserSnapshot], List[int]]:
+        """
+        Пользователи из кэша и идентификаторы, которых в нем нет
+
+        Returns:
+            (найденные пользователи по id, список промахов без повторов)
+        """
+        found: Dict[int, UserSnapshot] = {}
+        missing: List[int] = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        return found, missing
+
+    def put(self, user: "User | UserSnapshot") -> UserSnapshot:
+        snapshot = UserSnapshot.from_model(user)
+        self._users[snapshot.id] = (time.monotonic() + self.ttl, snapshot)
+        self._users.move_to_end(snapshot.id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+            self.evictions += 1
+        return snapshot
+
+    def invalidate(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        self._users.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._users),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+user_cache = UserCache()
@@ -1,11 +1,15 @@
 from .base import Base
-from sqlalchemy import Column, String, BigInteger, DateTime, Integer, Float, ForeignKey, Enum, Boolean
+from sqlalchemy import Column, String, BigInteger, DateTime, Integer, Float, ForeignKey, Enum, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 import enum
 from datetime import datetime
 
 class Session(Base):
     __tablename__ = "sessions"
+    __table_args__ = (
+        Index("ix_sessions_coach_active_created", "coach_id", "is_active", "created_at"),
+        Index("ix_sessions_created_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     type = Column(String, nullable=False)
@@ -32,6 +36,11 @@ class SessionRequestStatus(enum.Enum):
 
 class SessionRequest(Base):
     __tablename__ = "session_requests"
+    __table_args__ = (
+        UniqueConstraint("session_id", "user_id", name="uq_session_requests_session_user"),
+        Index("ix_session_requests_session_status_slot", "session_id", "status", "slot_number"),
+        Index("ix_session_requests_user_status", "user_id", "status"),
+    )
     
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
@@ -43,6 +52,9 @@ class SessionRequest(Base):
 
 class SessionReview(Base):
     __tablename__ = "session_reviews"
+    __table_args__ = (
+        UniqueConstraint("session_id", "user_id", name="uq_session_reviews_session_user"),
+    )
 
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
@@ -57,6 +69,8 @@ class UserSessionActivity(Base):
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False, index=True)
     user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False, index=True)
     join_time = Column(DateTime, nullable=False)
+    # У открытой активности - время последней отметки бота (heartbeat),
+    # по нему активность закрывается после аварийной остановки
     leave_time = Column(DateTime, nullable=True)
     total_duration_seconds = Column(Integer, default=0)
     is_active = Column(Boolean, default=True)
@@ -73,8 +87,14 @@ class UserSessionActivity(Base):
 
     @property
     def duration(self) -> float:
-        if self.total_duration_seconds > 0:
+        if self.total_duration_seconds and self.total_duration_seconds > 0:
             return float(self.total_duration_seconds)
         elif self.leave_time:
             return (self.leave_time - self.join_time).total_seconds()
         return 0
+
+    def duration_until(self, now: datetime) -> float:
+        """Длительность активности; незавершенная считается до now"""
+        if self.is_active:
+            return max((now - self.join_time).total_seconds(), 0)
+        return self.duration
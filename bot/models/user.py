@@ -18,4 +18,9 @@ class User(Base):
     session_activities = relationship("UserSessionActivity", back_populates="user")
 
     def get_sessions_count(self, session_type: str) -> int:
-        return len([req for req in self.session_requests if req.session.type == session_type])
\ No newline at end of file
+        """Количество сессий типа session_type по денормализованным счетчикам"""
+        if session_type == "replay":
+            return self.total_replay_sessions or 0
+        if session_type == "creative":
+            return self.total_creative_sessions or 0
+        return 0
\ No newline at end of file
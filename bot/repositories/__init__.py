@@ -1,5 +1,5 @@
-from .session_repo import SessionRepository
+from .session_repo import SessionRepository, SessionLoad, SlotClaimStatus
 from .user_repo import UserRepository
-from .base_repo import BaseRepository
+from .base_repo import BaseRepository, after_commit, unit_of_work
 
-__all__ = ["SessionRepository", "UserRepository", "BaseRepository"]
\ No newline at end of file
+__all__ = ["SessionRepository", "SessionLoad", "SlotClaimStatus", "UserRepository", "BaseRepository", "after_commit", "unit_of_work"]
@@ -1,9 +1,83 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
-from typing import TypeVar, Generic, Type, List, Optional
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import Any, AsyncIterator, Callable, Dict, TypeVar, Generic, Type, List, Optional
+from contextlib import asynccontextmanager
 
 T = TypeVar('T')
 
+# Ключ в AsyncSession.info с глубиной вложенности unit_of_work
+TRANSACTION_DEPTH_KEY = "transaction_depth"
+# Ключ в AsyncSession.info с функциями, ожидающими фиксации unit_of_work
+AFTER_COMMIT_KEY = "after_commit"
+# INSERT с поддержкой ON CONFLICT для поддерживаемых диалектов
+UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def check_upsert_support(dialect: str):
+    """
+    Проверяет, что диалект поддерживает ON CONFLICT, на котором построены upsert репозиториев
+    
+    Args:
+        dialect: Имя диалекта подключения
+        
+    Raises:
+        ValueError: Если диалект не поддерживается
+    """
+    if dialect not in UPSERT_INSERTS:
+        raise ValueError(
+            f"Database dialect {dialect} is not supported: repositories require "
+            f"INSERT ... ON CONFLICT ({', '.join(sorted(UPSERT_INSERTS))})"
+        )
+
+
+def after_commit(session: AsyncSession, callback: Callable[[], Any]):
+    """
+    Выполняет callback после фиксации изменений
+    
+    Внутри unit_of_work вызов откладывается до commit внешнего блока и
+    отменяется при откате, вне ее выполняется сразу: методы репозиториев
+    к этому моменту уже зафиксировали изменения.
+    """
+    if session.info.get(TRANSACTION_DEPTH_KEY, 0) > 0:
+        session.info.setdefault(AFTER_COMMIT_KEY, []).append(callback)
+    else:
+        callback()
+
+
+@asynccontextmanager
+async def unit_of_work(session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """
+    Транзакция, объединяющая записи нескольких репозиториев
+    
+    Внутри блока методы репозиториев выполняют flush вместо commit.
+    Фиксация происходит один раз при выходе из внешнего блока,
+    при исключении транзакция откатывается.
+    
+    Args:
+        session: Асинхронная сессия SQLAlchemy, общая для репозиториев
+    """
+    depth = session.info.get(TRANSACTION_DEPTH_KEY, 0)
+    session.info[TRANSACTION_DEPTH_KEY] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            await session.commit()
+    except BaseException:
+        if depth == 0:
+            session.info.pop(AFTER_COMMIT_KEY, None)
+            await session.rollback()
+        raise
+    finally:
+        session.info[TRANSACTION_DEPTH_KEY] = depth
+    if depth == 0:
+        for callback in session.info.pop(AFTER_COMMIT_KEY, []):
+            callback()
+
+
 class BaseRepository(Generic[T]):
     """Базовый репозиторий для работы с моделями"""
     
@@ -17,6 +91,37 @@ class BaseRepository(Generic[T]):
         """
         self.session = session
         self.model_cls = model_cls
+
+    @property
+    def in_transaction(self) -> bool:
+        """Выполняется ли репозиторий внутри unit_of_work"""
+        return self.session.info.get(TRANSACTION_DEPTH_KEY, 0) > 0
+
+    async def _commit(self):
+        """Фиксирует изменения или, внутри unit_of_work, только отправляет их в БД"""
+        if self.in_transaction:
+            await self.session.flush()
+        else:
+            await self.session.commit()
+    
+    def _insert(self, model_cls: Optional[Type] = None):
+        """
+        INSERT диалекта текущего подключения с поддержкой ON CONFLICT
+        
+        Args:
+            model_cls: Класс модели, по умолчанию модель репозитория
+        """
+        model_cls = model_cls or self.model_cls
+        dialect = self.session.get_bind().dialect.name
+        check_upsert_support(dialect)
+        return UPSERT_INSERTS[dialect](model_cls)
+    
+    def _apply_filters(self, query, **filters):
+        """Добавляет к запросу условия имя_поля=значение для существующих полей модели"""
+        for field, value in filters.items():
+            if hasattr(self.model_cls, field):
+                query = query.where(getattr(self.model_cls, field) == value)
+        return query
     
     async def get_by_id(self, id: int) -> Optional[T]:
         """
@@ -54,13 +159,38 @@ class BaseRepository(Generic[T]):
             Список отфильтрованных объектов
         """
         query = select(self.model_cls)
-        for field, value in filters.items():
-            if hasattr(self.model_cls, field):
-                query = query.where(getattr(self.model_cls, field) == value)
+        query = self._apply_filters(query, **filters)
         
         result = await self.session.execute(query)
         return list(result.scalars().all())
     
+    async def _create(self, model_cls: Type, **kwargs):
+        """
+        Создание объекта модели одним INSERT ... RETURNING
+        
+        Значения по умолчанию на стороне БД возвращаются тем же запросом,
+        без отдельного refresh.
+        """
+        query = insert(model_cls).values(**kwargs).returning(model_cls)
+        result = await self.session.execute(query)
+        obj = result.scalar_one()
+        await self._commit()
+        return obj
+    
+    async def _bulk_create(self, model_cls: Type, rows: List[Dict[str, Any]]) -> list:
+        """
+        Создание нескольких объектов модели одним executemany с RETURNING
+        
+        Объекты возвращаются в порядке rows.
+        """
+        if not rows:
+            return []
+        query = insert(model_cls).returning(model_cls, sort_by_parameter_order=True)
+        result = await self.session.execute(query, rows)
+        objs = list(result.scalars().all())
+        await self._commit()
+        return objs
+    
     async def create(self, **kwargs) -> T:
         """
         Создание нового объекта
@@ -71,11 +201,19 @@ class BaseRepository(Generic[T]):
         Returns:
             Созданный объект
         """
-        obj = self.model_cls(**kwargs)
-        self.session.add(obj)
-        await self.session.commit()
-        await self.session.refresh(obj)
-        return obj
+        return await self._create(self.model_cls, **kwargs)
+    
+    async def bulk_create(self, rows: List[Dict[str, Any]]) -> List[T]:
+        """
+        Создание нескольких объектов
+        
+        Args:
+            rows: Атрибуты создаваемых объектов
+            
+        Returns:
+            Созданные объекты в порядке rows
+        """
+        return await self._bulk_create(self.model_cls, rows)
     
     async def update(self, id: int, **kwargs) -> Optional[T]:
         """
@@ -90,9 +228,32 @@ class BaseRepository(Generic[T]):
         """
         query = update(self.model_cls).where(self.model_cls.id == id).values(**kwargs).returning(self.model_cls)
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.scalar_one_or_none()
     
+    async def update_many(self, ids: List[int], **kwargs) -> int:
+        """
+        Обновление нескольких объектов одним запросом
+        
+        Args:
+            ids: Идентификаторы объектов
+            **kwargs: Атрибуты для обновления
+            
+        Returns:
+            Количество обновленных объектов
+        """
+        if not ids:
+            return 0
+        query = (
+            update(self.model_cls)
+            .where(self.model_cls.id.in_(ids))
+            .values(**kwargs)
+            .execution_options(synchronize_session="fetch")
+        )
+        result = await self.session.execute(query)
+        await self._commit()
+        return result.rowcount
+    
     async def delete(self, id: int) -> bool:
         """
         Удаление объекта по ID
@@ -105,7 +266,7 @@ class BaseRepository(Generic[T]):
         """
         query = delete(self.model_cls).where(self.model_cls.id == id)
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def count(self, **filters) -> int:
@@ -118,12 +279,9 @@ class BaseRepository(Generic[T]):
         Returns:
             Количество объектов
         """
-        from sqlalchemy import func
         query = select(func.count()).select_from(self.model_cls)
         
-        for field, value in filters.items():
-            if hasattr(self.model_cls, field):
-                query = query.where(getattr(self.model_cls, field) == value)
+        query = self._apply_filters(query, **filters)
         
         result = await self.session.execute(query)
         return result.scalar_one()
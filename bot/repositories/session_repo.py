@@ -1,4 +1,5 @@
 from repositories.base_repo import BaseRepository
+from repositories.user_repo import SESSION_COUNTER_FIELDS, sessions_counter_update
 from models.session import (
     Session,
     SessionRequest,
@@ -7,98 +8,224 @@ from models.session import (
     UserSessionActivity,
 )
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, delete, func, case, tuple_, bindparam, and_, not_, or_
 from logger import logger
+from utils.utils import get_current_time
+
+
+class SessionLoad:
+    """Профили загрузки связей сессии"""
+
+    HEADER = "header"
+    WITH_REQUESTS = "with_requests"
+    FULL = "full"
+
+
+class SlotClaimStatus:
+    """Результаты занятия слота в активной сессии"""
+
+    CLAIMED = "claimed"
+    ALREADY_JOINED = "already_joined"
+    FULL = "full"
+
+
+SESSION_RELATIONS = frozenset({"requests", "reviews", "activities", "coach"})
+
+SESSION_LOAD_PROFILES = {
+    SessionLoad.HEADER: frozenset(),
+    SessionLoad.WITH_REQUESTS: frozenset({"requests"}),
+    SessionLoad.FULL: SESSION_RELATIONS,
+}
 
 
 class SessionRepository(BaseRepository[Session]):
     def __init__(self, session: AsyncSession):
         super().__init__(session, Session)
     
-    async def get_by_id(self, session_id: int) -> Optional[Session]:
-        query = select(Session).options(
-            selectinload(Session.requests),
-            selectinload(Session.reviews),
-            selectinload(Session.activities),
-            selectinload(Session.coach),
-        ).where(Session.id == session_id)
+    def _session_load_options(
+        self, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None
+    ) -> list:
+        """
+        Опции selectinload для выбранного профиля загрузки
+
+        Args:
+            load: Профиль загрузки (SessionLoad.HEADER, WITH_REQUESTS, FULL)
+            include: Явный набор связей; если задан, профиль игнорируется
+
+        Returns:
+            Список опций для select(Session).options(...)
+        """
+        if include is not None:
+            relations = frozenset(include)
+        elif load in SESSION_LOAD_PROFILES:
+            relations = SESSION_LOAD_PROFILES[load]
+        else:
+            raise ValueError(f"Unknown session load profile: {load}")
+
+        unknown = relations - SESSION_RELATIONS
+        if unknown:
+            raise ValueError(f"Unknown session relations: {', '.join(sorted(unknown))}")
+        return [selectinload(getattr(Session, relation)) for relation in sorted(relations)]
+
+    async def get_by_id(
+        self,
+        session_id: int,
+        load: str = SessionLoad.FULL,
+        include: Optional[Iterable[str]] = None,
+    ) -> Optional[Session]:
+        query = (
+            select(Session)
+            .options(*self._session_load_options(load, include))
+            .where(Session.id == session_id)
+        )
         result = await self.session.execute(query)
         return result.scalar_one_or_none()
 
-    async def get_all_sessions(self) -> List[Session]:
-        query = select(Session).options(
-            selectinload(Session.requests),
-            selectinload(Session.reviews),
-            selectinload(Session.activities),
-            selectinload(Session.coach),
-        )
+    async def get_all_sessions(
+        self, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None
+    ) -> List[Session]:
+        query = select(Session).options(*self._session_load_options(load, include))
         result = await self.session.execute(query)
         return result.scalars().all()
 
-    async def get_active_sessions(self) -> List[Session]:
+    async def get_latest_session(
+        self,
+        load: str = SessionLoad.HEADER,
+        include: Optional[Iterable[str]] = None,
+        **filters,
+    ) -> Optional[Session]:
+        """
+        Последняя созданная сессия
+        
+        Args:
+            load: Профиль загрузки связей (SessionLoad)
+            include: Дополнительные связи для загрузки
+            **filters: Условия фильтрации в формате имя_поля=значение
+        """
         query = (
             select(Session)
-            .options(
-                selectinload(Session.requests),
-                selectinload(Session.reviews),
-                selectinload(Session.activities),
-                selectinload(Session.coach),
+            .options(*self._session_load_options(load, include))
+            .order_by(Session.created_at.desc(), Session.id.desc())
+            .limit(1)
+        )
+        query = self._apply_filters(query, **filters)
+        result = await self.session.execute(query)
+        return result.scalar_one_or_none()
+
+    async def stream_sessions(
+        self,
+        batch_size: int = 100,
+        load: str = SessionLoad.HEADER,
+        include: Optional[Iterable[str]] = None,
+        **filters,
+    ) -> AsyncIterator[Session]:
+        """
+        Итерирует сессии в порядке (created_at, id) пачками по batch_size
+        
+        Пачки выбираются по ключу последней полученной сессии (keyset pagination),
+        поэтому в памяти одновременно находится не больше одной пачки.
+        
+        Args:
+            batch_size: Размер пачки
+            load: Профиль загрузки связей (SessionLoad)
+            include: Дополнительные связи для загрузки
+            **filters: Условия фильтрации в формате имя_поля=значение
+        """
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        options = self._session_load_options(load, include)
+        last_key = None
+        while True:
+            query = (
+                select(Session)
+                .options(*options)
+                .order_by(Session.created_at, Session.id)
+                .limit(batch_size)
             )
+            query = self._apply_filters(query, **filters)
+            if last_key is not None:
+                query = query.where(tuple_(Session.created_at, Session.id) > last_key)
+            result = await self.session.execute(query)
+            batch = result.scalars().all()
+            for session in batch:
+                yield session
+            if len(batch) < batch_size:
+                return
+            last_key = (batch[-1].created_at, batch[-1].id)
+
+    async def get_active_sessions(
+        self, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None
+    ) -> List[Session]:
+        query = (
+            select(Session)
+            .options(*self._session_load_options(load, include))
             .where(Session.is_active == True)
         )
         result = await self.session.execute(query)
         return result.scalars().all()
 
-    async def get_active_sessions_by_coach_id(self, coach_id: int) -> List[Session]:
+    async def get_active_sessions_by_coach_id(
+        self,
+        coach_id: int,
+        load: str = SessionLoad.FULL,
+        include: Optional[Iterable[str]] = None,
+    ) -> List[Session]:
         query = (
             select(Session)
-            .options(
-                selectinload(Session.requests),
-                selectinload(Session.reviews),
-                selectinload(Session.activities),
-                selectinload(Session.coach),
-            )
+            .options(*self._session_load_options(load, include))
             .where(Session.coach_id == coach_id, Session.is_active == True)
             .order_by(Session.created_at.desc())
         )
         result = await self.session.execute(query)
         return result.scalars().all()
 
-    async def get_active_sessions_by_user_id(self, user_id: int) -> List[Session]:
+    async def get_active_sessions_by_user_id(
+        self,
+        user_id: int,
+        load: str = SessionLoad.FULL,
+        include: Optional[Iterable[str]] = None,
+    ) -> List[Session]:
         query = (
             select(Session)
-            .options(
-                selectinload(Session.requests),
-                selectinload(Session.reviews),
-                selectinload(Session.activities),
-                selectinload(Session.coach),
-            )
+            .options(*self._session_load_options(load, include))
             .where(Session.is_active == True, Session.coach_id == user_id)
         )
         result = await self.session.execute(query)
         return result.scalars().all()
 
     async def get_last_created_session_by_coach_id(
-        self, coach_id: int
+        self,
+        coach_id: int,
+        load: str = SessionLoad.FULL,
+        include: Optional[Iterable[str]] = None,
     ) -> Optional[Session]:
         query = (
             select(Session)
-            .options(
-                selectinload(Session.requests),
-                selectinload(Session.reviews),
-                selectinload(Session.activities),
-                selectinload(Session.coach),
-            )
+            .options(*self._session_load_options(load, include))
             .where(Session.coach_id == coach_id)
             .order_by(Session.created_at.desc())
         )
         result = await self.session.execute(query)
         return result.scalars().first()
 
+    async def get_open_session_id_by_channel(self, channel_id: int) -> Optional[int]:
+        """Идентификатор открытой сессии, которой принадлежит голосовой или текстовый канал"""
+        query = (
+            select(Session.id)
+            .where(
+                Session.end_time.is_(None),
+                or_(Session.voice_channel_id == channel_id, Session.text_channel_id == channel_id),
+            )
+            .order_by(Session.id.desc())
+            .limit(1)
+        )
+        result = await self.session.execute(query)
+        return result.scalar_one_or_none()
+
     async def get_request_by_id(self, request_id: int) -> Optional[SessionRequest]:
         query = (
             select(SessionRequest)
@@ -123,6 +250,14 @@ class SessionRepository(BaseRepository[Session]):
         result = await self.session.execute(query)
         return result.scalars().all()
 
+    async def get_requests_by_session_ids(self, session_ids: List[int]) -> List[SessionRequest]:
+        """Заявки нескольких сессий одним запросом, без загрузки связей"""
+        if not session_ids:
+            return []
+        query = select(SessionRequest).where(SessionRequest.session_id.in_(session_ids))
+        result = await self.session.execute(query)
+        return list(result.scalars().all())
+
     async def get_accepted_requests(self, session_id: int) -> List[SessionRequest]:
         query = (
             select(SessionRequest)
@@ -146,7 +281,7 @@ class SessionRepository(BaseRepository[Session]):
 
     async def get_user_sessions_count(self, user_id: int, session_type: str) -> int:
         query = (
-            select(SessionRequest)
+            select(func.count(SessionRequest.id))
             .join(Session)
             .where(
                 SessionRequest.user_id == user_id,
@@ -155,7 +290,7 @@ class SessionRepository(BaseRepository[Session]):
             )
         )
         result = await self.session.execute(query)
-        return len(result.scalars().all())
+        return result.scalar_one()
 
     async def get_request_by_user_id(
         self, session_id: int, user_id: int
@@ -175,16 +310,92 @@ class SessionRepository(BaseRepository[Session]):
         return result.scalar_one_or_none()
 
     async def create_request(
-        self, session_id: int, user_id: int, status: SessionRequestStatus
-    ) -> SessionRequest:
-        request = SessionRequest(session_id=session_id, user_id=user_id, status=status)
-        self.session.add(request)
-        await self.session.commit()
-        return request
+        self,
+        session_id: int,
+        user_id: int,
+        status: SessionRequestStatus,
+        idempotent: bool = False,
+    ) -> SessionRequest | Tuple[SessionRequest, bool]:
+        """
+        Создание заявки пользователя на сессию
+        
+        Args:
+            session_id: Идентификатор сессии
+            user_id: Идентификатор пользователя
+            status: Статус заявки
+            idempotent: Не создавать дубликат, если заявка уже есть
+                (INSERT ... ON CONFLICT (session_id, user_id) DO NOTHING)
+            
+        Returns:
+            Заявка, в идемпотентном режиме (заявка, создана ли она сейчас)
+        """
+        if not idempotent:
+            return await self._create(
+                SessionRequest, session_id=session_id, user_id=user_id, status=status
+            )
+
+        query = (
+            self._insert(SessionRequest)
+            .values(session_id=session_id, user_id=user_id, status=status)
+            .on_conflict_do_nothing(
+                index_elements=[SessionRequest.session_id, SessionRequest.user_id]
+            )
+            .returning(SessionRequest)
+        )
+        result = await self.session.execute(query)
+        request = result.scalar_one_or_none()
+        created = request is not None
+        if not created:
+            # Заявка уже существует: читаем ее только в этом, редком, случае
+            request = await self.get_request_by_user_id(session_id, user_id)
+        await self._commit()
+        return request, created
+
+    async def create_requests(self, rows: List[Dict]) -> List[SessionRequest]:
+        """
+        Создание нескольких заявок одним executemany
+        
+        Args:
+            rows: Атрибуты заявок, каждая с session_id, user_id и status
+        """
+        return await self._bulk_create(SessionRequest, rows)
+
+    async def _adjust_sessions_counts(self, request_ids: List[int], accepted: bool):
+        """
+        Меняет счетчики сессий пользователей, чьи заявки переходят в статус
+        accepted (accepted=True) или выходят из него (accepted=False)
+
+        Вызывается до смены статуса, в той же транзакции: заявки, уже
+        находящиеся в нужном статусе, счетчики не меняют.
+        """
+        if not request_ids:
+            return
+        is_accepted = SessionRequest.status == SessionRequestStatus.ACCEPTED.value
+        query = (
+            select(Session.type, SessionRequest.user_id)
+            .join(Session, Session.id == SessionRequest.session_id)
+            .where(
+                SessionRequest.id.in_(request_ids),
+                not_(is_accepted) if accepted else is_accepted,
+            )
+        )
+        result = await self.session.execute(query)
+        by_type: Dict[str, List[int]] = {}
+        for session_type, user_id in result.all():
+            by_type.setdefault(session_type, []).append(user_id)
+        for session_type, user_ids in by_type.items():
+            if session_type in SESSION_COUNTER_FIELDS:
+                await self.session.execute(
+                    sessions_counter_update(session_type, user_ids, 1 if accepted else -1)
+                )
 
     async def update_request(
         self, request_id: int, **kwargs
     ) -> SessionRequest:
+        if "status" in kwargs:
+            await self._adjust_sessions_counts(
+                [request_id], kwargs["status"] == SessionRequestStatus.ACCEPTED.value
+            )
         query = (
             update(SessionRequest)
             .where(SessionRequest.id == request_id)
@@ -192,9 +403,136 @@ class SessionRepository(BaseRepository[Session]):
             .returning(SessionRequest)
         )
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.scalar_one_or_none()
 
+    async def bulk_assign_slots(
+        self,
+        session_id: int,
+        accepted: List[Tuple[int, int]],
+        rejected_ids: List[int],
+    ) -> List[SessionRequest]:
+        """
+        Распределение слотов сессии в одной транзакции
+
+        Счетчики сессий принятых пользователей увеличиваются в той же транзакции.
+
+        Args:
+            session_id: Идентификатор сессии
+            accepted: Пары (request_id, slot_number) принятых заявок
+            rejected_ids: Идентификаторы отклоненных заявок
+
+        Returns:
+            Обновленные заявки
+        """
+        updated = []
+        await self._adjust_sessions_counts([request_id for request_id, _ in accepted], True)
+        await self._adjust_sessions_counts(rejected_ids, False)
+        if accepted:
+            slots = dict(accepted)
+            query = (
+                update(SessionRequest)
+                .where(
+                    SessionRequest.session_id == session_id,
+                    SessionRequest.id.in_(slots.keys()),
+                )
+                .values(
+                    status=SessionRequestStatus.ACCEPTED.value,
+                    slot_number=case(slots, value=SessionRequest.id),
+                )
+                .returning(SessionRequest)
+            )
+            result = await self.session.execute(query)
+            updated.extend(result.scalars().all())
+        if rejected_ids:
+            query = (
+                update(SessionRequest)
+                .where(
+                    SessionRequest.session_id == session_id,
+                    SessionRequest.id.in_(rejected_ids),
+                )
+                .values(status=SessionRequestStatus.REJECTED.value, slot_number=None)
+                .returning(SessionRequest)
+            )
+            result = await self.session.execute(query)
+            updated.extend(result.scalars().all())
+        await self._commit()
+        return updated
+
+    async def claim_slot(
+        self, session_id: int, user_id: int
+    ) -> Tuple[str, Optional[int]]:
+        """
+        Атомарно занимает следующий слот активной сессии для пользователя
+        
+        Строка сессии блокируется (SELECT ... FOR UPDATE) до конца транзакции,
+        поэтому одновременные попытки занять слот выполняются по очереди:
+        вместимость и номер слота проверяются и назначаются без гонок.
+        
+        Args:
+            session_id: Идентификатор сессии
+            user_id: Идентификатор пользователя
+            
+        Returns:
+            (SlotClaimStatus, номер слота пользователя или None, если мест нет)
+        """
+        query = (
+            select(Session.max_slots, Session.type)
+            .where(Session.id == session_id)
+            .with_for_update()
+        )
+        result = await self.session.execute(query)
+        row = result.one_or_none()
+        if row is None:
+            await self._commit()
+            raise ValueError(f"Session {session_id} not found")
+        max_slots, session_type = row
+
+        # Отдельный запрос после блокировки: в READ COMMITTED он видит заявки,
+        # зафиксированные транзакцией, которая держала блокировку перед нами
+        is_user = SessionRequest.user_id == user_id
+        query = select(
+            func.count(SessionRequest.id),
+            func.max(SessionRequest.slot_number),
+            func.count(case((is_user, SessionRequest.id))),
+            func.max(case((is_user, SessionRequest.slot_number))),
+        ).where(
+            SessionRequest.session_id == session_id,
+            SessionRequest.status == SessionRequestStatus.ACCEPTED.value,
+        )
+        result = await self.session.execute(query)
+        accepted_count, last_slot, user_joined, user_slot = result.one()
+
+        if user_joined:
+            await self._commit()
+            return SlotClaimStatus.ALREADY_JOINED, user_slot
+        if accepted_count >= max_slots:
+            await self._commit()
+            return SlotClaimStatus.FULL, None
+
+        slot_number = (last_slot or 0) + 1
+        query = self._insert(SessionRequest).values(
+            session_id=session_id,
+            user_id=user_id,
+            status=SessionRequestStatus.ACCEPTED.value,
+            slot_number=slot_number,
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[SessionRequest.session_id, SessionRequest.user_id],
+            set_={
+                "status": query.excluded.status,
+                "slot_number": query.excluded.slot_number,
+                "updated_at": get_current_time(),
+            },
+        ).returning(SessionRequest)
+        # populate_existing обновляет уже загруженную в сессию заявку пользователя
+        await self.session.execute(query.execution_options(populate_existing=True))
+        # Пользователь еще не был принят (user_joined): счетчик растет вместе с заявкой
+        if session_type in SESSION_COUNTER_FIELDS:
+            await self.session.execute(sessions_counter_update(session_type, [user_id], 1))
+        await self._commit()
+        return SlotClaimStatus.CLAIMED, slot_number
+
     async def update_request_status(
         self, request_id: int, status: SessionRequestStatus
     ) -> SessionRequest:
@@ -209,8 +547,11 @@ class SessionRepository(BaseRepository[Session]):
         result = await self.session.execute(query)
         request = result.scalar_one_or_none()
         if request:
+            await self._adjust_sessions_counts(
+                [request_id], SessionRequestStatus(status) == SessionRequestStatus.ACCEPTED
+            )
             request.status = status
-            await self.session.commit()
+            await self._commit()
         return request
 
     async def delete_request(self, request_id: int) -> bool:
@@ -223,16 +564,39 @@ class SessionRepository(BaseRepository[Session]):
         request = result.scalar_one_or_none()
         if request:
             await self.session.delete(request)
-            await self.session.commit()
+            await self._commit()
             return True
         return False
 
     async def create_review(
         self, session_id: int, user_id: int, **kwargs
     ) -> SessionReview:
-        review = SessionReview(session_id=session_id, user_id=user_id, **kwargs)
-        self.session.add(review)
-        await self.session.commit()
+        return await self._create(
+            SessionReview, session_id=session_id, user_id=user_id, **kwargs
+        )
+
+    async def upsert_review(self, session_id: int, user_id: int, rating: int) -> SessionReview:
+        """
+        Создает или обновляет оценку пользователя одним
+        INSERT ... ON CONFLICT (session_id, user_id) DO UPDATE
+        
+        Args:
+            session_id: Идентификатор сессии
+            user_id: Идентификатор пользователя
+            rating: Оценка
+        """
+        query = self._insert(SessionReview).values(
+            session_id=session_id, user_id=user_id, rating=rating
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[SessionReview.session_id, SessionReview.user_id],
+            set_={"rating": query.excluded.rating, "updated_at": get_current_time()},
+        ).returning(SessionReview)
+        result = await self.session.execute(
+            query.execution_options(populate_existing=True)
+        )
+        review = result.scalar_one()
+        await self._commit()
         return review
 
     async def get_reviews_by_session_id(self, session_id: int) -> List[SessionReview]:
@@ -271,22 +635,32 @@ class SessionRepository(BaseRepository[Session]):
             .returning(SessionReview)
         )
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.scalar_one_or_none()
 
     async def delete_review(self, review_id: int) -> bool:
         query = delete(SessionReview).where(SessionReview.id == review_id)
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
 
     async def create_user_session_activity(
         self, session_id: int, user_id: int, **kwargs
     ) -> UserSessionActivity:
-        activity = UserSessionActivity(session_id=session_id, user_id=user_id, **kwargs)
-        self.session.add(activity)
-        await self.session.commit()
-        return activity
+        return await self._create(
+            UserSessionActivity, session_id=session_id, user_id=user_id, **kwargs
+        )
+
+    async def create_user_session_activities(
+        self, rows: List[Dict]
+    ) -> List[UserSessionActivity]:
+        """
+        Создание нескольких активностей пользователей одним executemany
+        
+        Args:
+            rows: Атрибуты активностей, каждая с session_id и user_id
+        """
+        return await self._bulk_create(UserSessionActivity, rows)
 
     async def get_user_session_activity_by_id(
         self, activity_id: int
@@ -344,9 +718,103 @@ class SessionRepository(BaseRepository[Session]):
             .returning(UserSessionActivity)
         )
         result = await self.session.execute(query)
-        await self.session.commit()
+        await self._commit()
         return result.scalar_one_or_none()
 
+    async def close_user_activities(self, closes: List[Dict]) -> int:
+        """
+        Завершение открытых активностей одним executemany
+
+        Args:
+            closes: Словари с session_id, user_id, leave_time и total_duration_seconds
+
+        Returns:
+            Количество завершенных строк
+        """
+        if not closes:
+            return 0
+        table = UserSessionActivity.__table__
+        query = (
+            update(table)
+            .where(
+                table.c.session_id == bindparam("b_session_id"),
+                table.c.user_id == bindparam("b_user_id"),
+                table.c.is_active == True,
+            )
+            .values(
+                leave_time=bindparam("b_leave_time"),
+                total_duration_seconds=bindparam("b_total_duration_seconds"),
+                is_active=False,
+            )
+        )
+        result = await self.session.execute(
+            query, [{f"b_{key}": value for key, value in close.items()} for close in closes]
+        )
+        await self._commit()
+        return result.rowcount
+
+    async def touch_open_activities(self, at: datetime) -> int:
+        """
+        Отметка открытых активностей: leave_time открытой строки - время
+        последнего heartbeat, до которого пользователь точно был в канале
+        """
+        query = (
+            update(UserSessionActivity)
+            .where(UserSessionActivity.is_active == True)
+            .values(leave_time=at)
+        )
+        result = await self.session.execute(query)
+        await self._commit()
+        return result.rowcount
+
+    async def close_dangling_activities(self) -> int:
+        """
+        Завершение активностей, оставшихся открытыми после остановки бота
+
+        Время выхода - последний heartbeat активности (leave_time), но не позже
+        конца сессии. Активность без heartbeat закрывается временем входа.
+
+        Returns:
+            Количество завершенных строк
+        """
+        query = (
+            select(
+                UserSessionActivity.id,
+                UserSessionActivity.join_time,
+                UserSessionActivity.leave_time,
+                Session.end_time,
+            )
+            .join(Session, Session.id == UserSessionActivity.session_id)
+            .where(UserSessionActivity.is_active == True)
+        )
+        result = await self.session.execute(query)
+        params = []
+        for activity_id, join_time, last_seen, end_time in result.all():
+            leave_time = last_seen or join_time
+            if end_time is not None:
+                leave_time = min(leave_time, end_time)
+            leave_time = max(leave_time, join_time)
+            params.append({
+                "b_id": activity_id,
+                "b_leave_time": leave_time,
+                "b_total_duration_seconds": int((leave_time - join_time).total_seconds()),
+            })
+        if not params:
+            return 0
+        table = UserSessionActivity.__table__
+        query = (
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(
+                leave_time=bindparam("b_leave_time"),
+                total_duration_seconds=bindparam("b_total_duration_seconds"),
+                is_active=False,
+            )
+        )
+        await self.session.execute(query, params)
+        await self._commit()
+        return len(params)
+
     async def get_session_activities(
         self, session_id: int
     ) -> List[UserSessionActivity]:
@@ -360,3 +828,40 @@ class SessionRepository(BaseRepository[Session]):
         )
         result = await self.session.execute(query)
         return result.scalars().all()
+
+    async def get_session_durations(
+        self, session_id: int, now: datetime
+    ) -> Dict[int, float]:
+        """
+        Суммарное время пользователей в сессии по UserSessionActivity.duration_until
+
+        Завершенные активности с total_duration_seconds > 0 суммируются в БД.
+        Остальные (незавершенные и завершенные без total_duration_seconds,
+        для которых длительность - leave_time - join_time) читаются строками
+        и считаются методом модели.
+
+        Args:
+            session_id: Идентификатор сессии
+            now: Момент, до которого учитываются незавершенные активности
+
+        Returns:
+            Словарь {user_id: секунды}
+        """
+        is_open = func.coalesce(UserSessionActivity.is_active, False) == True
+        has_total = func.coalesce(UserSessionActivity.total_duration_seconds, 0) > 0
+        summed = and_(not_(is_open), has_total)
+        query = (
+            select(UserSessionActivity.user_id, func.sum(UserSessionActivity.total_duration_seconds))
+            .where(UserSessionActivity.session_id == session_id, summed)
+            .group_by(UserSessionActivity.user_id)
+        )
+        result = await self.session.execute(query)
+        durations = {user_id: float(seconds) for user_id, seconds in result.all()}
+
+        query = select(UserSessionActivity).where(
+            UserSessionActivity.session_id == session_id, not_(summed)
+        )
+        result = await self.session.execute(query)
+        for activity in result.scalars().all():
+            durations[activity.user_id] = durations.get(activity.user_id, 0.0) + activity.duration_until(now)
+        return durations
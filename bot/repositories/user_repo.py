@@ -1,19 +1,123 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from typing import List
+from sqlalchemy import select, update, func
+from typing import Any, Dict, List, Optional
 
 from .base_repo import BaseRepository
 from models.user import User
-from models.session import SessionRequest
+from models.session import Session, SessionRequest, SessionRequestStatus
+from utils.utils import get_current_time
+
+# Счетчики сессий пользователя по типам сессий
+SESSION_COUNTER_FIELDS = {
+    "replay": "total_replay_sessions",
+    "creative": "total_creative_sessions",
+}
+
+# Поля, которые синхронизируются с участниками сервера
+SYNCED_FIELDS = ("nickname", "coach_tier")
+
+def sessions_count_subquery(session_type: str):
+    """
+    Количество сессий типа session_type пользователя (коррелировано с users.id)
+
+    Сессия засчитывается по принятой заявке. Заявки, отмеченные коучем как
+    неразобранные (skipped), и освобожденные слоты (rejected) не считаются.
+    """
+    return (
+        select(func.count(SessionRequest.id))
+        .join(Session, Session.id == SessionRequest.session_id)
+        .where(
+            SessionRequest.user_id == User.id,
+            SessionRequest.status == SessionRequestStatus.ACCEPTED.value,
+            Session.type == session_type,
+        )
+        .scalar_subquery()
+    )
+
+
+def sessions_counter_update(session_type: str, user_ids: List[int], delta: int):
+    """
+    Изменение счетчика сессий типа session_type на delta
+
+    Выполняется в транзакции, которая переводит заявки в статус accepted или
+    из него, поэтому счетчик совпадает с sessions_count_subquery.
+    """
+    field = SESSION_COUNTER_FIELDS[session_type]
+    return (
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values({field: func.coalesce(getattr(User, field), 0) + delta})
+        .execution_options(synchronize_session="fetch")
+    )
+
 
 class UserRepository(BaseRepository[User]):
     def __init__(self, session: AsyncSession):
         super().__init__(session, User)
 
     async def get_users_by_ids(self, user_ids: List[int]) -> List[User]:
-        query = select(User).options(
-            selectinload(User.session_requests).selectinload(SessionRequest.session)
-        ).where(User.id.in_(user_ids))
+        query = select(User).where(User.id.in_(user_ids))
         result = await self.session.execute(query)
         return result.scalars().all()
+
+    async def recompute_sessions_counts(self) -> int:
+        """
+        Пересчитывает счетчики сессий всех пользователей по sessions_count_subquery
+
+        Разовое восстановление (!recount_sessions): в обычной работе счетчики
+        меняются вместе со статусом заявок (SessionRepository). Перезаписывает
+        значения, заданные вручную или до ведения счетчиков.
+
+        Returns:
+            Количество обновленных пользователей
+        """
+        values = {
+            field: sessions_count_subquery(session_type)
+            for session_type, field in SESSION_COUNTER_FIELDS.items()
+        }
+        query = update(User).values(**values).execution_options(synchronize_session="fetch")
+        result = await self.session.execute(query)
+        await self._commit()
+        return result.rowcount
+
+    async def bulk_sync(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        """
+        Синхронизирует пользователей с участниками сервера пачками
+        
+        На каждую пачку выполняется один SELECT ... WHERE id IN и один
+        INSERT ... ON CONFLICT (id) DO UPDATE только для новых и изменившихся
+        пользователей. Каждая пачка фиксируется отдельно.
+        
+        Args:
+            rows: Данные пользователей: id, nickname, join_date, coach_tier
+            chunk_size: Размер пачки
+            
+        Returns:
+            Количество созданных или обновленных пользователей
+        """
+        written = 0
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            query = select(User.id, *(getattr(User, field) for field in SYNCED_FIELDS)).where(
+                User.id.in_([row["id"] for row in chunk])
+            )
+            result = await self.session.execute(query)
+            existing = {user_id: tuple(values) for user_id, *values in result.all()}
+            changed = [
+                row for row in chunk
+                if existing.get(row["id"]) != tuple(row.get(field) for field in SYNCED_FIELDS)
+            ]
+            if not changed:
+                continue
+            query = self._insert().values(changed)
+            query = query.on_conflict_do_update(
+                index_elements=[User.id],
+                set_={
+                    **{field: getattr(query.excluded, field) for field in SYNCED_FIELDS},
+                    "updated_at": get_current_time(),
+                },
+            )
+            await self.session.execute(query)
+            await self._commit()
+            written += len(changed)
+        return written
@@ -1,46 +1,145 @@
-from repositories.session_repo import SessionRepository
+from repositories.session_repo import SessionRepository, SessionLoad, SlotClaimStatus
+from repositories.base_repo import after_commit, unit_of_work
+from helpers.session_manager import SessionHeader, SessionState, session_manager
+from helpers.activity_tracker import ActivityBatch
+from helpers.user_cache import UserCache, user_cache as default_user_cache
 from models.session import Session, SessionRequest, SessionRequestStatus, SessionReview, UserSessionActivity
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, Iterable, List, Optional, Dict, Any, Tuple
 from logger import logger
 import pandas as pd
 from io import BytesIO
+import asyncio
 import discord
 from discord import Guild
 
+# Наибольшее число id в одном запросе guild.query_members
+QUERY_MEMBERS_LIMIT = 100
+
 class SessionService:
-    def __init__(self, session_repo: SessionRepository):
+    def __init__(self, session_repo: SessionRepository, user_cache: Optional[UserCache] = None):
+        """
+        Args:
+            session_repo: Репозиторий сессий
+            user_cache: Кэш пользователей, в котором сбрасываются пользователи
+                с измененными счетчиками сессий, по умолчанию общий
+        """
         self.session_repo = session_repo
+        self.user_cache = user_cache if user_cache is not None else default_user_cache
+
+    def transaction(self):
+        """Unit of work: изменения внутри блока фиксируются одним commit"""
+        return unit_of_work(self.session_repo.session)
+
+    def _write_through(self, callback):
+        """Применяет изменение к session_manager после фиксации в БД"""
+        after_commit(self.session_repo.session, callback)
+
+    def _invalidate_users(self, user_ids: Iterable[int]):
+        """
+        Сбрасывает пользователей в user_cache: смена статуса заявки меняет
+        их счетчики сессий в той же транзакции
+        """
+        user_ids = list(user_ids)
+        self.user_cache.invalidate(user_ids)
+        after_commit(self.session_repo.session, lambda: self.user_cache.invalidate(user_ids))
+
+    async def get_session_state(self, session_id: int) -> Optional[SessionState]:
+        """
+        Состояние открытой сессии из session_manager
+        
+        Если сессии нет в памяти, она читается из БД и сохраняется.
+        Для несуществующей или завершенной сессии возвращает None.
+        """
+        state = session_manager.get(session_id)
+        if state is not None:
+            return state
+        session = await self.get_session_by_id(session_id, load=SessionLoad.HEADER)
+        if not session or session.end_time is not None:
+            return None
+        requests = await self.session_repo.get_requests_by_session_ids([session_id])
+        return session_manager.load(session, requests)
+
+    async def get_session_header(self, session_id: int) -> Optional[SessionHeader]:
+        """Заголовок сессии: открытой - из session_manager, остальных - из БД"""
+        state = session_manager.get(session_id)
+        if state is not None:
+            return state.session
+        session = await self.get_session_by_id(session_id, load=SessionLoad.HEADER)
+        return SessionHeader.from_model(session) if session else None
 
-    async def get_all_sessions(self) -> List[Session]:
-        return await self.session_repo.get_all_sessions()
+    async def warm_session_state(self) -> int:
+        """Загружает в session_manager все открытые сессии двумя запросами"""
+        sessions = await self.session_repo.get_filtered(end_time=None)
+        requests = await self.session_repo.get_requests_by_session_ids([session.id for session in sessions])
+        by_session: Dict[int, List[SessionRequest]] = {}
+        for request in requests:
+            by_session.setdefault(request.session_id, []).append(request)
+        session_manager.clear()
+        for session in sessions:
+            session_manager.load(session, by_session.get(session.id, []))
+        session_manager.warmed = True
+        return len(sessions)
+
+    async def get_session_id_by_channel(self, channel_id: int) -> Optional[int]:
+        """Открытая сессия канала из индекса session_manager, до прогрева хранилища - из БД"""
+        session_id = session_manager.get_session_id_by_channel(channel_id)
+        if session_id is not None or session_manager.warmed:
+            return session_id
+        return await self.session_repo.get_open_session_id_by_channel(channel_id)
+
+    async def get_active_session_states_by_coach_id(self, coach_id: int) -> List[SessionState]:
+        """Активные сессии коуча из памяти, до прогрева хранилища - из БД"""
+        if session_manager.warmed:
+            return session_manager.get_by_coach_id(coach_id, active=True)
+        states = []
+        for session in await self.get_active_sessions_by_coach_id(coach_id, load=SessionLoad.HEADER):
+            state = await self.get_session_state(session.id)
+            if state:
+                states.append(state)
+        return states
+
+    async def get_all_sessions(self, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> List[Session]:
+        return await self.session_repo.get_all_sessions(load=load, include=include)
     
-    async def get_active_sessions(self) -> List[Session]:
-        return await self.session_repo.get_active_sessions()
+    async def get_latest_session(self, load: str = SessionLoad.HEADER, include: Optional[Iterable[str]] = None, **filters) -> Optional[Session]:
+        return await self.session_repo.get_latest_session(load=load, include=include, **filters)
     
-    async def get_active_sessions_by_coach_id(self, coach_id: int) -> List[Session]:
-        return await self.session_repo.get_active_sessions_by_coach_id(coach_id)
+    def stream_sessions(self, batch_size: int = 100, load: str = SessionLoad.HEADER, include: Optional[Iterable[str]] = None, **filters) -> AsyncIterator[Session]:
+        return self.session_repo.stream_sessions(batch_size=batch_size, load=load, include=include, **filters)
     
-    async def get_active_sessions_by_user_id(self, user_id: int) -> List[Session]:
-        return await self.session_repo.get_active_sessions_by_user_id(user_id)
+    async def get_active_sessions(self, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> List[Session]:
+        return await self.session_repo.get_active_sessions(load=load, include=include)
     
-    async def get_session_by_id(self, session_id: int) -> Optional[Session]:
-        return await self.session_repo.get_by_id(session_id)
-
-    async def get_active_sessions_by_coach_id(self, coach_id: int) -> List[Session]:
-        return await self.session_repo.get_active_sessions_by_coach_id(coach_id)
+    async def get_active_sessions_by_coach_id(self, coach_id: int, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> List[Session]:
+        return await self.session_repo.get_active_sessions_by_coach_id(coach_id, load=load, include=include)
+    
+    async def get_active_sessions_by_user_id(self, user_id: int, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> List[Session]:
+        return await self.session_repo.get_active_sessions_by_user_id(user_id, load=load, include=include)
+    
+    async def get_session_by_id(self, session_id: int, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> Optional[Session]:
+        return await self.session_repo.get_by_id(session_id, load=load, include=include)
 
-    async def get_last_created_session_by_coach_id(self, coach_id: int) -> Optional[Session]:
-        return await self.session_repo.get_last_created_session_by_coach_id(coach_id)
+    async def get_last_created_session_by_coach_id(self, coach_id: int, load: str = SessionLoad.FULL, include: Optional[Iterable[str]] = None) -> Optional[Session]:
+        return await self.session_repo.get_last_created_session_by_coach_id(coach_id, load=load, include=include)
     
     async def create_session(self, coach_id: int, **kwargs) -> Session:
-        return await self.session_repo.create(coach_id=coach_id, **kwargs)
+        session = await self.session_repo.create(coach_id=coach_id, **kwargs)
+        header = SessionHeader.from_model(session)
+        self._write_through(lambda: session_manager.load(header))
+        return session
 
     async def update_session(self, session_id: int, **kwargs) -> Session:
-        return await self.session_repo.update(session_id, **kwargs)
+        session = await self.session_repo.update(session_id, **kwargs)
+        if session:
+            header = SessionHeader.from_model(session)
+            self._write_through(lambda: session_manager.update_session(header))
+        return session
 
     async def delete_session(self, session_id: int) -> Session:
-        return await self.session_repo.delete(session_id)
+        deleted = await self.session_repo.delete(session_id)
+        self._write_through(lambda: session_manager.discard(session_id))
+        return deleted
     
     async def get_request_by_id(self, request_id: int) -> Optional[SessionRequest]:
         return await self.session_repo.get_request_by_id(request_id)
@@ -54,26 +153,62 @@ class SessionService:
     async def get_requests_by_session_id(self, session_id: int) -> List[SessionRequest]:
         return await self.session_repo.get_requests_by_session_id(session_id)
     
-    async def create_request(self, session_id: int, user_id: int) -> SessionRequest:
-        return await self.session_repo.create_request(session_id, user_id, SessionRequestStatus.PENDING.value)
+    async def create_request(self, session_id: int, user_id: int, idempotent: bool = False) -> SessionRequest | Tuple[SessionRequest, bool]:
+        result = await self.session_repo.create_request(session_id, user_id, SessionRequestStatus.PENDING.value, idempotent=idempotent)
+        request = result[0] if idempotent else result
+        self._write_through(lambda: session_manager.apply_requests([request]))
+        return result
+
+    async def create_requests(self, session_id: int, user_ids: List[int]) -> List[SessionRequest]:
+        rows = [
+            {"session_id": session_id, "user_id": user_id, "status": SessionRequestStatus.PENDING.value}
+            for user_id in user_ids
+        ]
+        requests = await self.session_repo.create_requests(rows)
+        self._write_through(lambda: session_manager.apply_requests(requests))
+        return requests
 
     async def update_request(self, request_id: int, **kwargs) -> SessionRequest:
         logger.info(f"Updating request {request_id} with {kwargs}")
         try:
-            return await self.session_repo.update_request(request_id, **kwargs)
+            request = await self.session_repo.update_request(request_id, **kwargs)
         except Exception as e:
             logger.error(f"Error updating request {request_id}: {e.with_traceback()}")
             raise e
+        if request:
+            self._write_through(lambda: session_manager.apply_requests([request]))
+            if "status" in kwargs:
+                self._invalidate_users([request.user_id])
+        return request
     
     async def update_request_status(self, request_id: int, status: SessionRequestStatus) -> SessionRequest:
-        return await self.session_repo.update_request(request_id, status=status.value)
+        return await self.update_request(request_id, status=status.value)
+    
+    async def claim_slot(self, session_id: int, user_id: int) -> Tuple[str, Optional[int]]:
+        status, slot_number = await self.session_repo.claim_slot(session_id, user_id)
+        if status == SlotClaimStatus.CLAIMED:
+            self._write_through(lambda: session_manager.set_slot(session_id, user_id, slot_number))
+            self._invalidate_users([user_id])
+        return status, slot_number
     
+    async def bulk_assign_slots(self, session_id: int, accepted: List[Tuple[int, int]], rejected_ids: List[int]) -> List[SessionRequest]:
+        requests = await self.session_repo.bulk_assign_slots(session_id, accepted, rejected_ids)
+        self._write_through(lambda: session_manager.apply_requests(requests))
+        self._invalidate_users(request.user_id for request in requests)
+        return requests
+
     async def delete_request(self, request_id: int) -> SessionRequest:
-        return await self.session_repo.delete_request(request_id)
+        deleted = await self.session_repo.delete_request(request_id)
+        if deleted:
+            self._write_through(lambda: session_manager.remove_request(request_id))
+        return deleted
 
     async def create_review(self, session_id: int, user_id: int, rating: int) -> SessionReview:
         return await self.session_repo.create_review(session_id, user_id, rating=rating)
     
+    async def upsert_review(self, session_id: int, user_id: int, rating: int) -> SessionReview:
+        return await self.session_repo.upsert_review(session_id, user_id, rating)
+    
     async def get_reviews_by_session_id(self, session_id: int) -> List[SessionReview]:
         return await self.session_repo.get_reviews_by_session_id(session_id)
 
@@ -90,7 +225,7 @@ class SessionService:
         return await self.session_repo.delete_review(review_id)
 
     async def get_session_data(self, session_id: int) -> Optional[Dict[str, Any]]:
-        session = await self.get_session_by_id(session_id)
+        session = await self.get_session_by_id(session_id, load=SessionLoad.HEADER)
         if not session:
             return None
         requests = await self.get_requests_by_session_id(session_id)
@@ -106,6 +241,9 @@ class SessionService:
     async def create_user_session_activity(self, session_id: int, user_id: int, **kwargs) -> UserSessionActivity:
         return await self.session_repo.create_user_session_activity(session_id, user_id, **kwargs)
 
+    async def create_user_session_activities(self, rows: List[Dict[str, Any]]) -> List[UserSessionActivity]:
+        return await self.session_repo.create_user_session_activities(rows)
+
     async def get_user_session_activity_by_id(self, activity_id: int) -> Optional[UserSessionActivity]:
         return await self.session_repo.get_user_session_activity_by_id(activity_id)
     
@@ -124,6 +262,28 @@ class SessionService:
             return {}
         return activities
 
+    async def apply_activity_batch(self, batch: ActivityBatch, heartbeat_at: Optional[datetime] = None) -> Tuple[int, int]:
+        """
+        Записывает пачку переходов ActivityTracker одной транзакцией
+
+        Args:
+            batch: Пачка переходов
+            heartbeat_at: Если передано, открытые активности отмечаются этим временем
+
+        Returns:
+            (завершено строк, вставлено строк)
+        """
+        async with self.transaction():
+            closed = await self.session_repo.close_user_activities(batch.closes)
+            created = await self.session_repo.create_user_session_activities(batch.rows)
+            if heartbeat_at is not None:
+                await self.session_repo.touch_open_activities(heartbeat_at)
+        return closed, len(created)
+
+    async def close_dangling_activities(self) -> int:
+        """Закрывает активности, оставшиеся is_active после аварийной остановки"""
+        return await self.session_repo.close_dangling_activities()
+
     async def get_active_user_activities(self, session_id: int, user_id: int) -> List[UserSessionActivity]:
         """Получает активные (незавершённые) активности пользователя"""
         return await self.session_repo.get_active_user_activities(session_id, user_id)
@@ -148,15 +308,8 @@ class SessionService:
         return sum(activity.duration for activity in activities if not activity.is_active)
 
     async def calculate_session_activities(self, session_id: int) -> Dict[int, float]:
-        activities = await self.get_session_activities(session_id)
-        activities_by_users = {}
-        for activity in activities:
-            if activity.user_id not in activities_by_users:
-                activities_by_users[activity.user_id] = []
-            activities_by_users[activity.user_id].append(activity)
-        for user_id in activities_by_users:
-            activities_by_users[user_id] = await self.get_user_total_session_time(activities_by_users[user_id])
-        return activities_by_users
+        """Время каждого пользователя в сессии, включая незавершенные активности"""
+        return await self.session_repo.get_session_durations(session_id, datetime.now())
 
     async def calculate_user_activity(self, session_id: int, user_id: int) -> float:
         activities = await self.get_user_session_activities(session_id, user_id)
@@ -169,9 +322,38 @@ class SessionService:
             raise ValueError("Invalid session type")
         return await self.session_repo.get_user_sessions_count(user_id, session_type)
 
-    async def get_queue_participants(self, guild: Guild, session_id: int) -> List[discord.Member]:
-        requests = await self.get_requests_by_session_id(session_id)
-        requests = [request for request in requests if request.status == SessionRequestStatus.PENDING.value]
-        user_ids = [request.user_id for request in requests]
-        members = [member for member in guild.members if member.id in user_ids]
-        return members
+    async def get_queue_user_ids(self, session_id: int) -> List[int]:
+        """id участников очереди в порядке подачи заявок"""
+        state = await self.get_session_state(session_id)
+        return list(state.pending_user_ids) if state else []
+
+    @staticmethod
+    async def fetch_members(guild: Guild, user_ids: List[int]) -> List[discord.Member]:
+        """
+        Участники сервера по id с сохранением порядка
+
+        Участники берутся из кэша сервера, отсутствующие запрашиваются у Discord
+        пачками query_members. Обращается только к Discord, поэтому вызывается
+        после закрытия скоупа БД. Покинувшие сервер и не полученные из-за
+        ошибки Discord пропускаются.
+        """
+        found: Dict[int, discord.Member] = {}
+        missing = []
+        for user_id in user_ids:
+            member = guild.get_member(user_id)
+            if member is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = member
+        for start in range(0, len(missing), QUERY_MEMBERS_LIMIT):
+            chunk = missing[start:start + QUERY_MEMBERS_LIMIT]
+            try:
+                members = await guild.query_members(user_ids=chunk, limit=len(chunk))
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                logger.warning(f"Error fetching queue members {chunk} in guild {guild.id}: {e}")
+                continue
+            found.update((member.id, member) for member in members)
+        not_found = [user_id for user_id in missing if user_id not in found]
+        if not_found:
+            logger.warning(f"Queue members {not_found} not found in guild {guild.id}")
+        return [found[user_id] for user_id in user_ids if user_id in found]
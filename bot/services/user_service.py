@@ -1,24 +1,81 @@
 from repositories.user_repo import UserRepository
+from repositories.base_repo import after_commit
+from helpers.user_cache import UserCache, UserSnapshot, user_cache
 from models.user import User
-from typing import List
+from typing import Any, Dict, Iterable, List, Optional
 class UserService:
-    def __init__(self, user_repo: UserRepository):
+    def __init__(self, user_repo: UserRepository, cache: Optional[UserCache] = None, fill_cache: bool = True):
+        """
+        Args:
+            user_repo: Репозиторий пользователей
+            cache: Кэш пользователей, по умолчанию общий для процесса
+            fill_cache: Сохранять прочитанные строки в кэш. Выключается для реплики:
+                она может отставать и вернуть строку до последней записи
+        """
         self.user_repo = user_repo
+        self.cache = cache if cache is not None else user_cache
+        self.fill_cache = fill_cache
+
+    def _remember(self, user: User) -> UserSnapshot:
+        if self.fill_cache:
+            return self.cache.put(user)
+        return UserSnapshot.from_model(user)
+
+    def _invalidate(self, user_ids: Iterable[int]):
+        """Сбрасывает кэш сразу и повторно после фиксации, чтобы не закэшировать старую строку"""
+        user_ids = list(user_ids)
+        self.cache.invalidate(user_ids)
+        after_commit(self.user_repo.session, lambda: self.cache.invalidate(user_ids))
+
+    async def get_user(self, user_id: int) -> Optional[UserSnapshot]:
+        user = self.cache.get(user_id)
+        if user is None:
+            user = await self.user_repo.get_by_id(user_id)
+            if user is not None:
+                user = self._remember(user)
+        return user
 
-    async def get_user(self, user_id: int) -> User:
-        return await self.user_repo.get_by_id(user_id)
-    
     async def create_user(self, user_id: int, nickname: str, **kwargs) -> User:
-        return await self.user_repo.create(id=user_id, nickname=nickname, **kwargs)
-    
+        user = await self.user_repo.create(id=user_id, nickname=nickname, **kwargs)
+        self._invalidate([user_id])
+        return user
+
     async def update_user(self, user_id: int, **kwargs) -> User:
-        return await self.user_repo.update(user_id, **kwargs)
-    
+        user = await self.user_repo.update(user_id, **kwargs)
+        self._invalidate([user_id])
+        return user
+
     async def delete_user(self, user_id: int) -> bool:
-        return await self.user_repo.delete(user_id)
-    
+        deleted = await self.user_repo.delete(user_id)
+        self._invalidate([user_id])
+        return deleted
+
     async def get_all_users(self) -> list[User]:
         return await self.user_repo.get_all()
 
-    async def get_users_by_ids(self, user_ids: List[int]) -> List[User]:
-        return await self.user_repo.get_users_by_ids(user_ids)
+    async def get_users_by_ids(self, user_ids: List[int]) -> List[UserSnapshot]:
+        """Пользователи по id: из кэша, в БД запрашиваются только промахи"""
+        found, missing = self.cache.get_many(user_ids)
+        if missing:
+            for user in await self.user_repo.get_users_by_ids(missing):
+                found[user.id] = self._remember(user)
+        return [found[user_id] for user_id in dict.fromkeys(user_ids) if user_id in found]
+
+    async def update_users(self, user_ids: List[int], **kwargs) -> int:
+        updated = await self.user_repo.update_many(user_ids, **kwargs)
+        self._invalidate(user_ids)
+        return updated
+
+    async def recompute_sessions_counts(self) -> int:
+        updated = await self.user_repo.recompute_sessions_counts()
+        self.cache.clear()
+        after_commit(self.user_repo.session, self.cache.clear)
+        return updated
+
+    async def bulk_sync(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        synced = await self.user_repo.bulk_sync(rows, chunk_size=chunk_size)
+        self._invalidate(row["id"] for row in rows)
+        return synced
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
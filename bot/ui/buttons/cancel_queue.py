@@ -2,59 +2,65 @@ import discord
 from discord.ui import Button
 from models.session import Session, SessionRequestStatus
 from ui.embeds import SessionQueueEmbed
-from services import SessionService, UserService
+from factory import ServiceFactory, get_service_factory
+from services import SessionService
 from logger import logger
+from database.query_counter import track_queries
 
 class CancelQueueButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="❌ Выйти", style=discord.ButtonStyle.danger, custom_id="cancel_session")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         try:
             guild = interaction.guild
-            all_guild_members = guild.members # Store all members for reliable filtering
             info_message = interaction.message
 
-            participant = await self.user_service.get_user(interaction.user.id)
-            if not participant:
-                participant = await self.user_service.create_user(interaction.user.id, interaction.user.name, join_date=interaction.user.joined_at.replace(tzinfo=None))
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                user_service = await factory.get_service("user")
 
-            request = await self.session_service.get_request_by_user_id(self.session.id, participant.id)
+                participant = await user_service.get_user(interaction.user.id)
+                if not participant:
+                    participant = await user_service.create_user(interaction.user.id, interaction.user.name, join_date=interaction.user.joined_at.replace(tzinfo=None))
 
+                state = await session_service.get_session_state(self.session.id)
+                request = state.get_request(participant.id) if state else None
+
+                cancelled = False
+                queue_user_ids = []
+                if request:
+                    if request.status == SessionRequestStatus.PENDING.value:
+                        await session_service.delete_request(request.id)
+                        cancelled = True
+                    queue_user_ids = await session_service.get_queue_user_ids(self.session.id)
+
+            # Обращения к Discord выполняются после закрытия скоупа БД. Загрузка
+            # участников очереди может не уложиться в 3 секунды на ответ: сначала defer
+            await interaction.response.defer(ephemeral=True)
             if not request:
-                await interaction.response.send_message("Вы не присоединились к этой сессии", ephemeral=True)
+                await interaction.followup.send("Вы не присоединились к этой сессии", ephemeral=True)
                 return
 
-            response_message_content = ""
-            refresh_embed = False
-
-            if request.status == SessionRequestStatus.PENDING.value:
-                await self.session_service.delete_request(request.id)
+            if cancelled:
                 response_message_content = "Вы отменили свою заявку на участие в сессии."
-                refresh_embed = True
             else:
                 response_message_content = f"Ваша заявка не может быть отменена, так как её текущий статус: '{request.status}'. Очередь не была изменена для вас."
-                # Embed will still be refreshed to show current state, as per original logic.
-                refresh_embed = True
 
             # Always refresh the embed to show the current state of the queue
             # This was the original behavior: embed is updated regardless of whether the specific user's request was PENDING.
-            current_session_requests = await self.session_service.get_requests_by_session_id(self.session.id)
-            pending_user_ids = [req.user_id for req in current_session_requests if req.status == SessionRequestStatus.PENDING.value]
-            
-            # Filter from the complete list of guild members
-            actual_pending_members = [member for member in all_guild_members if member.id in pending_user_ids]
-            
-            coach = await guild.fetch_member(self.session.coach_id)
+            actual_pending_members = await SessionService.fetch_members(guild, queue_user_ids)
+
+            coach = guild.get_member(self.session.coach_id) or await guild.fetch_member(self.session.coach_id)
             embed = SessionQueueEmbed(coach, self.session.id)
             embed.update_queue(actual_pending_members)
             await info_message.edit(embed=embed)
 
             # Send the single, appropriate response to the interaction
-            await interaction.response.send_message(response_message_content, ephemeral=True)
+            await interaction.followup.send(response_message_content, ephemeral=True)
 
         except discord.Forbidden:
             # Check if interaction already responded to, common in error handling
@@ -1,54 +1,67 @@
 import discord
 from discord.ui import Button
-from models.session import Session, SessionRequestStatus
+from models.session import Session
 from ui.embeds import SessionQueueEmbed
-from services import SessionService, UserService
+from factory import ServiceFactory, get_service_factory
+from services import SessionService
 from logger import logger
+from database.query_counter import track_queries
 
 class JoinQueueButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="🏃 В очередь", style=discord.ButtonStyle.success, custom_id="join_session")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
         
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         try:
             # if interaction.user.id == self.session.coach_id:
             #     await interaction.response.send_message("Вы не можете присоединиться к своей сессии", ephemeral=True)
             #     return
             guild = interaction.guild
-            members = guild.members
             info_message = interaction.message
 
-            participant = await self.user_service.get_user(interaction.user.id)
-            if not participant:
-                participant = await self.user_service.create_user(interaction.user.id, interaction.user.name, join_date=interaction.user.joined_at.replace(tzinfo=None))
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                user_service = await factory.get_service("user")
 
-            request = await self.session_service.get_request_by_user_id(self.session.id, participant.id)
-            if request:
-                await interaction.response.send_message("Вы уже в очереди", ephemeral=True)
+                participant = await user_service.get_user(interaction.user.id)
+                if not participant:
+                    participant = await user_service.create_user(interaction.user.id, interaction.user.name, join_date=interaction.user.joined_at.replace(tzinfo=None))
+
+                request, created = await session_service.create_request(self.session.id, participant.id, idempotent=True)
+                queue_user_ids = await session_service.get_queue_user_ids(self.session.id) if created else []
+
+            # Обращения к Discord выполняются после закрытия скоупа БД. Загрузка
+            # участников очереди может не уложиться в 3 секунды на ответ: сначала defer
+            await interaction.response.defer(ephemeral=True)
+            if not created:
+                await interaction.followup.send("Вы уже в очереди", ephemeral=True)
                 return
 
-            request = await self.session_service.create_request(self.session.id, participant.id)
-            requests = await self.session_service.get_requests_by_session_id(self.session.id)
-            requests = [request for request in requests if request.status == SessionRequestStatus.PENDING.value]
-            user_ids = [request.user_id for request in requests]
-            members = [member for member in members if member.id in user_ids]
+            members = await SessionService.fetch_members(guild, queue_user_ids)
 
-            coach = await guild.fetch_member(self.session.coach_id)
+            coach = guild.get_member(self.session.coach_id) or await guild.fetch_member(self.session.coach_id)
             embed = SessionQueueEmbed(coach, self.session.id)
             embed.update_queue(members)
 
             await info_message.edit(embed=embed)
-            await interaction.response.send_message("Вы присоединились к сессии", ephemeral=True)
+            await interaction.followup.send("Вы присоединились к сессии", ephemeral=True)
         except discord.Forbidden:
-            await interaction.response.send_message("У меня нет прав на редактирование этого сообщения", ephemeral=True)
+            await self._reply(interaction, "У меня нет прав на редактирование этого сообщения")
         except discord.HTTPException:
-            await interaction.response.send_message("Произошла ошибка при присоединении к сессии", ephemeral=True)
+            await self._reply(interaction, "Произошла ошибка при присоединении к сессии")
         except discord.NotFound:
-            await interaction.response.send_message("Сообщение не найдено", ephemeral=True)
+            await self._reply(interaction, "Сообщение не найдено")
         except Exception as e:
             import traceback
             logger.error(f"Error joining session: {traceback.format_exc()}")
-            await interaction.response.send_message("Произошла ошибка при присоединении к сессии", ephemeral=True)
+            await self._reply(interaction, "Произошла ошибка при присоединении к сессии")
+
+    async def _reply(self, interaction: discord.Interaction, message: str):
+        """Ответ на взаимодействие до и после defer"""
+        if not interaction.response.is_done():
+            await interaction.response.send_message(message, ephemeral=True)
+        else:
+            await interaction.followup.send(message, ephemeral=True)
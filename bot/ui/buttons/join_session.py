@@ -1,17 +1,19 @@
 import discord
 from discord.ui import Button
-from models.session import Session, SessionRequestStatus
+from models.session import Session
+from repositories import SlotClaimStatus
 from ui.embeds import SessionEmbed
-from services import SessionService, UserService
+from factory import ServiceFactory, get_service_factory
 from logger import logger
+from database.query_counter import track_queries
 
 class JoinSessionButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="Присоединиться", style=discord.ButtonStyle.success, custom_id="quick_join")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
         try:
@@ -20,24 +22,20 @@ class JoinSessionButton(Button):
                 await interaction.followup.send("Вы не можете присоединиться к своей сессии", ephemeral=True)
                 return
             message = interaction.message
-            requests = await self.session_service.get_accepted_requests(self.session.id)
-            accepted_requests = [request for request in requests if request.status == SessionRequestStatus.ACCEPTED.value]
-            if len(accepted_requests) >= self.session.max_slots:
-                await interaction.followup.send("В очереди уже достаточно участников", ephemeral=True)
-                return
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                status, _ = await session_service.claim_slot(self.session.id, user.id)
+                state = await session_service.get_session_state(self.session.id) if status == SlotClaimStatus.CLAIMED else None
+                accepted_user_ids = state.accepted_user_ids if state else []
 
-            request = await self.session_service.get_request_by_user_id(self.session.id, user.id)
-            if request and request.status == SessionRequestStatus.ACCEPTED.value:
+            # Обращения к Discord выполняются после закрытия скоупа БД
+            if status == SlotClaimStatus.ALREADY_JOINED:
                 await interaction.followup.send("Вы уже участвуете в сессии", ephemeral=True)
                 return
-            next_slot_number = len(accepted_requests) + 1
-            if request and (request.status == SessionRequestStatus.REJECTED.value or request.status == SessionRequestStatus.PENDING.value):
-                await self.session_service.update_request(request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=next_slot_number)
-            if not request:
-                request = await self.session_service.create_request(self.session.id, user.id)
-                await self.session_service.update_request(request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=next_slot_number)
-            requests = await self.session_service.get_accepted_requests(self.session.id)
-            participants = [interaction.guild.get_member(request.user_id) for request in requests]
+            if status == SlotClaimStatus.FULL:
+                await interaction.followup.send("В очереди уже достаточно участников", ephemeral=True)
+                return
+            participants = [interaction.guild.get_member(user_id) for user_id in accepted_user_ids]
             await interaction.followup.send(f"Вы присоединились к сессии", ephemeral=True)
             embed = SessionEmbed(participants, self.session.id, self.session.max_slots)
             await message.edit(embed=embed)
@@ -2,23 +2,31 @@ import discord
 from discord.ui import Button
 from models.session import Session, SessionRequestStatus
 from ui.embeds import SessionEmbed
-from services import SessionService, UserService
+from factory import ServiceFactory, get_service_factory
+from services import SessionService
 from logger import logger
+from database.query_counter import track_queries
 
 class QuitSessionButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="Освободить слот", style=discord.ButtonStyle.danger, custom_id="quit_session")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
         try:
             # Используем тот же алгоритм, что и в командах
-            success, error_msg = await self._remove_user_from_session(interaction)
-            
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service("session")
+                success, error_msg, accepted_user_ids = await self._remove_user_from_session(interaction, session_service)
+
+            # Обращения к Discord выполняются после закрытия скоупа БД
             if success:
+                participants = [interaction.guild.get_member(user_id) for user_id in accepted_user_ids]
+                embed = SessionEmbed(participants, self.session.id, self.session.max_slots)
+                await interaction.message.edit(embed=embed)
                 await interaction.followup.send("Вы успешно покинули сессию", ephemeral=True)
             else:
                 await interaction.followup.send(error_msg, ephemeral=True)
@@ -27,34 +35,36 @@ class QuitSessionButton(Button):
             logger.error(f"Error in QuitSessionButton: {e}")
             await interaction.followup.send("Произошла ошибка при выходе из сессии", ephemeral=True)
 
-    async def _remove_user_from_session(self, interaction: discord.Interaction) -> tuple[bool, str]:
-        """Приватный метод для удаления пользователя из сессии (аналогичен основному классу)."""
+    async def _remove_user_from_session(self, interaction: discord.Interaction, session_service: SessionService) -> tuple[bool, str, list[int]]:
+        """
+        Приватный метод для удаления пользователя из сессии (аналогичен основному классу).
+
+        Работает только с БД; возвращает id оставшихся участников для обновления embed.
+        """
         try:
-            guild = interaction.guild
             user_id = interaction.user.id
-            request = await self.session_service.get_request_by_user_id(self.session.id, user_id)
+            state = await session_service.get_session_state(self.session.id)
+            request = state.get_request(user_id) if state else None
             if not request or request.status != SessionRequestStatus.ACCEPTED.value:
-                return False, "Вы не участвуете в этой сессии"
-            
-            await self.session_service.update_request(
-                request.id, 
-                status=SessionRequestStatus.REJECTED.value, 
-                slot_number=None
-            )
+                return False, "Вы не участвуете в этой сессии", []
+            if request.id is None:
+                request = await session_service.get_request_by_user_id(self.session.id, user_id)
             
-            # Пересчитываем слоты
-            accepted_requests = await self.session_service.get_accepted_requests(self.session.id)
-            for idx, req in enumerate(accepted_requests):
-                if req.slot_number != idx + 1:
-                    await self.session_service.update_request(req.id, slot_number=idx + 1)
-            
-            # Обновляем embed
-            participants = [guild.get_member(req.user_id) for req in accepted_requests]
-            embed = SessionEmbed(participants, self.session.id, self.session.max_slots)
-            await interaction.message.edit(embed=embed)
-            
-            return True, ""
+            async with session_service.transaction():
+                await session_service.update_request(
+                    request.id, 
+                    status=SessionRequestStatus.REJECTED.value, 
+                    slot_number=None
+                )
+                
+                # Пересчитываем слоты
+                accepted_requests = await session_service.get_accepted_requests(self.session.id)
+                for idx, req in enumerate(accepted_requests):
+                    if req.slot_number != idx + 1:
+                        await session_service.update_request(req.id, slot_number=idx + 1)
+
+            return True, "", state.accepted_user_ids
             
         except Exception as e:
             logger.error(f"Error removing user {user_id} from session: {e}")
-            return False, "Произошла ошибка при удалении из сессии"
+            return False, "Произошла ошибка при удалении из сессии", []
@@ -2,31 +2,27 @@ import discord
 from discord.ui import View, Button
 from discord.ext import commands
 from models import Session, SessionRequestStatus
-from services import SessionService, DiscordService, UserService
-from factory import ServiceFactory
+from factory import ServiceFactory, get_service_factory
 from logger import logger
+from database.query_counter import track_queries
 from datetime import datetime, timedelta
 from .buttons import JoinQueueButton, CancelQueueButton, JoinSessionButton, QuitSessionButton
 
 class SessionQueueView(View):
-    def __init__(self, session: Session, session_service: SessionService, discord_service: DiscordService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(timeout=None)
         self.session = session
-        self.session_service = session_service
-        self.discord_service = discord_service
-        self.user_service = user_service
-        self.add_item(JoinQueueButton(session, session_service, user_service))
-        self.add_item(CancelQueueButton(session, session_service, user_service))
+        self.service_factory = service_factory
+        self.add_item(JoinQueueButton(session, service_factory))
+        self.add_item(CancelQueueButton(session, service_factory))
 
 class SessionView(View):
-    def __init__(self, session: Session, session_service: SessionService, discord_service: DiscordService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(timeout=None)
         self.session = session
-        self.session_service = session_service
-        self.discord_service = discord_service
-        self.user_service = user_service
-        self.add_item(JoinSessionButton(session, session_service, user_service))
-        self.add_item(QuitSessionButton(session, session_service, user_service))
+        self.service_factory = service_factory
+        self.add_item(JoinSessionButton(session, service_factory))
+        self.add_item(QuitSessionButton(session, service_factory))
 
 
 class EndSessionConfirmationView(discord.ui.View):
@@ -62,23 +58,16 @@ class AllParticipantsReviewedButton(Button):
         self.service_factory = service_factory
         self.bot = bot
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer() # Подтверждаем получение взаимодействия
         if not interaction.user.id == self.session.coach_id:
             await interaction.followup.send("Вы не можете завершить сессию, так как не являетесь коучем.", ephemeral=True)
             return
         try:
-            session_service = await self.service_factory.get_service('session')
-            user_service = await self.service_factory.get_service('user')
+            # Счетчики сессий принятых участников уже увеличены при распределении слотов
             await interaction.followup.send(f"Сессия `{self.session.id}` успешно завершена. Все участники были разобраны.", ephemeral=True)
-            requests = await session_service.get_requests_by_session_id(self.session.id)
-            for request in requests:
-                if request.status == SessionRequestStatus.ACCEPTED.value:
-                    user = await user_service.get_user(request.user_id)
-                    field_name = "total_replay_sessions" if self.session.type == "replay" else "total_creative_sessions"
-                    field = getattr(user, field_name)
-                    await user_service.update_user(user.id, **{field_name: field + 1})
-            
+
             # Отключаем кнопки в исходном сообщении
             if self.view:
                 await self.view.disable_all_items()
@@ -97,6 +86,7 @@ class NotAllParticipantsReviewedButton(Button):
         self.session = session
         self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         logger.info(interaction)
         if not interaction.user.id == self.session.coach_id:
@@ -108,26 +98,29 @@ class NotAllParticipantsReviewedButton(Button):
             # Здесь будет логика для отображения UserSelect
             # Пока просто заглушка
             
-            user_service = await self.service_factory.get_service('user')
-            session_service = await self.service_factory.get_service('session')
-            logger.info(f"Session: {self.session}")
-            requests = await session_service.get_requests_by_session_id(self.session.id)
-            logger.info(f"Requests: {requests}")
-            logger.info(f"Guild: {interaction.guild}")
-            # Мы заинтересованы в тех, кто был принят или хотя бы ожидал
-            accepted_or_pending_user_ids = [
-                req.user_id for req in requests 
-                if req.status in [SessionRequestStatus.ACCEPTED.value, SessionRequestStatus.PENDING.value]
-            ]
-            
+            async with get_service_factory(self.service_factory) as factory:
+                user_service = await factory.get_service('user')
+                session_service = await factory.get_service('session')
+                logger.info(f"Session: {self.session}")
+                requests = await session_service.get_requests_by_session_id(self.session.id)
+                logger.info(f"Requests: {requests}")
+                logger.info(f"Guild: {interaction.guild}")
+                # Мы заинтересованы в тех, кто был принят или хотя бы ожидал
+                accepted_or_pending_user_ids = [
+                    req.user_id for req in requests 
+                    if req.status in [SessionRequestStatus.ACCEPTED.value, SessionRequestStatus.PENDING.value]
+                ]
+                participants = (
+                    await user_service.get_users_by_ids(accepted_or_pending_user_ids)
+                    if accepted_or_pending_user_ids else []
+                )
+
             if not accepted_or_pending_user_ids:
                 await interaction.followup.send("В сессии нет участников для выбора.", ephemeral=True)
                 if self.view:
                     await self.view.disable_all_items()
                     await interaction.edit_original_response(view=self.view)
                 return
-
-            participants = await user_service.get_users_by_ids(accepted_or_pending_user_ids)
             
             # Преобразуем пользователей из БД в discord.Member или discord.User объекты для UserSelect
             guild_members = []
@@ -209,11 +202,9 @@ class UnreviewedParticipantsSelectView(View):
         # Автоматически завершаем сессию, как если бы нажали "Да, все разобраны"
         # Это спорное поведение, возможно, лучше просто ничего не делать или запросить подтверждение.
         # Пока оставим так для простоты.
-        session_service = await self.service_factory.get_service('session')
-        discord_service = await self.service_factory.get_service('discord')
-        guild = self.original_interaction.guild # Получаем guild из interaction
-
-        await session_service.update_session(self.session.id, is_active=False)
+        async with get_service_factory(self.service_factory) as factory:
+            session_service = await factory.get_service('session')
+            await session_service.update_session(self.session.id, is_active=False)
 
 # Меняем UserSelect на StringSelect, а точнее на правильный discord.ui.Select
 class UnreviewedParticipantsStringSelect(discord.ui.Select):
@@ -245,6 +236,7 @@ class UnreviewedParticipantsStringSelect(discord.ui.Select):
             options=options
         )
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         # self.values будет списком строк (ID пользователей), которые были выбраны
         if "no_participants" in self.values:
@@ -259,6 +251,7 @@ class ConfirmUnreviewedSelectionButton(Button):
         super().__init__(label="Подтвердить выбор и завершить", style=discord.ButtonStyle.primary, custom_id="confirm_unreviewed_selection")
         self.parent_view = parent_view
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
         
@@ -267,65 +260,61 @@ class ConfirmUnreviewedSelectionButton(Button):
         service_factory = self.parent_view.service_factory
         selected_user_ids = self.parent_view.selected_user_ids # <--- Получаем актуальное значение здесь
 
-        session_service = await service_factory.get_service('session')
-        user_service = await service_factory.get_service('user') # Убедимся, что user_service тоже получаем из factory
+        async with get_service_factory(service_factory) as factory:
+            session_service = await factory.get_service('session')
+            user_service = await factory.get_service('user')
         
-        logger.info(f"Selected user IDs: {selected_user_ids}")
-        unreviewed_db_user_ids = [int(uid) for uid in selected_user_ids]
-        logger.info(f"Session {session.id}: Coach indicated users {unreviewed_db_user_ids} were not reviewed.")
+            logger.info(f"Selected user IDs: {selected_user_ids}")
+            unreviewed_db_user_ids = [int(uid) for uid in selected_user_ids]
+            logger.info(f"Session {session.id}: Coach indicated users {unreviewed_db_user_ids} were not reviewed.")
         
-        for user_id_str in selected_user_ids:
-            try:
-                logger.info(f"User ID: {user_id_str}")
-                user_id = int(user_id_str)
-                logger.info(f"User ID: {user_id}")
-                request = await session_service.get_request_by_user_id(session.id, user_id)
-                logger.info(f"Request: {request}")
-                if request:
-                    await session_service.update_request_status(request.id, SessionRequestStatus.SKIPPED)
-            except Exception as e:
-                # Используйте e.with_traceback(None) или просто e, если traceback уже залогирован или не нужен в сообщении
-                logger.error(f"Error updating request status for user {user_id_str}: {e}", exc_info=True)
-
-
-        await session_service.update_session(session.id, is_active=False)
+            # Ошибка любого обновления откатывает весь блок: после сбоя запроса
+            # транзакция Postgres прервана, и продолжать ее нельзя
+            async with factory.transaction():
+                for user_id in unreviewed_db_user_ids:
+                    request = await session_service.get_request_by_user_id(session.id, user_id)
+                    logger.info(f"Request: {request}")
+                    if request:
+                        await session_service.update_request_status(request.id, SessionRequestStatus.SKIPPED)
+
+                await session_service.update_session(session.id, is_active=False)
         
-        requests = await session_service.get_requests_by_session_id(session.id)
-        # Убедимся, что users получаем после всех обновлений статусов, если это важно для логики ниже
-        all_user_ids_in_session = [req.user_id for req in requests]
+                requests = await session_service.get_requests_by_session_id(session.id)
+                # Убедимся, что users получаем после всех обновлений статусов, если это важно для логики ниже
+                all_user_ids_in_session = [req.user_id for req in requests]
         
-        # Проверка, есть ли вообще пользователи для обработки
-        if not all_user_ids_in_session:
-            logger.info(f"No users found in session {session.id} for post-session updates.")
-        else:
-            users_from_db = await user_service.get_users_by_ids(all_user_ids_in_session)
-            users_map = {user.id: user for user in users_from_db}
-
-            for request in requests:
-                user = users_map.get(request.user_id)
-                if not user:
-                    logger.warn(f"User with ID {request.user_id} from session request not found in DB batch fetch.")
-                    continue
-
-                data = {}
-                session_type = session.type # Получаем тип сессии из объекта session
-                if request.status == SessionRequestStatus.ACCEPTED.value:
-                    field = "total_replay_sessions" if session_type == 'replay' else "total_creative_sessions"
-                    data[field] = getattr(user, field, 0) + 1 # getattr с default значением
-                    if user.priority_coefficient == 1: # или user.priority_coefficient == 1.0 если это float
-                        data['priority_coefficient'] = 0.0 # или 0.0
-                        data['priority_expires_at'] = None
-                    if data: # Обновляем только если есть что обновлять
-                        await user_service.update_user(user.id, **data)
-                        logger.info(f'User {user.nickname or user.name} (ID: {user.id}) ACCEPTED stats updated successfully with data: {data}')
-
-                elif request.status == SessionRequestStatus.SKIPPED.value:
-                    data = {
-                        'priority_coefficient': 1.0, # или 1.0
-                        'priority_expires_at': datetime.now() + timedelta(days=7)
-                    }
-                    await user_service.update_user(user.id, **data)
-                    logger.info(f'User {user.nickname or user.name} (ID: {user.id}) SKIPPED stats updated successfully with data: {data}')
+                # Проверка, есть ли вообще пользователи для обработки
+                if not all_user_ids_in_session:
+                    logger.info(f"No users found in session {session.id} for post-session updates.")
+                else:
+                    users_from_db = await user_service.get_users_by_ids(all_user_ids_in_session)
+                    users_map = {user.id: user for user in users_from_db}
+                    accepted_ids = [
+                        req.user_id for req in requests
+                        if req.status == SessionRequestStatus.ACCEPTED.value and req.user_id in users_map
+                    ]
+                    skipped_ids = [
+                        req.user_id for req in requests
+                        if req.status == SessionRequestStatus.SKIPPED.value and req.user_id in users_map
+                    ]
+                    # Приоритет сбрасывается только у принятых пользователей, которые им воспользовались
+                    reset_priority_ids = [
+                        user_id for user_id in accepted_ids
+                        if users_map[user_id].priority_coefficient == 1
+                    ]
+
+                    await user_service.update_users(
+                        reset_priority_ids, priority_coefficient=0.0, priority_expires_at=None
+                    )
+                    await user_service.update_users(
+                        skipped_ids,
+                        priority_coefficient=1.0,
+                        priority_expires_at=datetime.now() + timedelta(days=7),
+                    )
+                    logger.info(
+                        f"Session {session.id} post-session updates: accepted={accepted_ids}, "
+                        f"priority reset={reset_priority_ids}, skipped={skipped_ids}"
+                    )
 
         selected_mentions = [f"<@{uid}>" for uid in self.selected_user_ids]
         message = f"Сессия `{self.session.id}` завершена. "
@@ -343,21 +332,20 @@ class ConfirmUnreviewedSelectionButton(Button):
             await self.parent_view.original_interaction.edit_original_response(view=self.view)
 
 class ReviewSessionView(View):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(timeout=None)
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
-        self.add_item(LikeButton(session, session_service, user_service))
-        self.add_item(DislikeButton(session, session_service, user_service))
+        self.service_factory = service_factory
+        self.add_item(LikeButton(session, service_factory))
+        self.add_item(DislikeButton(session, service_factory))
 
 class LikeButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="👍", style=discord.ButtonStyle.success, custom_id="like")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         logger.info(f"LikeButton callback called for session {self.session.id} by user {interaction.user.id}")
         await interaction.response.defer()
@@ -366,29 +354,29 @@ class LikeButton(Button):
             if user.id == self.session.coach_id:
                 await interaction.followup.send("Вы не можете оценивать себя.", ephemeral=True)
                 return
-            activities = await self.session_service.calculate_session_activities(self.session.id)
-            logger.info(f"Activities: {activities}")
-            if user.id not in activities or activities[user.id] < 300:
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service('session')
+                activities = await session_service.calculate_session_activities(self.session.id)
+                logger.info(f"Activities: {activities}")
+                allowed = user.id in activities and activities[user.id] >= 300
+                if allowed:
+                    await session_service.upsert_review(self.session.id, user.id, rating=1)
+            # Обращения к Discord выполняются после закрытия скоупа БД
+            if not allowed:
                 await interaction.followup.send("Вы должны провести хотя бы 5 минут в сессии, чтобы оценить её.", ephemeral=True)
                 return
-            reviews = await self.session_service.get_reviews_by_session_id(self.session.id)
-            review = next((r for r in reviews if r.user_id == user.id), None)
-            if review:
-                await self.session_service.update_review(review.id, rating=1)
-            else:
-                await self.session_service.create_review(self.session.id, user.id, rating=1)
             await interaction.followup.send("Спасибо за оценку!", ephemeral=True)
         except Exception as e:
             logger.error(f"Error in LikeButton: {e.with_traceback()}")
             await interaction.followup.send("Произошла ошибка при оценке сессии", ephemeral=True)
             
 class DislikeButton(Button):
-    def __init__(self, session: Session, session_service: SessionService, user_service: UserService):
+    def __init__(self, session: Session, service_factory: ServiceFactory):
         super().__init__(label="👎", style=discord.ButtonStyle.danger, custom_id="dislike")
         self.session = session
-        self.session_service = session_service
-        self.user_service = user_service
+        self.service_factory = service_factory
 
+    @track_queries()
     async def callback(self, interaction: discord.Interaction):
         logger.info(f"DislikeButton callback called for session {self.session.id}")
         await interaction.response.defer()
@@ -397,22 +385,17 @@ class DislikeButton(Button):
             if user.id == self.session.coach_id:
                 await interaction.followup.send("Вы не можете оценивать себя.", ephemeral=True)
                 return
-            activities = await self.session_service.get_session_activities(self.session.id)
-            if user.id not in activities or activities[user.id] < 300:
+            async with get_service_factory(self.service_factory) as factory:
+                session_service = await factory.get_service('session')
+                activities = await session_service.calculate_session_activities(self.session.id)
+                allowed = user.id in activities and activities[user.id] >= 300
+                if allowed:
+                    await session_service.upsert_review(self.session.id, user.id, rating=0)
+            # Обращения к Discord выполняются после закрытия скоупа БД
+            if not allowed:
                 await interaction.followup.send("Вы должны провести хотя бы 5 минут в сессии, чтобы оценить её.", ephemeral=True)
                 return
-
-            reviews = await self.session_service.get_reviews_by_session_id(self.session.id)
-            logger.info(f"Reviews: {reviews}")
-            review = next((r for r in reviews if r.user_id == user.id), None)
-            logger.info(f"Review: {review}")
-            if review:
-                await self.session_service.update_review(review.id, rating=0)
-                logger.info(f"Review updated to 0 for user {user.id}")
-            else:
-                logger.info(f"Review not found for user {user.id}, creating new review")
-                await self.session_service.create_review(self.session.id, user.id, rating=0)
-                logger.info(f"Review created for user {user.id}")
+            logger.info(f"Review set to 0 for user {user.id}")
             await interaction.followup.send("Спасибо за оценку!", ephemeral=True)
         except Exception as e:
             logger.error(f"Error in DislikeButton: {e.with_traceback()}")
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+# Использование: ./scripts/bench_indexes.sh postgresql+asyncpg://postgres:postgres@db:5432/boosty_bench
+docker compose exec -it bot python -m benchmarks.query_indexes --url "$1"
\ No newline at end of file
@@ -1,6 +1,19 @@
 import sys
 import os
 
+# Обязательные настройки для модулей, читающих config при импорте (database.db, factory).
+# Движки создаются без подключения, тесты подменяют фабрики сессий
+for key, value in {
+    "DISCORD_TOKEN": "test",
+    "POSTGRES_USER": "test",
+    "POSTGRES_PASSWORD": "test",
+    "POSTGRES_DB": "test",
+    "DATABASE_URL": "sqlite+aiosqlite:///:memory:",
+    "ADMIN_ID": "0",
+    "DEVELOPER_ID": "0",
+}.items():
+    os.environ.setdefault(key, value)
+
 # Добавляем корневую директорию проекта (на один уровень выше, чем 'tests')
 # в PYTHONPATH. Это позволит тестам импортировать модули из пакета 'bot'.
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,40 @@
+import pytest
+import datetime
+from types import SimpleNamespace
+
+# Обработчики событий импортируют модули приложения без префикса bot (PYTHONPATH=bot,
+# как в Docker), поэтому движок и кэш пользователей берутся из тех же модулей
+from app.bot import BoostyQueueBot
+from database.db import engine
+from database.pool_stats import get_pool_stats
+from factory import ServiceFactory
+from helpers.user_cache import user_cache
+from models import User
+
+
+def make_member(roles):
+    return SimpleNamespace(
+        id=1,
+        name="cached",
+        roles=[SimpleNamespace(name=role) for role in roles],
+        joined_at=datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc),
+    )
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    user_cache.clear()
+    yield
+    user_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_cached_user_member_update_does_not_checkout():
+    """Тестирует, что on_member_update без смены роли коуча для известного пользователя не берет соединение."""
+    user_cache.put(User(id=1, nickname="cached", join_date=datetime.datetime(2025, 1, 1)))
+    bot = SimpleNamespace(service_factory=ServiceFactory())
+    checkouts = get_pool_stats(engine)["checkouts"]
+
+    await BoostyQueueBot.on_member_update(bot, make_member([]), make_member(["Subscriber"]))
+
+    assert get_pool_stats(engine)["checkouts"] == checkouts
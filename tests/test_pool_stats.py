@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from bot.database.pool_stats import InstrumentedAsyncPool, PoolStats, get_pool_stats
+from bot.repositories import SessionRepository, UserRepository
+from bot.services import SessionService, UserService
+
+
+def test_pool_stats_histogram():
+    """Тестирует распределение времени ожидания по корзинам гистограммы."""
+    stats = PoolStats()
+    stats.observe_checkout(0.0005)
+    stats.observe_checkout(0.003)
+    stats.observe_checkout(10)
+
+    result = stats.to_dict()
+    assert result["checkouts"] == 3
+    assert result["wait_max_ms"] == 10000
+    assert result["wait_histogram"]["<=1ms"] == 1
+    assert result["wait_histogram"]["<=5ms"] == 1
+    assert result["wait_histogram"][">5000ms"] == 1
+
+
+@pytest.mark.asyncio
+async def test_instrumented_pool(tmp_path):
+    """Тестирует статистику пула: выдачи, занятые соединения и таймауты."""
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedAsyncPool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.1,
+    )
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            stats = get_pool_stats(engine)
+            assert stats["checked_out"] == 1
+            assert stats["checkouts"] == 1
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+
+        stats = get_pool_stats(engine)
+        assert stats["checked_out"] == 0
+        assert stats["checkouts"] == 2
+        assert stats["timeouts"] == 1
+        assert stats["wait_max_ms"] >= 100
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_services_without_statements_do_not_checkout(tmp_path):
+    """Тестирует, что создание сервисов без запросов не берет соединение из пула."""
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedAsyncPool,
+    )
+    SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        async with SessionLocal() as session:
+            SessionService(SessionRepository(session))
+            UserService(UserRepository(session))
+            assert not session.in_transaction()
+        assert get_pool_stats(engine)["checkouts"] == 0
+
+        async with SessionLocal() as session:
+            await session.execute(text("SELECT 1"))
+            assert session.in_transaction()
+        assert get_pool_stats(engine)["checkouts"] == 1
+    finally:
+        await engine.dispose()
+
@@ -0,0 +1,94 @@
+import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from bot.models import Base, Session, User
+from bot.repositories import SessionRepository
+from bot.database.query_counter import current_operation, instrument_engine, track_operation, track_queries
+
+
+@pytest_asyncio.fixture(scope="function")
+async def db_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    instrument_engine(engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with SessionLocal() as sess:
+        yield sess
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_track_operation_counts_and_repeats(db_session: AsyncSession):
+    """Тестирует подсчет запросов операции, вложенные операции и поиск N+1."""
+    with track_operation("outer") as outer:
+        for user_id in range(5):
+            await db_session.execute(select(User).where(User.id == user_id))
+        with track_operation("inner") as inner:
+            await db_session.execute(select(User))
+
+    assert inner.statements == 1
+    assert outer.statements == 6
+    assert outer.total_time > 0
+    repeated = outer.repeated_statements(threshold=5)
+    assert len(repeated) == 1
+    assert repeated[0][1] == 5
+    assert inner.repeated_statements(threshold=5) == []
+
+    # Вне операции запросы не учитываются
+    await db_session.execute(select(User))
+    assert outer.statements == 6
+
+
+@pytest.mark.asyncio
+async def test_track_queries_decorator(db_session: AsyncSession):
+    """Тестирует декоратор: имя операции по custom_id, бюджет запросов и затронутые строки."""
+    operations = []
+
+    class Button:
+        custom_id = "join_session"
+
+        @track_queries()
+        async def callback(self):
+            operations.append(current_operation().name)
+            await db_session.execute(select(User))
+
+    class Handler:
+        @track_queries()
+        async def handle(self):
+            operations.append(current_operation().name)
+
+    with track_operation("interaction") as stats:
+        await Button().callback()
+        await Handler().handle()
+    assert stats.statements == 1
+    # Имя операции: custom_id элемента UI, без него - имя функции
+    assert operations == ["button:join_session", Handler.handle.__qualname__]
+
+    # Затронутые строки учитываются только для записей, не для SELECT
+    assert stats.affected_rows == 0
+    with track_operation("write") as write_stats:
+        now = datetime.datetime(2025, 1, 1)
+        db_session.add_all([User(id=10, nickname="a", join_date=now), User(id=11, nickname="b", join_date=now)])
+        await db_session.flush()
+        await db_session.execute(select(User))
+    assert write_stats.affected_rows == 2
+
+
+@pytest.mark.asyncio
+async def test_claim_slot_query_budget(db_session: AsyncSession):
+    """Бюджет запросов занятия слота: блокировка, подсчет, upsert и счетчик сессий."""
+    now = datetime.datetime(2025, 1, 1)
+    db_session.add_all([User(id=1, nickname="coach", join_date=now), User(id=2, nickname="user", join_date=now)])
+    await db_session.flush()
+    db_session.add(Session(id=1, type="replay", coach_id=1, date=now, max_slots=8, is_active=True))
+    await db_session.commit()
+
+    with track_operation("claim_slot") as stats:
+        await SessionRepository(db_session).claim_slot(1, 2)
+    assert stats.statements <= 4
@@ -0,0 +1,79 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+import datetime
+
+# Фабрика импортирует модули приложения без префикса bot (PYTHONPATH=bot, как в Docker),
+# поэтому подменять сессии нужно в тех же модулях
+from database import db
+from factory import get_service_factory
+from helpers.user_cache import user_cache
+from models import Base, User
+
+
+@pytest_asyncio.fixture(scope="function")
+async def engines(tmp_path, monkeypatch):
+    """Основная БД и реплика - разные файлы, чтобы было видно, куда ушел запрос."""
+    primary = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}")
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}")
+    for engine in (primary, replica):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    async with replica.begin() as conn:
+        await conn.execute(User.__table__.insert().values(
+            id=1, nickname="replica_user", join_date=datetime.datetime(2024, 1, 1),
+        ))
+    monkeypatch.setattr(db, "async_session", sessionmaker(primary, class_=AsyncSession, expire_on_commit=False))
+    monkeypatch.setattr(db, "async_read_session", sessionmaker(replica, class_=AsyncSession, expire_on_commit=False))
+    user_cache.clear()
+    yield primary, replica
+    user_cache.clear()
+    await primary.dispose()
+    await replica.dispose()
+
+
+@pytest.mark.asyncio
+async def test_get_read_session_discards_writes(engines):
+    """Тестирует, что изменения через сессию чтения не фиксируются."""
+    primary, replica = engines
+    async with db.get_read_session() as session:
+        assert session.bind is replica
+        session.add(User(id=2, nickname="lost", join_date=datetime.datetime(2024, 1, 1)))
+        await session.flush()
+
+    async with db.get_db_session() as session:
+        assert session.bind is primary
+        session.add(User(id=3, nickname="kept", join_date=datetime.datetime(2024, 1, 1)))
+
+    async with replica.connect() as conn:
+        assert (await conn.execute(select(User.id))).scalars().all() == [1]
+    async with primary.connect() as conn:
+        assert (await conn.execute(select(User.id))).scalars().all() == [3]
+
+
+@pytest.mark.asyncio
+async def test_service_factory_read_only_routing(engines):
+    """Тестирует маршрутизацию read_only на реплику и запрет записи через нее."""
+    async with get_service_factory(read_only=True) as factory:
+        user_service = await factory.get_service("user")
+        user = await user_service.get_user(1)
+        assert user.nickname == "replica_user"
+        with pytest.raises(RuntimeError):
+            async with factory.transaction():
+                pass
+    # Строки реплики не попадают в общий кэш пользователей
+    assert user_cache.get(1) is None
+
+    async with get_service_factory() as factory:
+        user_service = await factory.get_service("user")
+        # Основная БД не содержит строки реплики
+        assert await user_service.get_user(1) is None
+        async with factory.transaction():
+            await user_service.create_user(4, "primary_user", join_date=datetime.datetime(2024, 1, 1))
+
+    async with get_service_factory() as factory:
+        user_service = await factory.get_service("user")
+        assert (await user_service.get_user(4)).nickname == "primary_user"
+    assert user_cache.get(4) is not None
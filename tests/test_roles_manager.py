@@ -0,0 +1,40 @@
+import pytest
+
+from bot.helpers import Roles, RolesManager
+
+
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeGuild:
+    def __init__(self, id: int, role_names):
+        self.id = id
+        self.roles = [FakeRole(name) for name in role_names]
+        self.default_role = FakeRole("@everyone")
+
+
+@pytest.fixture(autouse=True)
+def clear_roles_managers():
+    RolesManager._instances.clear()
+    yield
+    RolesManager._instances.clear()
+
+
+def test_roles_manager_cached_per_guild():
+    """Тестирует переиспользование ролей и шаблонов прав и сброс кэша."""
+    guild = FakeGuild(1, [Roles.MOD, Roles.SUB, Roles.COACH_T1, Roles.COACH_T2, Roles.COACH_T3])
+    manager = RolesManager.for_guild(guild)
+    assert RolesManager.for_guild(guild) is manager
+    assert manager.roles[Roles.SUB] is guild.roles[1]
+
+    overwrites = manager.get_session_channels_overwrites()
+    assert len(overwrites) == 6
+    overwrites.clear()
+    again = manager.get_session_channels_overwrites()
+    assert len(again) == 6
+    assert again[guild.roles[1]] is manager.get_session_channels_overwrites()[guild.roles[1]]
+
+    RolesManager.invalidate(guild)
+    assert RolesManager.for_guild(guild) is not manager
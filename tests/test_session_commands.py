@@ -0,0 +1,85 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+import datetime
+
+# Команды импортируют модули приложения без префикса bot (PYTHONPATH=bot, как в Docker),
+# поэтому хранилища и модели берутся из тех же модулей
+from commands.session_commands import SessionCommands
+from helpers import channel_registry, session_manager
+from models import Base, User
+from repositories import SessionRepository
+from services import SessionService
+
+
+class FakeChannel:
+    def __init__(self, id: int, channels=None):
+        self.id = id
+        self.channels = channels or []
+        self.deleted = False
+        self.sent = []
+
+    async def delete(self):
+        self.deleted = True
+
+    async def send(self, content):
+        self.sent.append(content)
+
+
+class FakeGuild:
+    def __init__(self, channels):
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+
+@pytest.fixture(autouse=True)
+def clear_registries():
+    session_manager.clear()
+    channel_registry.clear()
+    yield
+    session_manager.clear()
+    channel_registry.clear()
+
+
+@pytest_asyncio.fixture(scope="function")
+async def db_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with SessionLocal() as sess:
+        yield sess
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_session_channels_deleted_after_end(db_session: AsyncSession):
+    """Тестирует удаление каналов по заголовку, полученному при завершении /end."""
+    now = datetime.datetime(2025, 1, 1)
+    db_session.add(User(id=1, nickname="coach", join_date=now))
+    await db_session.commit()
+    session_service = SessionService(SessionRepository(db_session))
+
+    created = await session_service.create_session(type="replay", coach_id=1, date=now)
+    await session_service.update_session(
+        created.id, is_active=True, start_time=now, text_channel_id=10, voice_channel_id=11
+    )
+    state = await session_service.get_session_state(created.id)
+
+    text_channel = FakeChannel(10)
+    category = FakeChannel(12, channels=[text_channel])
+    guild = FakeGuild([text_channel, category])
+    channel_registry.session_categories[created.id] = category.id
+
+    cog = SessionCommands(None, None)
+    ended = await cog.close_session(session_service, state, now + datetime.timedelta(hours=1))
+    # Снимок в state остается активным, заголовок завершения - нет
+    assert state.session.is_active
+    assert not ended.is_active and ended.end_time is not None
+
+    await cog.delete_session_channels(guild, ended)
+    assert text_channel.deleted and category.deleted
+    assert text_channel.sent == []
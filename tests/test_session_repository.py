@@ -1,12 +1,19 @@
 import pytest
 import pytest_asyncio
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 import datetime
+from types import SimpleNamespace
+
+import discord
 
 from bot.models import Session, SessionRequest, SessionRequestStatus, User, Base
-from bot.repositories import SessionRepository, UserRepository
+from bot.repositories import SessionRepository, SessionLoad, SlotClaimStatus, UserRepository
 from bot.services import SessionService, UserService
+from bot.services.session_service import SessionHeader, session_manager
+from bot.helpers.user_cache import UserCache
+from bot.helpers.activity_tracker import ActivityTracker
 from bot.logger import logger
 
 def get_current_time():
@@ -24,6 +31,13 @@ async def engine():
     yield engine
     await engine.dispose()
 
+@pytest.fixture(autouse=True)
+def clear_session_manager():
+    """Хранилище сессий общее для процесса: идентификаторы повторяются между тестами."""
+    session_manager.clear()
+    yield
+    session_manager.clear()
+
 @pytest_asyncio.fixture(scope="function")
 async def db_session(engine): # Переименовал фикстуру session в db_session, чтобы избежать конфликта имен
     """Фикстура для создания сессии БД для каждого теста."""
@@ -42,8 +56,13 @@ def user_repo(db_session: AsyncSession) -> UserRepository:
     return UserRepository(db_session)
 
 @pytest.fixture
-def user_service(user_repo: UserRepository) -> UserService:
-    return UserService(user_repo)
+def users_cache() -> UserCache:
+    """Кэш пользователей, общий для сервисов теста."""
+    return UserCache()
+
+@pytest.fixture
+def user_service(user_repo: UserRepository, users_cache: UserCache) -> UserService:
+    return UserService(user_repo, cache=users_cache)
 
 # --- Фикстуры для Сессий ---
 @pytest.fixture
@@ -55,9 +74,9 @@ def session_repo(db_session: AsyncSession) -> SessionRepository:
 
 
 @pytest.fixture
-def session_service(session_repo: SessionRepository) -> SessionService:
+def session_service(session_repo: SessionRepository, users_cache: UserCache) -> SessionService:
     """Фикстура для SessionService."""
-    return SessionService(session_repo)
+    return SessionService(session_repo, user_cache=users_cache)
 
 # --- Тестовые данные ---
 TEST_COACH_ID = 1
@@ -277,3 +296,499 @@ async def test_active_sessions_by_user(session_service: SessionService, test_coa
     
     assert len(user1_joined_active_sessions) == 1
     assert user1_joined_active_sessions[0].id == session1.id
+
+@pytest.mark.asyncio
+async def test_session_load_profiles(session_service: SessionService, test_coach: User, test_user1: User):
+    """Тестирует профили загрузки связей сессии."""
+    now = get_current_time()
+    created_session = await session_service.create_session(
+        type="replay", coach_id=test_coach.id, date=now, max_slots=5
+    )
+    await session_service.create_request(session_id=created_session.id, user_id=test_user1.id)
+    session_service.session_repo.session.expunge_all()
+
+    header = await session_service.get_session_by_id(created_session.id, load=SessionLoad.HEADER)
+    assert header.coach_id == test_coach.id
+    assert {"requests", "reviews", "activities", "coach"} <= inspect(header).unloaded
+    session_service.session_repo.session.expunge_all()
+
+    with_requests = await session_service.get_session_by_id(created_session.id, load=SessionLoad.WITH_REQUESTS)
+    assert "requests" not in inspect(with_requests).unloaded
+    assert len(with_requests.requests) == 1
+    assert "reviews" in inspect(with_requests).unloaded
+    session_service.session_repo.session.expunge_all()
+
+    custom = await session_service.get_session_by_id(created_session.id, include={"coach"})
+    assert custom.coach.id == test_coach.id
+    assert "requests" in inspect(custom).unloaded
+
+    with pytest.raises(ValueError):
+        await session_service.get_session_by_id(created_session.id, load="everything")
+    with pytest.raises(ValueError):
+        await session_service.get_session_by_id(created_session.id, include={"participants"})
+
+@pytest.mark.asyncio
+async def test_sessions_aggregate_counts(session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует агрегатные подсчеты заявок на стороне БД."""
+    now = get_current_time()
+    replay_1 = await session_service.create_session(type="replay", coach_id=test_coach.id, date=now)
+    replay_2 = await session_service.create_session(type="replay", coach_id=test_coach.id, date=now)
+    creative = await session_service.create_session(type="creative", coach_id=test_coach.id, date=now)
+
+    for sess in (replay_1, replay_2, creative):
+        request = await session_service.create_request(session_id=sess.id, user_id=test_user1.id)
+        await session_service.update_request(request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=1)
+    await session_service.create_request(session_id=replay_1.id, user_id=test_user2.id)
+
+    assert await session_service.get_user_sessions_count(test_user1.id, "replay") == 2
+    assert await session_service.get_user_sessions_count(test_user1.id, "creative") == 1
+    assert await session_service.get_user_sessions_count(test_user2.id, "replay") == 0
+
+@pytest.mark.asyncio
+async def test_bulk_assign_slots(session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует распределение слотов одной транзакцией."""
+    now = get_current_time()
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=now, max_slots=1)
+    request1 = await session_service.create_request(session_id=created_session.id, user_id=test_user1.id)
+    request2 = await session_service.create_request(session_id=created_session.id, user_id=test_user2.id)
+    pending = await session_service.get_requests_by_session_id(created_session.id)
+    assert all(req.status == SessionRequestStatus.PENDING.value for req in pending)
+
+    updated = await session_service.bulk_assign_slots(created_session.id, [(request2.id, 1)], [request1.id])
+    assert len(updated) == 2
+
+    requests = {req.id: req for req in await session_service.get_requests_by_session_id(created_session.id)}
+    assert requests[request2.id].status == SessionRequestStatus.ACCEPTED.value
+    assert requests[request2.id].slot_number == 1
+    assert requests[request1.id].status == SessionRequestStatus.REJECTED.value
+    assert requests[request1.id].slot_number is None
+
+    assert await session_service.bulk_assign_slots(created_session.id, [], []) == []
+
+@pytest.mark.asyncio
+async def test_transaction_commits_once_and_rolls_back(session_service: SessionService, db_session: AsyncSession, test_coach: User, test_user1: User):
+    """Тестирует unit of work: один commit на блок и откат при ошибке."""
+    now = get_current_time()
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=now)
+
+    commits = []
+    original_commit = db_session.commit
+    async def counting_commit():
+        commits.append(1)
+        await original_commit()
+    db_session.commit = counting_commit
+
+    async with session_service.transaction():
+        request = await session_service.create_request(session_id=created_session.id, user_id=test_user1.id)
+        await session_service.update_request(request.id, status=SessionRequestStatus.ACCEPTED.value, slot_number=1)
+        await session_service.update_session(created_session.id, is_active=True)
+    request_id = request.id
+    assert len(commits) == 1
+    assert (await session_service.get_request_by_id(request_id)).slot_number == 1
+
+    with pytest.raises(RuntimeError):
+        async with session_service.transaction():
+            await session_service.update_request(request_id, slot_number=5)
+            raise RuntimeError("boom")
+    assert len(commits) == 1
+    db_session.expunge_all()
+    assert (await session_service.get_request_by_id(request_id)).slot_number == 1
+
+    await session_service.update_request(request_id, slot_number=2)
+    assert len(commits) == 2
+
+@pytest.mark.asyncio
+async def test_session_durations_in_sql(session_repo: SessionRepository, session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует подсчет времени пользователей в сессии на стороне БД."""
+    now = datetime.datetime(2025, 1, 1, 12, 0, 0)
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=now)
+
+    await session_service.create_user_session_activity(
+        created_session.id, test_user1.id, join_time=now - datetime.timedelta(minutes=30),
+        leave_time=now - datetime.timedelta(minutes=20), total_duration_seconds=600, is_active=False
+    )
+    await session_service.create_user_session_activity(
+        created_session.id, test_user1.id, join_time=now - datetime.timedelta(minutes=5)
+    )
+    await session_service.create_user_session_activity(
+        created_session.id, test_user2.id, join_time=now - datetime.timedelta(minutes=10),
+        leave_time=now, total_duration_seconds=600, is_active=False
+    )
+
+    durations = await session_repo.get_session_durations(created_session.id, now)
+    assert durations == {test_user1.id: 900.0, test_user2.id: 600.0}
+    assert await session_repo.get_session_durations(created_session.id + 1, now) == {}
+
+    # Как в UserSessionActivity.duration: без total_duration_seconds берется leave_time - join_time
+    await session_service.create_user_session_activity(
+        created_session.id, test_user2.id, join_time=now - datetime.timedelta(minutes=40),
+        leave_time=now - datetime.timedelta(minutes=38), total_duration_seconds=None, is_active=False
+    )
+    await session_service.create_user_session_activity(
+        created_session.id, test_user2.id, join_time=now - datetime.timedelta(minutes=50),
+        leave_time=now - datetime.timedelta(minutes=49), total_duration_seconds=0, is_active=False
+    )
+    # Учитываются все незавершенные активности пользователя, а не только самая ранняя
+    await session_service.create_user_session_activity(
+        created_session.id, test_user1.id, join_time=now - datetime.timedelta(minutes=1)
+    )
+    durations = await session_repo.get_session_durations(created_session.id, now)
+    assert durations == {test_user1.id: 960.0, test_user2.id: 780.0}
+
+    activities = await session_service.get_session_activities(created_session.id)
+    expected = {}
+    for activity in activities:
+        expected[activity.user_id] = expected.get(activity.user_id, 0.0) + activity.duration_until(now)
+    assert durations == expected
+
+
+@pytest.mark.asyncio
+async def test_sessions_counters(session_service: SessionService, user_service: UserService, db_session: AsyncSession, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует счетчики сессий, которые меняются вместе со статусом заявок."""
+    user1_id, user2_id = test_user1.id, test_user2.id
+    # Значения, заданные до ведения счетчиков, сохраняются: меняется только прирост
+    await user_service.update_user(user1_id, total_creative_sessions=5)
+    assert (await user_service.get_user(user1_id)).get_sessions_count("creative") == 5
+
+    creative = await session_service.create_session(type="creative", coach_id=test_coach.id, date=get_current_time(), max_slots=1)
+    request1 = await session_service.create_request(creative.id, user1_id)
+    request2 = await session_service.create_request(creative.id, user2_id)
+
+    # /start: распределение слотов и счетчики в одной транзакции
+    async with session_service.transaction():
+        await session_service.bulk_assign_slots(creative.id, [(request1.id, 1)], [request2.id])
+    user1 = await user_service.get_user(user1_id)
+    assert user1.get_sessions_count("creative") == 6
+    assert (await user_service.get_user(user2_id)).get_sessions_count("creative") == 0
+
+    # Повторное принятие уже принятой заявки не увеличивает счетчик
+    await session_service.update_request(request1.id, status=SessionRequestStatus.ACCEPTED.value)
+    assert (await user_service.get_user(user1_id)).get_sessions_count("creative") == 6
+
+    # /join: занятие слота активной сессии
+    replay = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time(), max_slots=2, is_active=True)
+    status, _ = await session_service.claim_slot(replay.id, user2_id)
+    assert status == SlotClaimStatus.CLAIMED
+    user2 = await user_service.get_user(user2_id)
+    assert (user2.get_sessions_count("replay"), user2.get_sessions_count("creative")) == (1, 0)
+    status, _ = await session_service.claim_slot(replay.id, user2_id)
+    assert status == SlotClaimStatus.ALREADY_JOINED
+    assert (await user_service.get_user(user2_id)).get_sessions_count("replay") == 1
+
+    # Неразобранный участник (skipped) теряет сессию
+    await session_service.update_request_status(request1.id, SessionRequestStatus.SKIPPED)
+    assert (await user_service.get_user(user1_id)).get_sessions_count("creative") == 5
+
+    # Ошибка в транзакции откатывает и статус, и счетчик
+    replay_request = await session_service.get_request_by_user_id(replay.id, user2_id)
+    with pytest.raises(RuntimeError):
+        async with session_service.transaction():
+            await session_service.update_request(replay_request.id, status=SessionRequestStatus.REJECTED.value, slot_number=None)
+            raise RuntimeError("boom")
+    assert (await user_service.get_user(user2_id)).get_sessions_count("replay") == 1
+
+    # !recount_sessions восстанавливает счетчики по истории и перезаписывает ручные значения
+    assert await user_service.recompute_sessions_counts() == 3
+    user1 = await user_service.get_user(user1_id)
+    user2 = await user_service.get_user(user2_id)
+    assert (user1.total_replay_sessions, user1.total_creative_sessions) == (0, 0)
+    assert (user2.total_replay_sessions, user2.total_creative_sessions) == (1, 0)
+
+
+@pytest.mark.asyncio
+async def test_latest_and_stream_sessions(session_service: SessionService, test_coach: User, test_user1: User):
+    """Тестирует получение последней сессии и потоковую выборку с keyset-пагинацией."""
+    assert await session_service.get_latest_session() is None
+    created_at = datetime.datetime(2025, 1, 1, 12, 0, 0)
+    created_ids = []
+    for idx in range(5):
+        # Две сессии с одинаковым created_at проверяют второй ключ пагинации (id)
+        session_created_at = created_at + datetime.timedelta(minutes=min(idx, 3))
+        created_session = await session_service.create_session(
+            type="replay", coach_id=test_coach.id if idx % 2 == 0 else test_user1.id,
+            date=session_created_at, created_at=session_created_at
+        )
+        created_ids.append(created_session.id)
+
+    latest = await session_service.get_latest_session()
+    assert latest.id == created_ids[-1]
+    assert "requests" in inspect(latest).unloaded
+    latest_by_coach = await session_service.get_latest_session(coach_id=test_user1.id)
+    assert latest_by_coach.id == created_ids[3]
+
+    streamed = [session.id async for session in session_service.stream_sessions(batch_size=2)]
+    assert streamed == created_ids
+    streamed = [session.id async for session in session_service.stream_sessions(batch_size=5, coach_id=test_coach.id)]
+    assert streamed == created_ids[::2]
+    with pytest.raises(ValueError):
+        [session async for session in session_service.stream_sessions(batch_size=0)]
+
+
+@pytest.mark.asyncio
+async def test_upsert_review(session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует создание и обновление оценки через upsert."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+
+    review = await session_service.upsert_review(created_session.id, test_user1.id, rating=1)
+    assert review.id is not None
+    assert review.rating == 1
+    updated = await session_service.upsert_review(created_session.id, test_user1.id, rating=0)
+    assert updated.id == review.id
+    assert updated.rating == 0
+    await session_service.upsert_review(created_session.id, test_user2.id, rating=1)
+
+    reviews = await session_service.get_reviews_by_session_id(created_session.id)
+    assert sorted((r.user_id, r.rating) for r in reviews) == [(test_user1.id, 0), (test_user2.id, 1)]
+
+
+@pytest.mark.asyncio
+async def test_claim_slot(session_service: SessionService, user_service: UserService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует занятие слотов активной сессии."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time(), max_slots=2)
+    rejected = await session_service.create_request(created_session.id, test_user2.id)
+    await session_service.update_request(rejected.id, status=SessionRequestStatus.REJECTED.value)
+
+    assert await session_service.claim_slot(created_session.id, test_user1.id) == (SlotClaimStatus.CLAIMED, 1)
+    assert await session_service.claim_slot(created_session.id, test_user1.id) == (SlotClaimStatus.ALREADY_JOINED, 1)
+    # Отклоненная заявка повышается до принятой, новая запись не создается
+    assert await session_service.claim_slot(created_session.id, test_user2.id) == (SlotClaimStatus.CLAIMED, 2)
+    requests = await session_service.get_requests_by_session_id(created_session.id)
+    assert len(requests) == 2
+    assert all(r.status == SessionRequestStatus.ACCEPTED.value for r in requests)
+
+    late_user = await user_service.create_user(user_id=1003, nickname="late", join_date=get_current_time())
+    assert await session_service.claim_slot(created_session.id, late_user.id) == (SlotClaimStatus.FULL, None)
+    assert await session_service.get_request_by_user_id(created_session.id, late_user.id) is None
+    with pytest.raises(ValueError):
+        await session_service.claim_slot(created_session.id + 1, test_user1.id)
+
+
+@pytest.mark.asyncio
+async def test_create_request_idempotent(session_service: SessionService, test_coach: User, test_user1: User):
+    """Тестирует идемпотентное создание заявки в очередь."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+
+    request, created = await session_service.create_request(created_session.id, test_user1.id, idempotent=True)
+    assert created is True
+    assert request.status == SessionRequestStatus.PENDING.value
+    repeated, created = await session_service.create_request(created_session.id, test_user1.id, idempotent=True)
+    assert created is False
+    assert repeated.id == request.id
+    assert len(await session_service.get_requests_by_session_id(created_session.id)) == 1
+
+
+@pytest.mark.asyncio
+async def test_create_with_returning(session_service: SessionService, db_session: AsyncSession, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует создание объектов через INSERT ... RETURNING и пакетное создание."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+
+    statements = []
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0].upper())
+    sync_engine = db_session.bind.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_execute)
+    try:
+        request = await session_service.create_request(created_session.id, test_user1.id)
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", before_execute)
+    assert statements == ["INSERT"]
+    assert request.id is not None
+    assert request.created_at is not None
+    assert request.status == SessionRequestStatus.PENDING.value
+
+    activities = await session_service.create_user_session_activities([
+        {"session_id": created_session.id, "user_id": test_user2.id, "join_time": get_current_time()},
+        {"session_id": created_session.id, "user_id": test_user1.id, "join_time": get_current_time()},
+    ])
+    assert [a.user_id for a in activities] == [test_user2.id, test_user1.id]
+    assert all(a.id is not None and a.is_active for a in activities)
+
+    other_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+    requests = await session_service.create_requests(other_session.id, [test_user1.id, test_user2.id])
+    assert [r.user_id for r in requests] == [test_user1.id, test_user2.id]
+    assert await session_service.create_requests(other_session.id, []) == []
+
+
+@pytest.mark.asyncio
+async def test_session_state_write_through(session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует обновление хранилища открытых сессий после фиксации изменений."""
+    # Откат транзакции ниже истекает ORM-объекты сессии БД: идентификаторы читаются заранее
+    coach_id, user1_id, user2_id = test_coach.id, test_user1.id, test_user2.id
+    created_session = await session_service.create_session(type="replay", coach_id=coach_id, date=get_current_time(), max_slots=2)
+    session_id = created_session.id
+    state = session_manager.get(session_id)
+    assert state is not None
+    assert isinstance(state.session, SessionHeader)
+
+    request1 = await session_service.create_request(session_id, user1_id)
+    request1_id = request1.id
+    await session_service.create_request(session_id, user2_id, idempotent=True)
+    assert state.pending_user_ids == [user1_id, user2_id]
+    assert state.pending_ids == {user1_id, user2_id}
+
+    await session_service.bulk_assign_slots(session_id, [(request1_id, 1)], [])
+    await session_service.update_session(session_id, is_active=True)
+    assert state.slots == {1: user1_id}
+    assert state.pending_user_ids == [user2_id]
+    assert state.pending_ids == {user2_id}
+    assert session_manager.get_by_coach_id(coach_id, active=True) == [state]
+
+    # Откат unit of work не меняет хранилище
+    with pytest.raises(RuntimeError):
+        async with session_service.transaction():
+            await session_service.update_request(request1_id, slot_number=5)
+            raise RuntimeError("boom")
+    assert state.slots == {1: user1_id}
+
+    assert await session_service.claim_slot(session_id, user2_id) == (SlotClaimStatus.CLAIMED, 2)
+    assert state.slots == {1: user1_id, 2: user2_id}
+    assert state.count_free_slots() == 0
+
+    # Прогрев из БД восстанавливает то же состояние
+    assert await session_service.warm_session_state() == 1
+    warmed = session_manager.get(session_id)
+    assert warmed.slots == {1: user1_id, 2: user2_id}
+    assert warmed.get_request(user1_id).id == request1_id
+
+    await session_service.update_session(session_id, is_active=False, end_time=get_current_time())
+    assert session_manager.get(session_id) is None
+    assert await session_service.get_session_state(session_id) is None
+
+
+@pytest.mark.asyncio
+async def test_session_state_survives_rollback_and_close(session_service: SessionService, db_session: AsyncSession, test_coach: User):
+    """Тестирует, что заголовок в хранилище не зависит от жизни AsyncSession."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time(), max_slots=3)
+    state = session_manager.get(created_session.id)
+
+    # Откат истекает все объекты AsyncSession, закрытие их отсоединяет
+    with pytest.raises(RuntimeError):
+        async with session_service.transaction():
+            await session_service.update_session(created_session.id, max_slots=5)
+            raise RuntimeError("boom")
+    await db_session.close()
+
+    assert state.count_free_slots() == 3
+    assert state.session.is_active is False
+
+
+@pytest.mark.asyncio
+async def test_session_channel_index(session_service: SessionService, test_coach: User):
+    """Тестирует индекс каналов открытых сессий: создание, запуск и завершение."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+    await session_service.update_session(created_session.id, text_channel_id=100)
+    assert session_manager.get_session_id_by_channel(100) == created_session.id
+    assert session_manager.get_session_id_by_channel(200) is None
+
+    await session_service.update_session(created_session.id, is_active=True, voice_channel_id=200)
+    assert session_manager.get_by_channel(200).session_id == created_session.id
+
+    await session_service.warm_session_state()
+    assert session_manager.get_session_id_by_channel(200) == created_session.id
+
+    await session_service.update_session(created_session.id, is_active=False, end_time=get_current_time())
+    assert session_manager.get_session_id_by_channel(100) is None
+    assert session_manager.get_session_id_by_channel(200) is None
+
+
+@pytest.mark.asyncio
+async def test_session_channel_lookup_without_warm(session_service: SessionService, test_coach: User):
+    """Тестирует поиск сессии канала в БД, если хранилище не прогрето."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+    await session_service.update_session(created_session.id, is_active=True, text_channel_id=100, voice_channel_id=200)
+
+    # Неудачный прогрев: индекс пуст
+    session_manager.clear()
+    assert session_manager.get_session_id_by_channel(200) is None
+    assert await session_service.get_session_id_by_channel(200) == created_session.id
+    assert await session_service.get_session_id_by_channel(100) == created_session.id
+    assert await session_service.get_session_id_by_channel(300) is None
+
+    # После прогрева используется только индекс
+    await session_service.warm_session_state()
+    assert await session_service.get_session_id_by_channel(200) == created_session.id
+
+    await session_service.update_session(created_session.id, is_active=False, end_time=get_current_time())
+    session_manager.clear()
+    assert await session_service.get_session_id_by_channel(200) is None
+
+class FakeMember:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeGuild:
+    """Кэш сервера и query_members; первый запрос завершается ошибкой Discord"""
+
+    def __init__(self, cached_ids, known_ids):
+        self.id = 1
+        self.cached = {user_id: FakeMember(user_id) for user_id in cached_ids}
+        self.known_ids = set(known_ids)
+        self.queries = []
+
+    def get_member(self, user_id: int):
+        return self.cached.get(user_id)
+
+    async def query_members(self, user_ids, limit):
+        self.queries.append(list(user_ids))
+        if len(self.queries) == 1:
+            raise discord.HTTPException(SimpleNamespace(status=503, reason="Service Unavailable"), "unavailable")
+        return [FakeMember(user_id) for user_id in user_ids if user_id in self.known_ids]
+
+
+@pytest.mark.asyncio
+async def test_fetch_members_batches_queries():
+    """Тестирует пачечный запрос отсутствующих в кэше участников и пропуск ошибок Discord."""
+    missing = list(range(1000, 1150))
+    guild = FakeGuild(cached_ids=[1, 2], known_ids=missing[:-1])
+
+    members = await SessionService.fetch_members(guild, [2] + missing + [1])
+
+    assert [len(chunk) for chunk in guild.queries] == [100, 50]
+    # Первая пачка потеряна из-за ошибки, последний id покинул сервер
+    assert [member.id for member in members] == [2] + missing[100:-1] + [1]
+
+@pytest.mark.asyncio
+async def test_activity_tracker_batches(session_service: SessionService, test_coach: User, test_user1: User, test_user2: User):
+    """Тестирует пачечную запись активностей и закрытие зависших строк."""
+    created_session = await session_service.create_session(type="replay", coach_id=test_coach.id, date=get_current_time())
+    tracker = ActivityTracker()
+    start = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+    assert tracker.join(created_session.id, test_user1.id, start)
+    assert not tracker.join(created_session.id, test_user1.id, start)
+    tracker.join(created_session.id, test_user2.id, start)
+    tracker.leave(created_session.id, test_user2.id, start + datetime.timedelta(seconds=30))
+    batch, _ = tracker.drain()
+    assert batch.closes == []
+    assert await session_service.apply_activity_batch(batch) == (0, 2)
+    assert tracker.is_open(created_session.id, test_user1.id)
+    assert not tracker.drain()[0]
+
+    # Выход и повторный вход в одной пачке: старая строка закрывается, новая открывается
+    tracker.leave(created_session.id, test_user1.id, start + datetime.timedelta(seconds=60))
+    tracker.join(created_session.id, test_user1.id, start + datetime.timedelta(seconds=90))
+    batch, _ = tracker.drain()
+    assert await session_service.apply_activity_batch(batch) == (1, 1)
+
+    activities = await session_service.get_user_session_activities(created_session.id, test_user1.id)
+    assert sorted((a.is_active, a.total_duration_seconds) for a in activities) == [(False, 60), (True, 0)]
+    activities = await session_service.get_user_session_activities(created_session.id, test_user2.id)
+    assert [(a.is_active, a.total_duration_seconds) for a in activities] == [(False, 30)]
+
+    # Строка, оставшаяся открытой после аварийной остановки, закрывается последним
+    # heartbeat, а не временем запуска: простой не засчитывается
+    assert await session_service.apply_activity_batch(tracker.drain()[0], heartbeat_at=start + datetime.timedelta(seconds=130)) == (0, 0)
+    await session_service.update_session(created_session.id, end_time=start + datetime.timedelta(seconds=150))
+    assert await session_service.close_dangling_activities() == 1
+    assert await session_service.close_dangling_activities() == 0
+    tracker.clear()
+    durations = await session_service.calculate_session_activities(created_session.id)
+    assert durations[test_user1.id] == 100
+
+    # При остановке бота открытые активности закрываются до сброса буфера
+    tracker.join(created_session.id, test_user2.id, start + datetime.timedelta(seconds=200))
+    assert tracker.close_all(start + datetime.timedelta(seconds=210)) == 1
+    assert not tracker.open
+    batch, _ = tracker.drain()
+    assert batch.rows[0]["total_duration_seconds"] == 10 and batch.rows[0]["is_active"] is False
@@ -9,7 +9,9 @@ import datetime
 from bot.models.base import Base
 from bot.models.user import User
 from bot.repositories.user_repo import UserRepository
+from bot.repositories.base_repo import check_upsert_support, unit_of_work
 from bot.services.user_service import UserService
+from bot.helpers.user_cache import UserCache
 from bot.logger import logger
 # Предположим, что у вас есть такой utils.py или аналогичный для get_current_time
 # Если нет, замените на datetime.datetime.utcnow или datetime.datetime.now(datetime.timezone.utc)
@@ -55,8 +57,8 @@ def user_repo(session: AsyncSession) -> UserRepository:
 
 @pytest.fixture
 def user_service(user_repo: UserRepository) -> UserService:
-    """Фикстура для UserService."""
-    return UserService(user_repo)
+    """Фикстура для UserService с отдельным кэшем на тест."""
+    return UserService(user_repo, cache=UserCache())
 
 # Данные для тестов
 TEST_USER_ID = 12345
@@ -236,4 +238,103 @@ async def test_complex_scenario_create_update_delete(user_service: UserService):
     all_users = await user_service.get_all_users()
     assert len(all_users) == 1
     assert all_users[0].id == user_b_id
-    assert all_users[0].nickname == user_b_initial_nick
\ No newline at end of file
+    assert all_users[0].nickname == user_b_initial_nick
+
+@pytest.mark.asyncio
+async def test_bulk_sync(user_service: UserService):
+    """Тестирует пакетную синхронизацию пользователей с участниками сервера."""
+    join_date = get_current_time().replace(tzinfo=None)
+    await user_service.create_user(user_id=3001, nickname="old_nick", join_date=join_date, total_replay_sessions=4)
+    await user_service.create_user(user_id=3002, nickname="same", join_date=join_date)
+
+    rows = [
+        {"id": 3001, "nickname": "new_nick", "join_date": join_date, "coach_tier": "Coach T1"},
+        {"id": 3002, "nickname": "same", "join_date": join_date, "coach_tier": None},
+        {"id": 3003, "nickname": "newcomer", "join_date": join_date, "coach_tier": None},
+    ]
+    # Пачки по 2 проверяют обработку нескольких чанков; неизменный пользователь пропускается
+    written = await user_service.bulk_sync(rows, chunk_size=2)
+    assert written == 2
+
+    updated = await user_service.get_user(3001)
+    assert (updated.nickname, updated.coach_tier) == ("new_nick", "Coach T1")
+    assert updated.total_replay_sessions == 4
+    created = await user_service.get_user(3003)
+    assert created.nickname == "newcomer"
+    assert created.total_replay_sessions == 0
+    assert await user_service.bulk_sync(rows) == 0
+
+
+@pytest.mark.asyncio
+async def test_user_cache(user_service: UserService):
+    """Тестирует кэш пользователей: попадания, промахи, пакетное чтение и сброс при изменении."""
+    current_time = get_current_time()
+    await user_service.create_user(user_id=1, nickname="first", join_date=current_time)
+    await user_service.create_user(user_id=2, nickname="second", join_date=current_time)
+
+    assert (await user_service.get_user(1)).nickname == "first"
+    assert (await user_service.get_user(1)).nickname == "first"
+    stats = user_service.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+    # Из БД запрашивается только промах (id=2), порядок ответа как в запросе
+    users = await user_service.get_users_by_ids([2, 1, 3])
+    assert [user.id for user in users] == [2, 1]
+    stats = user_service.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (2, 3)
+
+    await user_service.update_user(1, nickname="renamed")
+    assert (await user_service.get_user(1)).nickname == "renamed"
+
+    await user_service.delete_user(2)
+    assert await user_service.get_user(2) is None
+
+
+@pytest.mark.asyncio
+async def test_user_cache_snapshots(user_repo: UserRepository, session: AsyncSession):
+    """Тестирует, что кэш хранит снимки строк и не заполняется сервисом без fill_cache."""
+    cache = UserCache()
+    user_service = UserService(user_repo, cache=cache)
+    await user_service.create_user(user_id=1, nickname="first", join_date=get_current_time())
+    cached = await user_service.get_user(1)
+    assert not isinstance(cached, User)
+
+    # Откат и закрытие сессии не затрагивают снимок в кэше
+    with pytest.raises(RuntimeError):
+        async with unit_of_work(session):
+            await user_repo.update(1, nickname="rolled back")
+            raise RuntimeError("boom")
+    await session.close()
+    assert cache.get(1).nickname == "first"
+    assert cache.get(1).get_sessions_count("replay") == 0
+
+    # Чтение с реплики не попадает в общий кэш
+    replica_service = UserService(user_repo, cache=cache, fill_cache=False)
+    cache.invalidate([1])
+    assert (await replica_service.get_user(1)).nickname == "first"
+    assert await replica_service.get_users_by_ids([1]) != []
+    assert cache.stats()["size"] == 0
+
+
+def test_user_cache_lru_and_ttl():
+    """Тестирует вытеснение по размеру и истечение времени жизни записей."""
+    cache = UserCache(max_size=2, ttl=60)
+    for user_id in (1, 2):
+        cache.put(User(id=user_id, nickname=str(user_id)))
+    cache.get(1)
+    cache.put(User(id=3, nickname="3"))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.stats()["evictions"] == 1
+
+    expired = UserCache(ttl=0)
+    expired.put(User(id=1, nickname="1"))
+    assert expired.get(1) is None
+
+
+def test_unsupported_dialect_rejected():
+    """Тестирует отказ от БД без ON CONFLICT с понятной ошибкой."""
+    check_upsert_support("sqlite")
+    check_upsert_support("postgresql")
+    with pytest.raises(ValueError, match="mysql"):
+        check_upsert_support("mysql")